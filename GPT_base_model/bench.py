@@ -0,0 +1,234 @@
+"""
+Training throughput benchmark for the GPT in model.py, on random tokens.
+Times forward + backward + AdamW steps the same way train_gpt2.py runs them
+(bfloat16 autocast, fused AdamW on CUDA) and prints tok/sec for every variant,
+by default eager vs torch.compile:
+$ python bench.py                                   # GPT-2 (124M), B=16, T=1024
+$ python bench.py --device cpu --n_layer 4 --n_embd 256 --n_head 4 -B 4 -T 256
+The random tokens are cut into documents of --doc_len tokens on average, so
+causal attention over whole rows can be compared with packed attention within
+every document (train_gpt2.py --packed):
+$ python bench.py --attention causal packed --doc_len 1000
+Every variant runs in a fresh process and also reports its peak memory (allocated
+CUDA memory, or the resident set on CPU). --memory_budget searches the largest
+power of two B whose peak fits in the budget, e.g. full vs chunked loss:
+$ python bench.py --loss full chunked --memory_budget 80
+or the activation checkpointing policies (see GPTConfig):
+$ python bench.py --compile compile --activation_checkpoint none block attn mlp
+"""
+
+import time
+import argparse
+import itertools
+import dataclasses
+import torch
+from model import GPT, GPTConfig, document_ids
+from metrics import peak_memory, run_isolated, sync
+
+# -----------------------------------------------------------------------------
+
+
+def random_documents(B, T, eot, doc_len):
+    """(B, T) random tokens, with an eot at the start of every document"""
+    x = torch.randint(eot, (B, T))
+    lengths = torch.distributions.Exponential(1.0 / doc_len).sample((B, T))
+    for b in range(B):
+        # the row starts in the middle of a document, like a window of a shard
+        t = int(torch.randint(int(lengths[b, 0]) + 1, ()))
+        for length in lengths[b, 1:]:
+            if t >= T:
+                break
+            x[b, t] = eot
+            t += max(1, int(length))
+    return x
+
+
+def bench_train(
+    config,
+    B,
+    T,
+    device,
+    use_compile=False,
+    steps=20,
+    warmup=5,
+    packed=False,
+    doc_len=1000,
+):
+    """Returns the training throughput in tok/sec and the peak memory in bytes"""
+    device_type = "cuda" if device.startswith("cuda") else "cpu"
+    if device_type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    torch.manual_seed(1337)
+    model = GPT(config).to(device)
+    optimizer = model.configure_optimizers(
+        weight_decay=0.1, learning_rate=6e-4, device_type=device_type, verbose=False
+    )
+    if use_compile:
+        model = torch.compile(model)
+    eot = min(50256, config.vocab_size - 1)
+    x = random_documents(B, T, eot, doc_len).to(device)
+    y = torch.randint(config.vocab_size, (B, T), device=device)
+    doc_ids = document_ids(x, eot) if packed else None
+    # the first steps include compilation and allocator warmup, they are not timed
+    for i in range(warmup + steps):
+        if i == warmup:
+            sync(device)
+            t0 = time.time()
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            logits, loss = model(x, y, doc_ids=doc_ids)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    sync(device)
+    dt = time.time() - t0
+    return B * T * steps / dt, peak_memory(device)
+
+
+def try_bench_train(*args, **kwargs):
+    # None if the variant doesn't fit on the device
+    try:
+        return bench_train(*args, **kwargs)
+    except torch.OutOfMemoryError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="the device to use",
+    )
+    parser.add_argument("-B", type=int, default=16, help="micro batch size")
+    parser.add_argument("-T", type=int, default=1024, help="sequence length")
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--steps", type=int, default=20, help="timed steps per variant")
+    parser.add_argument(
+        "--attention",
+        type=str,
+        nargs="+",
+        default=["causal"],
+        choices=["causal", "packed"],
+        help="causal attention over the whole row, or within every document",
+    )
+    parser.add_argument(
+        "--doc_len", type=int, default=1000, help="mean document length in tokens"
+    )
+    parser.add_argument(
+        "--loss",
+        type=str,
+        nargs="+",
+        default=["full"],
+        choices=["full", "chunked"],
+        help="loss over the full logits, or chunked without materializing them",
+    )
+    parser.add_argument(
+        "--loss_chunk_size",
+        type=int,
+        default=4096,
+        help="tokens per chunked loss chunk",
+    )
+    parser.add_argument(
+        "--activation_checkpoint",
+        type=str,
+        nargs="+",
+        default=["none"],
+        choices=["none", "block", "attn", "mlp"],
+        help="activation checkpointing policies to run",
+    )
+    parser.add_argument(
+        "--activation_checkpoint_every",
+        type=int,
+        default=1,
+        help="checkpoint every N-th block",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        help="GB, find the largest power of two B that fits for every variant",
+    )
+    parser.add_argument(
+        "--compile",
+        type=str,
+        nargs="+",
+        default=["eager", "compile"],
+        choices=["eager", "compile"],
+        help="variants to run",
+    )
+    args = parser.parse_args()
+
+    torch.set_float32_matmul_precision("high")
+    config = GPTConfig(
+        block_size=max(1024, args.T),
+        vocab_size=args.vocab_size,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        n_embd=args.n_embd,
+    )
+    print(f"{config}, B={args.B}, T={args.T}, device={args.device}")
+    results = {}
+    for variant, attention, loss, policy in itertools.product(
+        args.compile, args.attention, args.loss, args.activation_checkpoint
+    ):
+        name = f"{variant:8s} {attention:7s} {loss:7s} ckpt={policy:5s}"
+        chunk_size = args.loss_chunk_size if loss == "chunked" else 0
+        variant_config = dataclasses.replace(
+            config,
+            loss_chunk_size=chunk_size,
+            activation_checkpoint=policy,
+            activation_checkpoint_every=args.activation_checkpoint_every,
+        )
+        kwargs = dict(
+            use_compile=variant == "compile",
+            packed=attention == "packed",
+            doc_len=args.doc_len,
+        )
+        result = run_isolated(
+            try_bench_train,
+            variant_config,
+            args.B,
+            args.T,
+            args.device,
+            steps=args.steps,
+            **kwargs,
+        )
+        if result is None:
+            print(f"{name} | out of memory")
+            continue
+        tok_per_sec, peak = result
+        results[variant, attention, loss, policy] = tok_per_sec
+        print(
+            f"{name} | tok/sec: {tok_per_sec:.2f} | peak memory: {peak / 2**30:.2f}GB"
+        )
+        if args.memory_budget is not None:
+            # double B until the peak memory no longer fits, one timed step per B
+            max_B = None
+            B = 1
+            while True:
+                result = run_isolated(
+                    try_bench_train,
+                    variant_config,
+                    B,
+                    args.T,
+                    args.device,
+                    steps=1,
+                    warmup=1,
+                    **kwargs,
+                )
+                if result is None or result[1] > args.memory_budget * 2**30:
+                    break
+                max_B = B
+                B *= 2
+            print(f"{name} | largest B in {args.memory_budget:.0f}GB: {max_B}")
+    for rest in itertools.product(
+        args.attention, args.loss, args.activation_checkpoint
+    ):
+        if ("eager", *rest) in results and ("compile", *rest) in results:
+            speedup = results[("compile", *rest)] / results[("eager", *rest)]
+            print(f"torch.compile speedup ({', '.join(rest)}): {speedup:.2f}x")
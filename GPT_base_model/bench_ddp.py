@@ -0,0 +1,141 @@
+"""
+Data-parallel scaling benchmark on CPU processes over gloo, on random tokens.
+Every rank is pinned to its own cores (see distributed.py) and runs the step of
+train_gpt2.py: gradient accumulation with the all-reduce on the last micro step only,
+the loss averaged along with the last gradient bucket (distributed.bucket_hook), grad
+clipping and AdamW. The total batch size per step is fixed, as in train_gpt2.py, so
+more processes means fewer micro steps each (strong scaling):
+$ python bench_ddp.py                                # 1/2/4/8 processes
+$ python bench_ddp.py --nproc 1 2 4 --n_layer 4 --n_embd 256 --total_batch_size 65536
+Reports step time, tok/sec, and the speedup and efficiency over the first entry.
+"""
+
+import os
+import time
+import socket
+import argparse
+import multiprocessing as mp
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from model import GPT, GPTConfig
+from distributed import BucketHookState, bucket_hook, pin_threads
+
+# -----------------------------------------------------------------------------
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def worker(rank, world_size, port, config, B, T, total_batch_size, steps, warmup, out):
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    cores = pin_threads(rank, world_size)
+    torch.manual_seed(1337)
+    model = GPT(config)
+    optimizer = model.configure_optimizers(
+        weight_decay=0.1, learning_rate=6e-4, device_type="cpu", verbose=False
+    )
+    model = DDP(model)
+    comm_state = BucketHookState("cpu")
+    model.register_comm_hook(comm_state, bucket_hook)
+    grad_accum_steps = total_batch_size // (B * T * world_size)
+    # every rank its own data, like the rank striding of DataLoaderLite
+    rng = torch.Generator().manual_seed(rank)
+    x = torch.randint(config.vocab_size, (B, T), generator=rng)
+    y = torch.randint(config.vocab_size, (B, T), generator=rng)
+    for i in range(warmup + steps):
+        if i == warmup:
+            dist.barrier()
+            t0 = time.time()
+        optimizer.zero_grad()
+        loss_accum = 0.0
+        for micro_step in range(grad_accum_steps):
+            model.require_backward_grad_sync = micro_step == grad_accum_steps - 1
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                _, loss = model(x, y)
+            loss = loss / grad_accum_steps
+            loss_accum += loss.detach()
+            if micro_step == grad_accum_steps - 1:
+                comm_state.loss = loss_accum  # averaged with the last bucket
+            loss.backward()
+        comm_state.reset()  # the stamps aren't used here, don't let them pile up
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+    dist.barrier()
+    dt = (time.time() - t0) / steps
+    if rank == 0:
+        out.put((dt, len(cores)))
+    dist.destroy_process_group()
+
+
+def bench_ddp(world_size, config, B, T, total_batch_size, steps=5, warmup=2):
+    """Runs world_size ranks, returns (seconds per step, threads per rank)"""
+    ctx = mp.get_context("spawn")
+    out = ctx.SimpleQueue()
+    args = (world_size, free_port(), config, B, T, total_batch_size, steps, warmup, out)
+    procs = [
+        ctx.Process(target=worker, args=(rank, *args)) for rank in range(world_size)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert all(p.exitcode == 0 for p in procs), "a rank failed"
+    return out.get()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="numbers of processes to run",
+    )
+    parser.add_argument("-B", type=int, default=4, help="micro batch size")
+    parser.add_argument("-T", type=int, default=256, help="sequence length")
+    parser.add_argument(
+        "--total_batch_size",
+        type=int,
+        default=None,
+        help="tokens per step (default: B * T * the largest --nproc)",
+    )
+    parser.add_argument("--n_layer", type=int, default=4)
+    parser.add_argument("--n_head", type=int, default=4)
+    parser.add_argument("--n_embd", type=int, default=256)
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--steps", type=int, default=5, help="timed steps per run")
+    args = parser.parse_args()
+
+    total_batch_size = args.total_batch_size or args.B * args.T * max(args.nproc)
+    for n in args.nproc:
+        assert (
+            total_batch_size % (args.B * args.T * n) == 0
+        ), f"total_batch_size must be divisible by B * T * {n}"
+    config = GPTConfig(
+        block_size=max(1024, args.T),
+        vocab_size=args.vocab_size,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        n_embd=args.n_embd,
+    )
+    print(f"{config}, B={args.B}, T={args.T}, total batch size={total_batch_size}")
+    print(f"{len(os.sched_getaffinity(0))} cores available")
+    base = None
+    for n in args.nproc:
+        dt, threads = bench_ddp(
+            n, config, args.B, args.T, total_batch_size, steps=args.steps
+        )
+        tok_per_sec = total_batch_size / dt
+        base = base or (n, tok_per_sec)
+        speedup = tok_per_sec / base[1]
+        efficiency = speedup * base[0] / n
+        print(
+            f"{n} processes x {threads} threads | step: {dt*1000:.2f}ms | tok/sec: {tok_per_sec:.2f} | speedup: {speedup:.2f}x | efficiency: {efficiency:.0%}"
+        )
@@ -0,0 +1,113 @@
+"""
+Load generator for serve.py.
+Fires --num_requests streaming completions at the server for every concurrency level
+and reports generated tokens/sec, and p50/p99 of the request latency and of the
+time to first token:
+$ python serve.py --checkpoint log/model_19072.pt &
+$ python bench_serve.py --concurrency 1 4 16 64
+"""
+
+import json
+import time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+
+
+def run_request(url, prompt, max_new_tokens, seed):
+    """Returns (latency, time to first token, number of tokens) of one request"""
+    body = {
+        "prompt": prompt,
+        "max_new_tokens": max_new_tokens,
+        "top_k": 50,
+        "seed": seed,
+        "stream": True,
+    }
+    req = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"))
+    t0 = time.time()
+    ttft = None
+    num_tokens = 0
+    with urllib.request.urlopen(req) as resp:
+        for line in resp:
+            msg = json.loads(line)
+            if "token" in msg:
+                if ttft is None:
+                    ttft = time.time() - t0
+                num_tokens += 1
+    return time.time() - t0, ttft or 0.0, num_tokens
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def bench(url, concurrency, num_requests, prompt, max_new_tokens):
+    t0 = time.time()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(
+            pool.map(
+                lambda i: run_request(url, prompt, max_new_tokens, seed=i),
+                range(num_requests),
+            )
+        )
+    dt = time.time() - t0
+    latencies = [r[0] for r in results]
+    ttfts = [r[1] for r in results]
+    num_tokens = sum(r[2] for r in results)
+    print(
+        f"concurrency {concurrency:4d} | tok/sec: {num_tokens / dt:9.2f} | "
+        f"latency p50 {percentile(latencies, 50)*1000:8.1f}ms p99 {percentile(latencies, 99)*1000:8.1f}ms | "
+        f"ttft p50 {percentile(ttfts, 50)*1000:8.1f}ms p99 {percentile(ttfts, 99)*1000:8.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-u",
+        "--url",
+        type=str,
+        default="http://127.0.0.1:8000/generate",
+        help="the server endpoint",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32],
+        help="concurrency levels to run",
+    )
+    parser.add_argument(
+        "-n",
+        "--num_requests",
+        type=int,
+        default=64,
+        help="requests per concurrency level",
+    )
+    parser.add_argument(
+        "-m",
+        "--max_new_tokens",
+        type=int,
+        default=64,
+        help="tokens to generate per request",
+    )
+    parser.add_argument(
+        "-p",
+        "--prompt",
+        type=str,
+        default="Hello, I'm a language model,",
+        help="the prompt to send",
+    )
+    args = parser.parse_args()
+    for concurrency in args.concurrency:
+        bench(
+            args.url,
+            concurrency,
+            max(args.num_requests, concurrency),
+            args.prompt,
+            args.max_new_tokens,
+        )
@@ -0,0 +1,462 @@
+"""
+Checkpointing helpers for train_gpt2.py.
+A resumable checkpoint holds the model, the AdamW state, every RNG stream and the
+DataLoaderLite position of every rank, so a preempted run continues exactly where
+it stopped:
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py --resume
+Checkpoints are written on a background thread, the step loop only pays for the
+copy of the state to host memory.
+
+There are two on-disk formats:
+- single: log/model_XXXXX.pt, one torch.save pickle written by rank 0
+- sharded: log/model_XXXXX/, every rank writes its own contiguous slice of every
+  (flattened) tensor as raw bytes to rank_XXXXX.bin, plus its RNG/loader state to
+  rank_XXXXX.pt. Rank 0 adds meta.pt (everything that is not a tensor) and a small
+  index.json manifest. Write time scales down with the number of ranks, and so
+  does read time: on resume every rank memory-maps only the .bin files that hold
+  its own slice of each tensor, and the ranks all-gather the slices into full
+  tensors. Any slice of any tensor can be assembled, so a checkpoint can be loaded
+  at a different world size.
+"""
+
+import os
+import re
+import json
+import math
+import random
+import threading
+from dataclasses import dataclass
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# -----------------------------------------------------------------------------
+
+
+def same_tensor_key(t):
+    """
+    Identifies the memory a tensor views, tensors with the same key are the same
+    tensor under different names (the tied wte/lm_head weight is in the model's
+    state dict twice). None for empty tensors, which may not have any memory
+    """
+    if t.numel() == 0:
+        return None
+    storage = t.untyped_storage().data_ptr()
+    return (storage, t.storage_offset(), tuple(t.shape), t.stride(), t.dtype, t.device)
+
+
+def snapshot_to_cpu(obj, copies=None):
+    """Recursively copies all tensors in a (nested) checkpoint dict to host memory.
+    Tied tensors are copied once, and stay tied in the copy"""
+    copies = {} if copies is None else copies
+    if isinstance(obj, torch.Tensor):
+        key = same_tensor_key(obj)
+        if key is None:
+            return obj.detach().to("cpu", copy=True)
+        if key not in copies:
+            copies[key] = obj.detach().to("cpu", copy=True)
+        return copies[key]
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v, copies) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v, copies) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """Captures every RNG stream this process draws from"""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()  # the current device of this rank
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def optimizer_state_by_id(state):
+    """
+    Re-keys a full optimizer state dict keyed by parameter names (what FSDP runs get
+    from torch.distributed.checkpoint.state_dict) by the positional ids of a plain
+    optimizer.state_dict(), so FSDP and DDP checkpoints are interchangeable
+    """
+    names = [name for group in state["param_groups"] for name in group["params"]]
+    ids = {name: i for i, name in enumerate(names)}
+    return {
+        "state": {ids[name]: s for name, s in state["state"].items()},
+        "param_groups": [
+            {**group, "params": [ids[name] for name in group["params"]]}
+            for group in state["param_groups"]
+        ],
+    }
+
+
+def optimizer_state_by_name(state, model, optimizer):
+    """Inverse of optimizer_state_by_id, for the parameters of model in optimizer"""
+    param_names = {p: name for name, p in model.named_parameters()}
+    names = [
+        param_names[p] for group in optimizer.param_groups for p in group["params"]
+    ]
+    return {
+        "state": {names[i]: s for i, s in state["state"].items()},
+        "param_groups": [
+            {**group, "params": [names[i] for i in group["params"]]}
+            for group in state["param_groups"]
+        ],
+    }
+
+
+def find_latest_checkpoint(log_dir):
+    """Returns the path of the newest complete checkpoint in log_dir, or None"""
+    if not os.path.isdir(log_dir):
+        return None
+    ckpts = []
+    for f in os.listdir(log_dir):
+        m = re.fullmatch(r"model_(\d{5})(\.pt)?", f)
+        path = os.path.join(log_dir, f)
+        if m is None:
+            continue
+        if m.group(2) is None and not is_complete_sharded(path):
+            continue  # some rank never finished writing this one
+        ckpts.append((int(m.group(1)), path))
+    if not ckpts:
+        return None
+    return max(ckpts)[1]
+
+
+def load_checkpoint(path, rank=0, world_size=1, device="cpu"):
+    """
+    Loads either checkpoint format into the same nested dict. In a distributed run
+    every rank passes its rank, the world size and its device: each then reads only
+    its slice of a sharded checkpoint (see ShardedCheckpoint.load)
+    """
+    if os.path.isdir(path):
+        return ShardedCheckpoint(path).load(rank, world_size, device)
+    # the checkpoint holds the GPTConfig and RNG states, not just tensors.
+    # mmap=True maps the tensor storages instead of reading them all up front
+    return torch.load(path, map_location="cpu", weights_only=False, mmap=True)
+
+
+# -----------------------------------------------------------------------------
+# sharded checkpoints
+
+
+@dataclass
+class TensorRef:
+    """Stands in for a tensor in the pickled skeleton of a sharded checkpoint"""
+
+    key: str
+
+
+def split_tensors(obj, path=""):
+    """Returns (skeleton, tensors): obj with every tensor replaced by a TensorRef,
+    and a flat dict of those tensors keyed by their path in obj. Tied tensors are
+    stored once, under the first path, and every later one refers to that path"""
+    tensors = {}
+    first_paths = {}
+
+    def visit(o, path):
+        if isinstance(o, torch.Tensor):
+            key = same_tensor_key(o)
+            if key in first_paths:
+                return TensorRef(first_paths[key])
+            if key is not None:
+                first_paths[key] = path
+            tensors[path] = o
+            return TensorRef(path)
+        if isinstance(o, dict):
+            return {k: visit(v, f"{path}/{k}") for k, v in o.items()}
+        if isinstance(o, (list, tuple)):
+            return type(o)(visit(v, f"{path}/{i}") for i, v in enumerate(o))
+        return o
+
+    return visit(obj, path), tensors
+
+
+def fill_tensors(skeleton, get_tensor):
+    """Inverse of split_tensors, get_tensor(key) produces the tensor for a TensorRef.
+    It has to return the same tensor for the same key, or ties come back untied"""
+    if isinstance(skeleton, TensorRef):
+        return get_tensor(skeleton.key)
+    if isinstance(skeleton, dict):
+        return {k: fill_tensors(v, get_tensor) for k, v in skeleton.items()}
+    if isinstance(skeleton, (list, tuple)):
+        return type(skeleton)(fill_tensors(v, get_tensor) for v in skeleton)
+    return skeleton
+
+
+def holds_tensors(skeleton):
+    """Whether there is a TensorRef anywhere in skeleton"""
+    if isinstance(skeleton, TensorRef):
+        return True
+    if isinstance(skeleton, dict):
+        return any(holds_tensors(v) for v in skeleton.values())
+    if isinstance(skeleton, (list, tuple)):
+        return any(holds_tensors(v) for v in skeleton)
+    return False
+
+
+def shard_bounds(numel, rank, world_size):
+    """The contiguous range of a flattened tensor that `rank` owns"""
+    return numel * rank // world_size, numel * (rank + 1) // world_size
+
+
+def gather_shards(local, numel, world_size, device):
+    """
+    Assembles a flattened tensor of numel elements on the CPU from the slices
+    shard_bounds assigns, each rank passes in its own (all of them must call it)
+    """
+    # all_gather wants the same size from every rank, the slices differ by one at most
+    size = -(-numel // world_size)
+    padded = torch.zeros(size, dtype=local.dtype, device=device)
+    padded[: local.numel()] = local
+    pieces = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(pieces, padded)
+    for rank in range(world_size):
+        start, end = shard_bounds(numel, rank, world_size)
+        pieces[rank] = pieces[rank][: end - start]
+    return torch.cat(pieces).cpu()
+
+
+def dtype_from_str(name):
+    return getattr(torch, name.removeprefix("torch."))
+
+
+def build_index(tensors, world_size):
+    # the layout is a pure function of the shapes and the world size, so rank 0 can
+    # write the manifest for everyone without any communication
+    index = {"world_size": world_size, "tensors": {}}
+    rank_bytes = [0] * world_size
+    for key in sorted(tensors):
+        t = tensors[key]
+        offsets = []
+        for rank in range(world_size):
+            start, end = shard_bounds(t.numel(), rank, world_size)
+            offsets.append(rank_bytes[rank])
+            rank_bytes[rank] += (end - start) * t.element_size()
+        index["tensors"][key] = {
+            "dtype": str(t.dtype),
+            "shape": list(t.shape),
+            "offsets": offsets,
+        }
+    index["rank_bytes"] = rank_bytes
+    return index
+
+
+def is_complete_sharded(path):
+    index_path = os.path.join(path, "index.json")
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    for rank, nbytes in enumerate(index["rank_bytes"]):
+        bin_path = os.path.join(path, f"rank_{rank:05d}.bin")
+        if not os.path.exists(bin_path) or os.path.getsize(bin_path) != nbytes:
+            return False
+        if not os.path.exists(os.path.join(path, f"rank_{rank:05d}.pt")):
+            return False
+    return True
+
+
+class ShardedCheckpoint:
+    """
+    Reader for the sharded format. The rank files are memory-mapped on first use
+    and tensors are assembled from the slices they need, so nothing is unpickled
+    except the small skeleton and the per-rank states.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as f:
+            self.index = json.load(f)
+        self.world_size = self.index["world_size"]
+        self.maps = {}
+
+    def rank_map(self, rank):
+        if rank not in self.maps:
+            bin_path = os.path.join(self.path, f"rank_{rank:05d}.bin")
+            # copy-on-write so torch.frombuffer gets a writable buffer, nothing is
+            # ever written back to the file
+            self.maps[rank] = np.memmap(bin_path, dtype=np.uint8, mode="c")
+        return self.maps[rank]
+
+    def read(self, key, start=0, end=None):
+        """Elements [start, end) of the flattened tensor `key`, from whichever
+        rank files hold them. This is what re-sharding to a new world size uses."""
+        info = self.index["tensors"][key]
+        dtype = dtype_from_str(info["dtype"])
+        numel = math.prod(info["shape"])
+        end = numel if end is None else end
+        out = torch.empty(end - start, dtype=dtype)
+        itemsize = out.element_size()
+        for rank in range(self.world_size):
+            rank_lo, rank_hi = shard_bounds(numel, rank, self.world_size)
+            lo, hi = max(rank_lo, start), min(rank_hi, end)
+            if lo >= hi:
+                continue
+            offset = info["offsets"][rank] + (lo - rank_lo) * itemsize
+            buf = self.rank_map(rank)[offset : offset + (hi - lo) * itemsize]
+            out[lo - start : hi - start].copy_(torch.frombuffer(buf, dtype=dtype))
+        return out
+
+    def tensor(self, key):
+        return self.read(key).view(self.index["tensors"][key]["shape"])
+
+    def load(self, rank=0, world_size=1, device="cpu"):
+        """
+        The same dict the single-file format has, but the entries that hold tensors
+        are only assembled when they are first looked up (see LazyCheckpoint). With
+        world_size > 1 every rank reads just its shard_bounds slice of each tensor,
+        from the rank files that overlap it, and the full tensor is all-gathered on
+        device, so every rank must look up the same entries in the same order.
+        """
+        skeleton = torch.load(
+            os.path.join(self.path, "meta.pt"), map_location="cpu", weights_only=False
+        )
+
+        tensors = {}  # tied tensors are looked up once per name, but read once
+
+        def get_tensor(key):
+            if key in tensors:
+                return tensors[key]
+            if world_size == 1:
+                tensors[key] = self.tensor(key)
+                return tensors[key]
+            info = self.index["tensors"][key]
+            numel = math.prod(info["shape"])
+            local = self.read(key, *shard_bounds(numel, rank, world_size))
+            full = gather_shards(local.to(device), numel, world_size, device)
+            tensors[key] = full.view(info["shape"])
+            return tensors[key]
+
+        rank_states = [
+            torch.load(
+                os.path.join(self.path, f"rank_{r:05d}.pt"),
+                map_location="cpu",
+                weights_only=False,
+            )
+            for r in range(self.world_size)
+        ]
+        checkpoint = LazyCheckpoint(skeleton, get_tensor)
+        checkpoint["world_size"] = self.world_size
+        checkpoint["rng"] = [s["rng"] for s in rank_states]
+        checkpoint["loader"] = [s["loader"] for s in rank_states]
+        return checkpoint
+
+
+class LazyCheckpoint(dict):
+    """
+    A checkpoint dict whose top-level entries that hold tensors (model, optimizer)
+    are filled in by get_tensor on first lookup, everything else is there up front
+    """
+
+    def __init__(self, skeleton, get_tensor):
+        super().__init__()
+        self.skeletons = {}
+        self.get_tensor = get_tensor
+        for key, value in skeleton.items():
+            if holds_tensors(value):
+                self.skeletons[key] = value
+            else:
+                self[key] = value
+
+    def __missing__(self, key):
+        if key not in self.skeletons:
+            raise KeyError(key)
+        value = fill_tensors(self.skeletons.pop(key), self.get_tensor)
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self.skeletons
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary name, renamed once complete"""
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints with torch.save on a background thread.
+    save() snapshots the state to host memory synchronously (training mutates the
+    originals right after), then hands the write off. Files are written to a
+    temporary name and renamed, so a crash mid-write never leaves a torn checkpoint.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, checkpoint, path):
+        """Single-file format, called on rank 0 only"""
+        self.wait()  # at most one write in flight
+        checkpoint = snapshot_to_cpu(checkpoint)
+        self.start(self.write, checkpoint, path)
+
+    def save_sharded(self, checkpoint, rank_state, path, rank, world_size):
+        """Sharded format, called on every rank with the same (replicated)
+        checkpoint and this rank's own rank_state (RNG and loader position)"""
+        self.wait()
+        skeleton, tensors = split_tensors(checkpoint)
+        index = build_index(tensors, world_size) if rank == 0 else None
+        slices = []
+        # only this rank's slice of each tensor is copied to host memory
+        for key in sorted(tensors):
+            flat = tensors[key].detach().reshape(-1)
+            start, end = shard_bounds(flat.numel(), rank, world_size)
+            slices.append(flat[start:end].to("cpu", copy=True))
+        rank_state = snapshot_to_cpu(rank_state)
+        self.start(self.write_sharded, skeleton, index, slices, rank_state, path, rank)
+
+    def start(self, target, *args):
+        self.thread = threading.Thread(target=target, args=args, daemon=True)
+        self.thread.start()
+
+    def write(self, checkpoint, path):
+        try:
+            atomic_save(checkpoint, path)
+        except BaseException as e:
+            self.error = e  # re-raised by wait() on the training thread
+
+    def write_sharded(self, skeleton, index, slices, rank_state, path, rank):
+        try:
+            os.makedirs(path, exist_ok=True)
+            bin_path = os.path.join(path, f"rank_{rank:05d}.bin")
+            with open(bin_path + ".tmp", "wb") as f:
+                for t in slices:
+                    f.write(t.contiguous().view(torch.uint8).numpy().tobytes())
+            os.replace(bin_path + ".tmp", bin_path)
+            atomic_save(rank_state, os.path.join(path, f"rank_{rank:05d}.pt"))
+            if index is not None:
+                atomic_save(skeleton, os.path.join(path, "meta.pt"))
+                # the manifest goes last, readers use it to check all ranks finished
+                with open(os.path.join(path, "index.json.tmp"), "w") as f:
+                    json.dump(index, f)
+                os.replace(
+                    os.path.join(path, "index.json.tmp"),
+                    os.path.join(path, "index.json"),
+                )
+        except BaseException as e:
+            self.error = e
+
+    def wait(self):
+        """Blocks until the write in flight is done, and raises if it failed. Call
+        it once more after the last save(), or a failed last write goes unnoticed"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing checkpoint failed") from error
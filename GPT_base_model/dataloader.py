@@ -0,0 +1,331 @@
+"""
+Data loading of train_gpt2.py: DataLoaderLite cuts the token shards written by
+fineweb.py into (B, T) batches for every rank, either walking the shards in order
+or, with shuffle=True, the documents of all shards in a seeded random order (see
+shards.py). PrefetchLoader builds the next batches on a background thread.
+"""
+
+import os
+import mmap
+import time
+import queue
+import threading
+import numpy as np
+import torch
+from shards import ShardIndex, permute
+
+# -----------------------------------------------------------------------------
+
+
+def load_tokens(filename, memmap=False):
+    if memmap:
+        # map the uint16 shard read-only, pages are only faulted in as batches are sliced
+        return np.load(filename, mmap_mode="r")
+    npt = np.load(filename)
+    npt = npt.astype(np.int32)  # added after video
+    ptt = torch.tensor(npt, dtype=torch.long)
+    return ptt
+
+
+def page_of(tokens, i):
+    # the page of the mapping of a memory-mapped shard that token i is on (i can be an array).
+    # np.memmap maps from an allocation-aligned offset, so element 0 sits a bit in
+    base = tokens.offset % mmap.ALLOCATIONGRANULARITY
+    return (base + i * tokens.itemsize) // mmap.PAGESIZE
+
+
+def release_pages(tokens, first, end):
+    # hand pages [first, end) of a memory-mapped shard back to the kernel, they are
+    # faulted in again if they are read again
+    mm = getattr(tokens, "_mmap", None)
+    if mm is None or not hasattr(mm, "madvise") or end <= first:
+        return
+    mm.madvise(mmap.MADV_DONTNEED, first * mmap.PAGESIZE, (end - first) * mmap.PAGESIZE)
+
+
+def page_counts(tokens, index):
+    # how many of the documents in the index of a shard (see shards.py) are on each of
+    # its pages. A page holds at most PAGESIZE // 2 + 1 of them, so uint16 counts do
+    starts, lengths = index[:, 0], index[:, 1]
+    starts, lengths = starts[lengths > 0], lengths[lengths > 0]
+    num_pages = int(page_of(tokens, len(tokens))) + 1
+    first = page_of(tokens, starts)
+    end = page_of(tokens, starts + lengths - 1) + 1
+    counts = np.bincount(first, minlength=num_pages + 1)
+    counts -= np.bincount(end, minlength=num_pages + 1)
+    return np.cumsum(counts)[:num_pages].astype(np.uint16)
+
+
+class DataLoaderLite:
+    def __init__(
+        self,
+        B,
+        T,
+        process_rank,
+        num_processes,
+        split,
+        memmap=False,
+        shuffle=False,
+        seed=1337,
+        data_root="edu_fineweb10B",
+        verbose=True,
+    ):
+        self.B = B
+        self.T = T
+        self.process_rank = process_rank
+        self.num_processes = num_processes
+        self.memmap = memmap  # slice batches straight out of memory-mapped shards
+        self.shuffle = shuffle
+        self.seed = seed
+        assert split in {"train", "val"}
+
+        if shuffle:
+            # walk the documents of all shards in a seeded random order that changes every
+            # epoch, concatenated into one stream that is cut into windows of T tokens. The
+            # document index says where every document is without opening the shards, and
+            # the order is computed on the fly (see permute), so nothing but a few counters
+            # is held in memory
+            self.index = ShardIndex(data_root, split)
+            self.shards = self.index.filenames
+            assert (
+                self.index.num_tokens > B * T * num_processes
+            ), f"not enough data in {split}"
+            if verbose:
+                print(
+                    f"found {len(self.shards)} shards for split {split}, {len(self.index)} documents, {self.index.num_tokens} tokens"
+                )
+            self.reset()
+            return
+
+        # get the shard filenames
+        shards = os.listdir(data_root)
+        shards = [s for s in shards if split in s and s.endswith(".npy")]
+        shards = sorted(shards)
+        shards = [os.path.join(data_root, s) for s in shards]
+        self.shards = shards
+        assert len(shards) > 0, f"no shards found for split {split}"
+        if verbose:
+            print(f"found {len(shards)} shards for split {split}")
+        self.reset()
+
+    def reset(self):
+        if self.shuffle:
+            # state, init at the first document of epoch zero. The position counts the
+            # documents (doc, plus offset tokens of the next one) and tokens (consumed)
+            # taken by all ranks together, every step rank r takes the r-th B*T of them
+            self.epoch = 0
+            self.doc = 0
+            self.offset = 0
+            self.consumed = 0
+            # per shard, how many documents on every page were not read yet this epoch
+            self.page_counts = {}
+            return
+        # state, init at shard zero
+        self.current_shard = 0
+        self.load_shard()
+        self.current_position = self.B * self.T * self.process_rank
+
+    def state_dict(self):
+        if self.shuffle:
+            return {
+                "epoch": self.epoch,
+                "doc": self.doc,
+                "offset": self.offset,
+                "consumed": self.consumed,
+            }
+        return {
+            "current_shard": self.current_shard,
+            "current_position": self.current_position,
+        }
+
+    def load_state_dict(self, state):
+        if self.shuffle:
+            assert "doc" in state, "the checkpoint was taken without --shuffle"
+            self.epoch = state["epoch"]
+            self.doc = state["doc"]
+            self.offset = state["offset"]
+            self.consumed = state["consumed"]
+            # pages of the documents read before the checkpoint are not released again
+            # until the next epoch, which only costs memory the kernel can reclaim
+            self.page_counts = {}
+            return
+        assert "current_shard" in state, "the checkpoint was taken with --shuffle"
+        self.current_shard = state["current_shard"]
+        self.load_shard()
+        self.current_position = state["current_position"]
+
+    def load_shard(self):
+        self.tokens = load_tokens(self.shards[self.current_shard], memmap=self.memmap)
+        self.released_pages = 0  # prefix of the mapping already handed back to the kernel
+
+    def release_prefix(self, end):
+        # in memmap mode, tell the kernel we are done with the tokens before `end`,
+        # otherwise every page we ever sliced stays resident until the shard is unmapped
+        page = int(page_of(self.tokens, end))  # the pages before it hold earlier tokens only
+        if page > self.released_pages:
+            release_pages(self.tokens, self.released_pages, page)
+            self.released_pages = page
+
+    def release_document(self, shard, start, length):
+        # a document read to its end (by any rank): pages it has to itself go right
+        # away, the first and last one only once the other documents on them are read
+        if length == 0:
+            return
+        tokens = self.index.shard(shard)
+        if shard not in self.page_counts:
+            self.page_counts[shard] = page_counts(tokens, self.index.indexes[shard])
+        counts = self.page_counts[shard]
+        first = int(page_of(tokens, start))
+        last = int(page_of(tokens, start + length - 1))
+        counts[first : last + 1] -= 1
+        release_pages(
+            tokens,
+            first if counts[first] == 0 else first + 1,
+            last + 1 if counts[last] == 0 else last,
+        )
+
+    def documents(self, doc):
+        # yields (doc, shard, start, length) of the documents of this epoch's order from
+        # doc on, a document that straddles two shards is two of them (see ShardIndex)
+        num_docs = len(self.index)
+        while doc < num_docs:
+            ids = np.arange(doc, min(doc + 1024, num_docs))
+            ids = permute(ids, num_docs, (self.seed, self.epoch))
+            shards = np.searchsorted(self.index.shard_docs, ids, side="right") - 1
+            for i, shard in zip(ids, shards):
+                entry = self.index.indexes[shard][i - self.index.shard_docs[shard]]
+                start, length, _ = entry
+                yield doc, int(shard), int(start), int(length)
+                doc += 1
+
+    def next_batch(self):
+        if self.shuffle:
+            return self.next_shuffled_batch()
+        B, T = self.B, self.T
+        buf = self.tokens[self.current_position : self.current_position + B * T + 1]
+        if self.memmap:
+            # widen only this batch to int64, the shard itself stays uint16 on disk
+            buf = torch.from_numpy(buf.astype(np.int64))
+            self.release_prefix(self.current_position + B * T + 1)
+        x = (buf[:-1]).view(B, T)  # inputs
+        y = (buf[1:]).view(B, T)  # targets
+        # advance the position in the tensor
+        self.current_position += B * T * self.num_processes
+        # if loading the next batch would be out of bounds, advance to next shard
+        if self.current_position + (B * T * self.num_processes + 1) > len(self.tokens):
+            self.current_shard = (self.current_shard + 1) % len(self.shards)
+            self.load_shard()
+            self.current_position = B * T * self.process_rank
+        return x, y
+
+    def next_shuffled_batch(self):
+        B, T = self.B, self.T
+        step_tokens = B * T * self.num_processes
+        if self.consumed + step_tokens + 1 > self.index.num_tokens:
+            # not enough tokens left for every rank, start the next epoch in a new order
+            self.epoch += 1
+            self.doc = 0
+            self.offset = 0
+            self.consumed = 0
+            self.page_counts = {}
+        # every rank walks the documents of the whole step, but only copies its own
+        # stretch of the stream: B windows, and the target of the last token
+        lo = B * T * self.process_rank
+        hi = lo + B * T + 1
+        buf = np.empty(hi - lo, dtype=np.int64)
+        pos = -self.offset  # where the current document starts, relative to the step
+        for doc, shard, start, length in self.documents(self.doc):
+            a, b = max(pos, lo), min(pos + length, hi)
+            if a < b:
+                tokens = self.index.shard(shard)
+                buf[a - lo : b - lo] = tokens[start + a - pos : start + b - pos]
+            if pos + length > step_tokens:
+                # the next step starts inside this document
+                self.doc, self.offset = doc, step_tokens - pos
+                break
+            # every document is read once per epoch, don't let the pages pile up
+            self.release_document(shard, start, length)
+            pos += length
+        self.consumed += step_tokens
+        buf = torch.from_numpy(buf)
+        x = buf[:-1].view(B, T)  # inputs
+        y = buf[1:].view(B, T)  # targets
+        return x, y
+
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoaderLite and builds the next `depth` batches on a background thread.
+    On CUDA the batches are staged in a ring of pinned host buffers and copied to the
+    device with non_blocking=True on a side stream, so next_batch() only has to make
+    the current stream wait on an event. Elsewhere the thread still overlaps the host
+    slicing with compute. `wait_time` accumulates the seconds next_batch() was blocked.
+    state_dict() is the loader position after the last batch handed out, not after
+    the batches still sitting in the queue, so it is safe to checkpoint.
+    """
+
+    def __init__(self, loader, device, depth=4):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.use_cuda = device.startswith("cuda")
+        self.stream = torch.cuda.Stream(device=device) if self.use_cuda else None
+        self.queue = queue.Queue(maxsize=depth)
+        self.wait_time = 0.0
+        self.consumed_state = loader.state_dict()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def worker(self):
+        try:
+            if self.use_cuda and torch.device(self.device).index is not None:
+                # a new thread starts out on cuda:0, the pinned buffers, events and
+                # copies must belong to this rank's device
+                torch.cuda.set_device(self.device)
+            slots = []  # ring of (pinned x, pinned y, copy done event)
+            i = 0
+            while True:
+                x, y = self.loader.next_batch()
+                state = self.loader.state_dict()
+                event = None
+                if self.use_cuda:
+                    if len(slots) < self.depth + 1:
+                        slots.append(
+                            (
+                                torch.empty_like(x).pin_memory(),
+                                torch.empty_like(y).pin_memory(),
+                                torch.cuda.Event(),
+                            )
+                        )
+                    px, py, event = slots[i]
+                    i = (i + 1) % (self.depth + 1)
+                    event.synchronize()  # the previous copy out of this slot is done
+                    px.copy_(x)
+                    py.copy_(y)
+                    with torch.cuda.stream(self.stream):
+                        x = px.to(self.device, non_blocking=True)
+                        y = py.to(self.device, non_blocking=True)
+                        event.record(self.stream)
+                self.queue.put((x, y, event, state))
+        except BaseException as e:
+            self.queue.put(e)  # re-raised on the training thread
+
+    def next_batch(self):
+        t0 = time.time()
+        item = self.queue.get()
+        self.wait_time += time.time() - t0
+        if isinstance(item, BaseException):
+            raise item
+        x, y, event, self.consumed_state = item
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # the tensors were allocated on the side stream but are used on this one
+            x.record_stream(stream)
+            y.record_stream(stream)
+        else:
+            x, y = x.to(self.device), y.to(self.device)
+        return x, y
+
+    def state_dict(self):
+        return self.consumed_state
@@ -0,0 +1,157 @@
+"""
+Helpers for data-parallel training of train_gpt2.py on CPU processes over gloo.
+torchrun starts every rank with OMP_NUM_THREADS=1 unless told otherwise, and without
+it every rank would spread its threads over all the cores of the host, so the ranks
+on a host are each given their own disjoint slice of the cores instead:
+$ torchrun --standalone --nproc_per_node=4 train_gpt2.py
+$ torchrun --standalone --nproc_per_node=4 train_gpt2.py --cpu_threads 8
+It also has the DDP comm hook train_gpt2.py reduces the gradient buckets with. It
+optionally compresses them (fp16/bf16 or PowerSGD), folds the loss of the step into
+the last bucket's all-reduce, and times every bucket's collective so that a step can
+be broken down into compute and (exposed) communication:
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py --bucket_cap_mb 50 --comm_hook bf16
+"""
+
+import os
+import time
+import torch
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+# -----------------------------------------------------------------------------
+
+
+def pin_threads(local_rank, local_world_size, num_threads=None):
+    """
+    Pins this process to num_threads cores of the ones it may run on (by default an
+    equal share for each of the local_world_size ranks on this host, rank i takes the
+    i-th slice) and sizes torch's intra-op thread pool to match. Returns the cores.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))  # no affinity control (macOS)
+    n = num_threads or max(1, len(cpus) // local_world_size)
+    # more ranks (or threads) than cores wraps around and shares them
+    start = local_rank * n
+    cores = [cpus[(start + i) % len(cpus)] for i in range(n)]
+    if hasattr(os, "sched_setaffinity"):
+        # threads started from now on (the OpenMP pool, the prefetcher) inherit it
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(n)
+    return cores
+
+
+# -----------------------------------------------------------------------------
+# gradient bucket communication
+
+
+def stamp(device):
+    """A point in time: an event recorded on the current CUDA stream, or the host clock"""
+    if device.startswith("cuda"):
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+    return time.perf_counter()
+
+
+def elapsed(start, end):
+    """Seconds from one stamp to another, CUDA events must have completed"""
+    if isinstance(start, torch.cuda.Event):
+        return start.elapsed_time(end) / 1000
+    return end - start
+
+
+class BucketHookState:
+    """
+    State of bucket_hook. The gradient buckets are reduced with the comm hook `name`:
+    none (an averaging all-reduce), fp16 or bf16 (compressed to half precision on
+    the wire) or powersgd (low-rank approximation, with error feedback). Set `loss`
+    before the backward pass that syncs the gradients and it comes back averaged
+    across the ranks. Every bucket's collective is stamped until reset().
+    """
+
+    def __init__(self, device, name="none", powersgd_rank=1):
+        self.device = device
+        self.name = name
+        self.inner = {
+            "none": None,
+            "fp16": default_hooks.fp16_compress_hook,
+            "bf16": default_hooks.bf16_compress_hook,
+            "powersgd": powerSGD_hook.powerSGD_hook,
+        }[name]
+        self.inner_state = None  # the default process group
+        if name == "powersgd":
+            self.inner_state = powerSGD_hook.PowerSGDState(
+                process_group=None, matrix_approximation_rank=powersgd_rank
+            )
+        self.loss = None
+        self.reset()
+
+    def reset(self):
+        self.launches = []  # when the bucket was ready and its collective started
+        self.completions = []  # when its result was ready
+
+
+def comm_breakdown(launches, completions, start, end):
+    """
+    Returns (comm, exposed comm) seconds of a forward/backward pass between the stamps
+    start and end, given the stamps of its gradient collectives (see BucketHookState).
+    comm is how long any collective was in flight, exposed comm the part of it that
+    did not overlap with the backward pass: from the moment the last bucket was ready
+    until the backward pass returned.
+    """
+    if not launches:
+        return 0.0, 0.0
+    spans = sorted(
+        (elapsed(start, a), elapsed(start, b)) for a, b in zip(launches, completions)
+    )
+    comm = 0.0
+    busy_until = 0.0
+    for a, b in spans:
+        comm += max(0.0, b - max(a, busy_until))
+        busy_until = max(busy_until, b)
+    exposed = max(0.0, elapsed(launches[-1], end))
+    return comm, exposed
+
+
+def bucket_hook(state, bucket):
+    """DDP comm hook, see BucketHookState"""
+    state.launches.append(stamp(state.device))
+    world_size = dist.get_world_size()
+    # the last bucket is the one whose collective ends the backward pass
+    loss = state.loss if bucket.is_last() else None
+    if state.inner is None:
+        tensor = bucket.buffer()
+        if loss is not None:
+            # one collective for both, instead of a blocking one for the loss after
+            tensor = torch.cat([tensor, loss.view(1).to(tensor.dtype)])
+        tensor.div_(world_size)
+        fut = dist.all_reduce(tensor, async_op=True).get_future()
+
+        def unpack(fut):
+            reduced = fut.value()[0]
+            if loss is not None:
+                loss.copy_(reduced[-1])
+                reduced = bucket.buffer().copy_(reduced[:-1])
+            return reduced
+
+    else:
+        fut = state.inner(state.inner_state, bucket)
+        if loss is not None:
+            # compressing the loss would round it, so it goes out in full precision
+            # right behind the last bucket, and the backward pass waits for both
+            loss.div_(world_size)
+            loss_fut = dist.all_reduce(loss, async_op=True).get_future()
+
+        def unpack(fut):
+            if loss is not None:
+                loss_fut.wait()
+            return fut.value()
+
+    def done(fut):
+        reduced = unpack(fut)
+        state.completions.append(stamp(state.device))
+        return reduced
+
+    return fut.then(done)
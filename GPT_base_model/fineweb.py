@@ -5,78 +5,305 @@ Downloads and tokenizes the data and saves data shards to disk.
 Run simply as:
 $ python fineweb.py
 Will save shards to the local directory "edu_fineweb10B".
+
+With --stream the dataset is read from the hub as it is tokenized instead of being
+downloaded up front. --local reads .jsonl/.parquet files (one file or a directory of
+them) instead of the hub, e.g. to try the whole pipeline offline on a small stand-in:
+$ python fineweb.py --local sample.jsonl --shard_size 1000000 --output_dir fineweb_test
+Documents are tokenized in large chunks with tiktoken's batch encoder, and the
+workers write the tokens into shared memory instead of sending them back through the
+pool. Full shards are handed to a pool of writer processes, and manifest.json in the output
+directory records every completed shard and where in the dataset it ends. Every shard
+gets a document index sidecar (see shards.py). Running the
+same command again after a crash resumes after the last completed shard.
 """
 
 import os
+import sys
+import time
+import glob
+import json
+import argparse
+import itertools
+import collections
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import numpy as np
 import tiktoken
-from datasets import load_dataset # pip install datasets
 from tqdm import tqdm # pip install tqdm
+from shards import index_filename, save_manifest, write_index
 
 # ------------------------------------------
 local_dir = "edu_fineweb10B"
 remote_name = "sample-10BT"
 shard_size = int(1e8) # 100M tokens per shard, total of 100 shards
-
-# create the cache the local directory if it doesn't exist yet
-DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), local_dir)
-os.makedirs(DATA_CACHE_DIR, exist_ok=True)
-
-# download the dataset
-fw = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train")
+chunk_size = 256 # documents tokenized by one batched call
+slot_size = 2**20 # tokens of the shared memory output buffer of a chunk, ~4x an average chunk
 
 # init the tokenizer
 enc = tiktoken.get_encoding("gpt2")
 eot = enc._special_tokens['<|endoftext|>'] # end of text token
-def tokenize(doc):
-    # tokenizes a single document and returns a numpy array of uint16 tokens
-    tokens = [eot] # the special <|endoftext|> token delimits all documents
-    tokens.extend(enc.encode_ordinary(doc["text"]))
-    tokens_np = np.array(tokens)
-    assert (0 <= tokens_np).all() and (tokens_np < 2**16).all(), "token dictionary too large for uint16"
-    tokens_np_uint16 = tokens_np.astype(np.uint16)
-    return tokens_np_uint16
+assert enc.n_vocab <= 2**16, "token dictionary too large for uint16"
 
-def write_datafile(filename, tokens_np):
-    np.save(filename, tokens_np)
-
-# tokenize all documents and write output shards, each of shard_size tokens (last shard has remainder)
-nprocs = max(1, os.cpu_count()//2)
-with mp.Pool(nprocs) as pool:
-    shard_index = 0
-    # preallocate buffer to hold current shard
-    all_tokens_np = np.empty((shard_size,), dtype=np.uint16)
-    token_count = 0
-    progress_bar = None
-    for tokens in pool.imap(tokenize, fw, chunksize=16):
-
-        # is there enough space in the current shard for the new tokens?
-        if token_count + len(tokens) < shard_size:
-            # simply append tokens to current shard
-            all_tokens_np[token_count:token_count+len(tokens)] = tokens
-            token_count += len(tokens)
-            # update progress bar
-            if progress_bar is None:
-                progress_bar = tqdm(total=shard_size, unit="tokens", desc=f"Shard {shard_index}")
-            progress_bar.update(len(tokens))
+slots = None # the shared memory output buffers, attached once in every tokenizer process
+num_threads = 1
+def init_tokenizer(slot_names, threads):
+    global slots, num_threads
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    num_threads = threads
+
+def tokenize_chunk(texts, slot):
+    # tokenizes a chunk of documents with one batched call and writes the tokens straight into the
+    # shared memory slot, each document preceded by the special <|endoftext|> token that delimits it.
+    # Only the document lengths go back through the pool (and the tokens, if they don't fit the slot)
+    encoded = enc.encode_ordinary_batch(texts, num_threads=num_threads)
+    lengths = np.array([len(tokens) + 1 for tokens in encoded], dtype=np.int64)
+    total = int(lengths.sum())
+    slot_tokens = slots[slot].size // 2
+    tokens_np = np.ndarray((min(total, slot_tokens),), dtype=np.uint16, buffer=slots[slot].buf)
+    if total > slot_tokens:
+        tokens_np = np.empty((total,), dtype=np.uint16)
+    tokens_np[np.cumsum(lengths) - lengths] = eot
+    position = 0
+    for tokens in encoded:
+        tokens_np[position+1:position+1+len(tokens)] = tokens
+        position += len(tokens) + 1
+    return lengths, (tokens_np if total > slot_tokens else None)
+
+def tokenize_all(pool, docs, slots):
+    # yields (tokens, document lengths) of every chunk of documents, in order. Every chunk in flight
+    # owns a slot, which is reused when the consumer asks for the next chunk, so a streamed dataset
+    # is read just ahead of the tokenizer workers
+    free_slots = collections.deque(range(len(slots)))
+    in_flight = collections.deque()
+    while True:
+        texts = [doc["text"] for doc in itertools.islice(docs, chunk_size)]
+        if texts:
+            slot = free_slots.popleft()
+            in_flight.append((slot, pool.apply_async(tokenize_chunk, (texts, slot))))
+            if free_slots:
+                continue
+        if not in_flight:
+            return
+        slot, result = in_flight.popleft()
+        lengths, tokens_np = result.get()
+        if tokens_np is None:
+            tokens_np = np.ndarray((int(lengths.sum()),), dtype=np.uint16, buffer=slots[slot].buf)
+        yield tokens_np, lengths
+        del tokens_np
+        free_slots.append(slot)
+
+def iterate_local(path, start=0):
+    # yields the documents of a .jsonl/.parquet file, or of all such files in a directory, from
+    # document `start` on. Parquet files and row groups before it are skipped by their row counts
+    # without being read, .jsonl lines are skipped without being parsed
+    if os.path.isdir(path):
+        filenames = sorted(f for f in glob.glob(os.path.join(path, "*")) if f.endswith((".jsonl", ".parquet")))
+    else:
+        filenames = [path]
+    for filename in filenames:
+        if filename.endswith(".parquet"):
+            import pyarrow.parquet as pq # pip install pyarrow
+            pf = pq.ParquetFile(filename)
+            row_groups = []
+            for i in range(pf.num_row_groups):
+                num_rows = pf.metadata.row_group(i).num_rows
+                if start >= num_rows and not row_groups:
+                    start -= num_rows
+                else:
+                    row_groups.append(i)
+            for batch in pf.iter_batches(columns=["text"], row_groups=row_groups):
+                texts = batch.column("text").to_pylist()
+                for text in texts[start:]:
+                    yield {"text": text}
+                start = max(0, start - len(texts))
         else:
-            # write the current shard and start a new one
-            split = "val" if shard_index == 0 else "train"
-            filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-            # split the document into whatever fits in this shard; the remainder goes to next one
-            remainder = shard_size - token_count
-            progress_bar.update(remainder)
-            all_tokens_np[token_count:token_count+remainder] = tokens[:remainder]
-            write_datafile(filename, all_tokens_np)
-            shard_index += 1
-            progress_bar = None
-            # populate the next shard with the leftovers of the current doc
-            all_tokens_np[0:len(tokens)-remainder] = tokens[remainder:]
-            token_count = len(tokens)-remainder
+            with open(filename, "r") as f:
+                for line in f:
+                    if start > 0:
+                        start -= 1
+                        continue
+                    yield json.loads(line)
+
+def load_documents(local, stream, start=0):
+    # the documents from index `start` on, the dataset skips the ones before it
+    if local is not None:
+        return iterate_local(local, start)
+    from datasets import load_dataset # pip install datasets
+    dataset = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train", streaming=stream)
+    return dataset.skip(start) if start > 0 else dataset
+
+def write_datafile(filename, tokens_np):
+    # write to a temporary file and rename it, a crash never leaves a truncated shard
+    with open(filename + ".tmp", "wb") as f:
+        np.save(f, tokens_np)
+    os.replace(filename + ".tmp", filename + ".npy")
+
+def write_shard(shm_name, token_count, filename, starts, doc_ids):
+    # runs in a writer process, the tokens are in the shared memory buffer of the shard.
+    # The document index goes first, so a shard on disk always has its index
+    write_index(index_filename(filename), starts, doc_ids, token_count)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    tokens_np = np.ndarray((token_count,), dtype=np.uint16, buffer=shm.buf)
+    write_datafile(filename, tokens_np)
+    del tokens_np # the buffer can't be closed while an array still points into it
+    shm.close()
 
-    # write any remaining tokens as the last shard
-    if token_count != 0:
+def document_pieces(ends, lengths, a, b):
+    # the documents of a chunk that overlap its tokens [a, b): their indices in the chunk, and
+    # where in [a, b) each of them starts (at a, for one that starts before a)
+    starts = ends - lengths
+    first = np.searchsorted(ends, a, side="right")
+    last = np.searchsorted(starts, b, side="left")
+    return np.arange(first, last), np.maximum(starts[first:last], a) - a
+
+def load_manifest(output_dir, config):
+    path = os.path.join(output_dir, "manifest.json")
+    if not os.path.exists(path):
+        # docs: index of the first document not fully written yet, doc_offset: how many of its tokens are
+        return {**config, "shards": [], "docs": 0, "doc_offset": 0, "complete": False}
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    for key, value in config.items():
+        if key not in manifest and manifest["complete"]:
+            continue  # written by shards.py --build for shards from before the manifest, nothing left to resume
+        assert manifest[key] == value, f"{path} was written with {key}={manifest[key]}, not {value}"
+    return manifest
+
+# ------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize FineWeb-Edu into uint16 shards")
+    parser.add_argument("-o", "--output_dir", type=str, default=os.path.join(os.path.dirname(__file__), local_dir), help="where to write the shards")
+    parser.add_argument("-s", "--shard_size", type=int, default=shard_size, help="tokens per shard")
+    parser.add_argument("--stream", action="store_true", help="stream the dataset instead of downloading it up front")
+    parser.add_argument("--local", type=str, default=None, help="read a local .jsonl/.parquet file (or directory of them) instead of the hub")
+    parser.add_argument("-n", "--num_procs", type=int, default=max(1, os.cpu_count()//2), help="tokenizer processes")
+    parser.add_argument("-t", "--num_threads", type=int, default=1, help="tiktoken threads per tokenizer process")
+    parser.add_argument("-w", "--num_writers", type=int, default=2, help="shard writer processes")
+    args = parser.parse_args()
+    shard_size = args.shard_size
+
+    # create the cache the local directory if it doesn't exist yet
+    DATA_CACHE_DIR = args.output_dir
+    os.makedirs(DATA_CACHE_DIR, exist_ok=True)
+    for filename in glob.glob(os.path.join(DATA_CACHE_DIR, "*.tmp")):
+        os.remove(filename)  # partial shard of a crashed run
+    source = os.path.abspath(args.local) if args.local is not None else f"HuggingFaceFW/fineweb-edu/{remote_name}"
+    manifest = load_manifest(DATA_CACHE_DIR, {"source": source, "shard_size": shard_size, "encoding": enc.name})
+    if manifest["complete"]:
+        print(f"all {len(manifest['shards'])} shards are in {DATA_CACHE_DIR} already")
+        sys.exit(0)
+    if manifest["shards"]:
+        print(f"resuming after shard {len(manifest['shards']) - 1}, at document {manifest['docs']}")
+
+    # read the dataset from the first document that isn't fully in the completed shards
+    doc_index = manifest["docs"]
+    skip = manifest["doc_offset"]  # tokens of that document that are in the last shard already
+    docs = iter(load_documents(args.local, args.stream, start=doc_index))
+
+    # tokenize all documents and write output shards, each of shard_size tokens (last shard has remainder).
+    # A shard is filled in shared memory and written by a writer process while the next one fills
+    buffers = [shared_memory.SharedMemory(create=True, size=shard_size * 2) for _ in range(args.num_writers + 1)]
+    # and the tokenizer processes write every chunk of documents into a slot of shared memory
+    slots = [shared_memory.SharedMemory(create=True, size=slot_size * 2) for _ in range(2 * args.num_procs)]
+    free_buffers = collections.deque(range(len(buffers)))
+    writing = collections.deque() # (buffer, async result, manifest entry, dataset position after the shard)
+    def retire_oldest():
+        # wait for the oldest write, shards enter the manifest in order so it never has gaps
+        buffer, result, entry, position = writing.popleft()
+        result.get()
+        manifest["shards"].append(entry)
+        manifest.update(position)
+        save_manifest(DATA_CACHE_DIR, manifest)
+        free_buffers.append(buffer)
+    def submit_shard(buffer, token_count, position):
         split = "val" if shard_index == 0 else "train"
         filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-        write_datafile(filename, all_tokens_np[:token_count])
+        starts, doc_ids = np.concatenate(shard_starts), np.concatenate(shard_doc_ids)
+        result = writers.apply_async(write_shard, (buffers[buffer].name, token_count, filename, starts, doc_ids))
+        entry = {
+            "filename": os.path.basename(filename) + ".npy",
+            "tokens": token_count,
+            "index": os.path.basename(index_filename(filename)),
+            "first_doc": int(doc_ids[0]),
+            "num_docs": len(doc_ids),
+        }
+        writing.append((buffer, result, entry, position))
+        shard_starts.clear()
+        shard_doc_ids.clear()
+    def add_documents(ends, lengths, a, b):
+        # record where the documents in tokens [a, b) of the chunk start in the current shard
+        docs_in_chunk, offsets = document_pieces(ends, lengths, a, b)
+        shard_starts.append(token_count + offsets)
+        shard_doc_ids.append(doc_index + docs_in_chunk)
+
+    tokens_np = all_tokens_np = None
+    try:
+        with mp.Pool(args.num_procs, initializer=init_tokenizer, initargs=([slot.name for slot in slots], args.num_threads)) as pool, \
+             mp.Pool(args.num_writers) as writers:
+            shard_index = len(manifest["shards"])
+            # current shard buffer
+            buffer = free_buffers.popleft()
+            all_tokens_np = np.ndarray((shard_size,), dtype=np.uint16, buffer=buffers[buffer].buf)
+            token_count = 0
+            shard_starts, shard_doc_ids = [], [] # document index of the current shard
+            progress_bar = None
+            t0 = time.time()
+            num_docs, num_tokens = 0, 0
+            for tokens_np, lengths in tokenize_all(pool, docs, slots):
+                start, skip = skip, 0 # on resume, the first document is partly written already
+                ends = np.cumsum(lengths)
+                num_docs += len(lengths)
+                num_tokens += len(tokens_np) - start
+
+                # do the tokens fill the current shard? (a chunk can fill several)
+                while token_count + len(tokens_np) - start >= shard_size:
+                    # write the current shard and start a new one
+                    remainder = shard_size - token_count
+                    if progress_bar is None:
+                        progress_bar = tqdm(total=shard_size, unit="tokens", desc=f"Shard {shard_index}")
+                    progress_bar.update(remainder)
+                    add_documents(ends, lengths, start, start + remainder)
+                    all_tokens_np[token_count:] = tokens_np[start:start+remainder]
+                    start += remainder
+                    # the shard ends in the first document of the chunk that isn't fully written yet
+                    doc = np.searchsorted(ends, start, side="right")
+                    doc_offset = start - (ends[doc - 1] if doc > 0 else 0)
+                    submit_shard(buffer, shard_size, {"docs": doc_index + int(doc), "doc_offset": int(doc_offset)})
+                    shard_index += 1
+                    progress_bar.set_postfix(docs_per_sec=f"{num_docs / (time.time() - t0):.0f}")
+                    progress_bar.close()
+                    progress_bar = None
+                    if not free_buffers:
+                        retire_oldest()
+                    buffer = free_buffers.popleft()
+                    all_tokens_np = np.ndarray((shard_size,), dtype=np.uint16, buffer=buffers[buffer].buf)
+                    token_count = 0
+
+                # simply append the (rest of the) tokens to the current shard
+                if start < len(tokens_np):
+                    add_documents(ends, lengths, start, len(tokens_np))
+                all_tokens_np[token_count:token_count+len(tokens_np)-start] = tokens_np[start:]
+                token_count += len(tokens_np) - start
+                doc_index += len(lengths)
+                # update progress bar
+                if progress_bar is None:
+                    progress_bar = tqdm(total=shard_size, unit="tokens", desc=f"Shard {shard_index}")
+                progress_bar.update(len(tokens_np) - start)
+
+            # write any remaining tokens as the last shard
+            if token_count != 0:
+                submit_shard(buffer, token_count, {"docs": doc_index, "doc_offset": 0})
+            while writing:
+                retire_oldest()
+            manifest["complete"] = True
+            save_manifest(DATA_CACHE_DIR, manifest)
+            if progress_bar is not None:
+                progress_bar.close()
+            dt = time.time() - t0
+            print(f"tokenized {num_docs} documents, {num_tokens} tokens in {dt:.1f}s | docs/sec: {num_docs / dt:.0f} | tok/sec: {num_tokens / dt:.0f}")
+    finally:
+        tokens_np = all_tokens_np = None # views into the shared memory, which can't be closed while they exist
+        for shm in buffers + slots:
+            shm.close()
+            shm.unlink()
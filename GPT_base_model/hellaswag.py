@@ -23,17 +23,26 @@ gpt2-xl (1558M)
 - this script: 10042 acc: 0.3842 acc_norm: 0.4893 (completion style)
 
 The validation set of HellaSwag has a total of 10,042 examples.
+
+Pushing one example (a 4xN tensor) at a time through the model leaves the GPU mostly
+idle, so by default examples are pre-tokenized, sorted into length buckets and many
+examples' 4 candidates are packed into every forward pass (see evaluate_batched).
+Rows are only right-padded and the padding is masked out, so the scores are the same.
+The tokenized examples are cached on disk as flat arrays (see load_tokenized).
 """
 
 import os
 import json
+import shutil
+import hashlib
 import requests
 import tiktoken
 from tqdm import tqdm
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from transformers import GPT2LMHeadModel
+from model import GPT
 
 # -----------------------------------------------------------------------------
 DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), "hellaswag")
@@ -109,6 +118,140 @@ def render_example(example):
 
     return data, tokens, mask, label
 
+def tokenize_example(example):
+    """
+    Tokenizes the example without building tensors, returns (ctx_tokens, ending_tokens, label).
+    Row i is ctx_tokens + ending_tokens[i], its completion region starts at len(ctx_tokens).
+    """
+    ctx_tokens = enc.encode(example["ctx"])
+    ending_tokens = [enc.encode(" " + end) for end in example["endings"]] # note: prepending " " because GPT-2 tokenizer
+    return ctx_tokens, ending_tokens, example["label"]
+
+class TokenizedExamples:
+    """
+    HellaSwag examples tokenized into flat arrays:
+    - tokens: all tokens, every example's context followed by its 4 endings
+    - offsets: (n, 6) per example, where its context and each of its endings start in tokens,
+      and where the example ends
+    - labels: (n,) the index of the correct ending
+    Row j of example i is context + ending j, and its mask span (the completion region)
+    starts at the context length and covers ending j. The arrays can be memory-mapped.
+    """
+    def __init__(self, tokens, offsets, labels):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def row_lengths(self):
+        # (n, 4) length of every row: context + ending
+        ctx_len = self.offsets[:, 1] - self.offsets[:, 0]
+        return ctx_len[:, None] + np.diff(self.offsets[:, 1:], axis=1)
+
+def tokenize_examples(examples):
+    """Tokenizes an iterable of examples into TokenizedExamples"""
+    tokens, offsets, labels = [], [], []
+    n = 0
+    for example in examples:
+        ctx_tokens, ending_tokens, label = tokenize_example(example)
+        row = [n]
+        for segment in [ctx_tokens] + ending_tokens:
+            tokens.extend(segment)
+            n += len(segment)
+            row.append(n)
+        offsets.append(row)
+        labels.append(label)
+    dtype = np.uint16 if enc.n_vocab < 2**16 else np.uint32
+    return TokenizedExamples(
+        np.array(tokens, dtype=dtype),
+        np.array(offsets, dtype=np.int64).reshape(-1, 6),
+        np.array(labels, dtype=np.int64),
+    )
+
+def collate_examples(examples, indices):
+    """
+    Packs the examples at `indices` into one batch of 4*len(indices) rows: tokens and mask of
+    size (4*n)xN, right-padded to the longest row, and the n labels.
+    """
+    max_len = int(examples.row_lengths()[indices].max())
+    tokens = np.zeros((4 * len(indices), max_len), dtype=np.int64)
+    mask = np.zeros((4 * len(indices), max_len), dtype=np.int64)
+    for i, example in enumerate(indices):
+        offsets = examples.offsets[example]
+        ctx_len = offsets[1] - offsets[0]
+        for j in range(4):
+            end_len = offsets[j + 2] - offsets[j + 1]
+            tokens[4*i + j, :ctx_len] = examples.tokens[offsets[0]:offsets[1]]
+            tokens[4*i + j, ctx_len:ctx_len + end_len] = examples.tokens[offsets[j + 1]:offsets[j + 2]]
+            mask[4*i + j, ctx_len:ctx_len + end_len] = 1
+    labels = np.asarray(examples.labels[indices], dtype=np.int64)
+    return torch.from_numpy(tokens), torch.from_numpy(mask), torch.from_numpy(labels)
+
+def iterate_batches(examples, indices=None, max_batch_tokens=16384):
+    """
+    Length bucketing: sorts the examples (all of them, or the ones at `indices`) by their
+    longest row and cuts the sorted list into batches of at most max_batch_tokens (padded)
+    tokens, so every batch holds examples of similar length and wastes little compute on
+    padding. Yields collated batches.
+    """
+    if indices is None:
+        indices = np.arange(len(examples))
+    row_len = examples.row_lengths()[indices].max(axis=1)
+    order = np.argsort(row_len, kind="stable")
+    batch = []
+    for i in order:
+        # sorted ascending, so the example being added is the longest one in the batch
+        if batch and 4 * (len(batch) + 1) * row_len[i] > max_batch_tokens:
+            yield collate_examples(examples, batch)
+            batch = []
+        batch.append(indices[i])
+    if batch:
+        yield collate_examples(examples, batch)
+
+def score_batch(tokens, mask, logits):
+    """
+    Vectorized completion scoring for a collated batch of 4*n rows.
+    Returns pred (lowest total loss) and pred_norm (lowest average loss) for all n examples.
+    """
+    # evaluate the autoregressive loss at all positions
+    shift_logits = (logits[..., :-1, :]).contiguous()
+    shift_tokens = (tokens[..., 1:]).contiguous()
+    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
+    flat_shift_tokens = shift_tokens.view(-1)
+    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
+    shift_losses = shift_losses.view(tokens.size(0), -1)
+    # now get the average loss just for the completion region (where mask == 1), in each row
+    shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
+    masked_shift_losses = shift_losses * shift_mask
+    # sum and divide by the number of 1s in the mask
+    sum_loss = masked_shift_losses.sum(dim=1)
+    avg_loss = sum_loss / shift_mask.sum(dim=1)
+    # the 4 rows of every example are consecutive, the lowest loss is the most likely
+    pred = sum_loss.view(-1, 4).argmin(dim=1)
+    pred_norm = avg_loss.view(-1, 4).argmin(dim=1)
+    return pred, pred_norm
+
+@torch.no_grad()
+def evaluate_batched(model_fn, examples, device, indices=None, max_batch_tokens=16384):
+    """
+    Scores TokenizedExamples (all of them, or the ones at `indices`) with model_fn
+    (tokens -> logits) in length-bucketed batches. Returns (num_correct, num_correct_norm, num_total).
+    """
+    num_correct = 0
+    num_correct_norm = 0
+    num_total = len(examples) if indices is None else len(indices)
+    for tokens, mask, labels in iterate_batches(examples, indices, max_batch_tokens):
+        tokens = tokens.to(device)
+        mask = mask.to(device)
+        labels = labels.to(device)
+        logits = model_fn(tokens)
+        pred, pred_norm = score_batch(tokens, mask, logits)
+        num_correct += (pred == labels).sum().item()
+        num_correct_norm += (pred_norm == labels).sum().item()
+    return num_correct, num_correct_norm, num_total
+
 def iterate_examples(split):
     # there are 10,042 examples in total in val
     download(split)
@@ -117,14 +260,49 @@ def iterate_examples(split):
             example = json.loads(line)
             yield example
 
+def load_tokenized(split):
+    """
+    Returns the split as memory-mapped TokenizedExamples. They are tokenized once and cached
+    in DATA_CACHE_DIR, keyed by the tokenizer and the hash of the jsonl file, so repeated
+    evals (and every rank) only slice the precomputed arrays.
+    """
+    download(split)
+    data_filename = os.path.join(DATA_CACHE_DIR, f"hellaswag_{split}.jsonl")
+    with open(data_filename, "rb") as f:
+        data_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+    cache_dir = os.path.join(DATA_CACHE_DIR, f"hellaswag_{split}_{enc.name}_{data_hash}")
+    if not os.path.exists(cache_dir):
+        examples = tokenize_examples(iterate_examples(split))
+        # write to a private directory and rename, so concurrent builders can't collide
+        tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in ["tokens", "offsets", "labels"]:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(examples, name))
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir) # someone else finished first
+    return TokenizedExamples(*[
+        np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode="r")
+        for name in ["tokens", "offsets", "labels"]
+    ])
+
 @torch.no_grad()
-def evaluate(model_type, device):
+def evaluate(model_type, device, max_batch_tokens=16384):
 
     torch.set_float32_matmul_precision('high') # use tf32
-    model = GPT2LMHeadModel.from_pretrained(model_type)
+    model = GPT.from_pretrained(model_type) # converted from huggingface once, then cached
     model.to(device)
     # model = torch.compile(model) # optionally torch compile the model
 
+    if max_batch_tokens > 0:
+        examples = load_tokenized("val")
+        num_correct, num_correct_norm, num_total = evaluate_batched(
+            lambda tokens: model(tokens)[0], examples, device, max_batch_tokens=max_batch_tokens
+        )
+        print(f"{num_total} acc: {num_correct/num_total:.4f} acc_norm: {num_correct_norm}/{num_total}={num_correct_norm/num_total:.4f}")
+        return
+
     num_correct_norm = 0
     num_correct = 0
     num_total = 0
@@ -134,7 +312,7 @@ def evaluate(model_type, device):
         mask = mask.to(device)
 
         # get the logits
-        logits = model(tokens).logits
+        logits, _ = model(tokens)
         # evaluate the autoregressive loss at all positions
         shift_logits = (logits[..., :-1, :]).contiguous()
         shift_tokens = (tokens[..., 1:]).contiguous()
@@ -173,5 +351,6 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--model_type", type=str, default="gpt2", help="the model type to use")
     parser.add_argument("-d", "--device", type=str, default="cuda", help="the device to use")
+    parser.add_argument("-b", "--max_batch_tokens", type=int, default=16384, help="padded tokens per forward pass, 0 to evaluate one example at a time")
     args = parser.parse_args()
-    evaluate(args.model_type, args.device)
+    evaluate(args.model_type, args.device, args.max_batch_tokens)
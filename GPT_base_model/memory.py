@@ -0,0 +1,218 @@
+"""
+Picks the micro batch size B of train_gpt2.py: the largest B that fits in memory.
+The total batch size (tokens per step) stays fixed, B only trades off against the
+number of gradient accumulation steps. Memory is first estimated from the GPTConfig
+(parameters, gradients, AdamW state, DDP buckets, activations and logits per sample,
+see estimate_memory), and on CUDA the estimate is then checked and corrected by
+probing a forward + backward pass at candidate B's on the real model:
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py                  # auto
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py --memory_budget 40
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py -B 16           # fixed
+On CPU a probe that runs out of memory takes the whole process down, so there B is
+picked from the estimate against the available RAM alone. The same goes for --fsdp:
+the forward and backward of a sharded model run collectives, and a rank that runs out
+of memory part-way would leave the others blocked in them, so only DDP and
+single-process runs on CUDA are probed.
+"""
+
+import os
+import torch
+import torch.distributed as dist
+
+# -----------------------------------------------------------------------------
+
+# bytes of activations kept for the backward pass, per token and channel, of the
+# attention half (ln_1, qkv, attention output, c_proj input) and the MLP half (ln_2,
+# c_fc, GELU, c_proj input) of a block, in bf16 autocast with flash attention and no
+# dropout. After Korthikanti et al. 2022, "Reducing Activation Recomputation in Large
+# Transformer Models", with the fp32 residual stream going into the layernorms
+ATTN_BYTES = 14
+MLP_BYTES = 22
+# bytes per logit: bf16 logits, their fp32 log-softmax and its gradient
+LOGIT_BYTES = 10
+# the fraction of the budget the estimate / the probed peak may fill, the rest is
+# left for fragmentation, the data loader and whatever the estimate misses
+SAFETY = 0.9
+
+
+def num_params(config):
+    """Parameters of a GPT with config (the lm_head is tied to the token embedding)"""
+    L, d = config.n_layer, config.n_embd
+    # per block: qkv and c_proj, c_fc and c_proj, their biases, two layernorms
+    block = 12 * d * d + 13 * d
+    return L * block + (config.vocab_size + config.block_size) * d + 2 * d
+
+
+def estimate_memory(config, B, T, world_size=1, ddp=False, fsdp=False):
+    """
+    Estimated bytes of a training step at micro batch size B and sequence length T,
+    by category: params, grads and optimizer (fp32 weights, gradients and AdamW's
+    two moments, sharded across the ranks with fsdp), buckets (DDP's copy of the
+    gradients, or FSDP's unsharded block), activations and logits. Also "total".
+    """
+    L, d = config.n_layer, config.n_embd
+    N = num_params(config)
+    shards = world_size if fsdp else 1
+    memory = {
+        "params": 4 * N // shards,
+        "grads": 4 * N // shards,
+        "optimizer": 8 * N // shards,
+        "buckets": 0,
+    }
+    if ddp and not fsdp:
+        memory["buckets"] = 4 * N
+    elif fsdp:
+        # the all-gathered parameters and unsharded gradients of one block
+        memory["buckets"] = 2 * 4 * 12 * d * d
+    # activations: every block keeps what its halves keep, or only the (fp32) input
+    # of the parts that are checkpointed, plus one recomputed block in the backward
+    tokens = B * T
+    per_block = ATTN_BYTES + MLP_BYTES
+    kept = {
+        "none": per_block,
+        "block": 4,
+        "attn": MLP_BYTES + 4,
+        "mlp": ATTN_BYTES + 4,
+    }[config.activation_checkpoint]
+    num_checkpointed = len(range(0, L, config.activation_checkpoint_every))
+    if config.activation_checkpoint == "none":
+        num_checkpointed = 0
+    per_token = num_checkpointed * kept + (L - num_checkpointed) * per_block
+    if num_checkpointed > 0:
+        per_token += per_block  # the block being recomputed
+    # the embeddings and the final layernorm, fp32
+    per_token += 3 * 4
+    memory["activations"] = tokens * d * per_token
+    rows = tokens
+    if config.loss_chunk_size > 0:
+        rows = min(tokens, config.loss_chunk_size)
+    memory["logits"] = rows * config.vocab_size * LOGIT_BYTES
+    memory["total"] = sum(memory.values())
+    return memory
+
+
+def available_memory(device, local_world_size=1):
+    """
+    Bytes this rank can use: on CUDA what is free on the device plus what this
+    process already holds, on CPU its share of the host's available RAM
+    """
+    if device.startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device)
+    available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    if os.path.exists("/proc/meminfo"):
+        # MemAvailable also counts the page cache the kernel can drop
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    return available // local_world_size
+
+
+def candidate_batch_sizes(total_batch_size, T, world_size):
+    """The B's (ascending) that give a whole number of gradient accumulation steps"""
+    assert (
+        total_batch_size % (T * world_size) == 0
+    ), "make sure total_batch_size is divisible by T * ddp_world_size"
+    max_B = total_batch_size // (T * world_size)
+    return [B for B in range(1, max_B + 1) if max_B % B == 0]
+
+
+def probe(model, B, T, device):
+    """
+    Peak allocated CUDA memory in bytes of a forward + backward pass of the model at
+    micro batch size B on random tokens, None if it runs out of memory. The gradients
+    are dropped after, and the global RNG is not touched
+    """
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randint(model.config.vocab_size, (B, T + 1), generator=generator)
+    x = x.to(device)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    peak = None
+    try:
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+            _, loss = model(x[:, :-1], x[:, 1:])
+        loss.backward()
+        peak = torch.cuda.max_memory_allocated(device)
+    except torch.OutOfMemoryError:
+        pass
+    # outside the except block, so the exception no longer pins the activations
+    loss = None
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    return peak
+
+
+def all_min(value, device):
+    """The smallest of the ints every rank passes in (all of them must call it)"""
+    if not dist.is_initialized():
+        return value
+    value = torch.tensor([value], device=device)
+    dist.all_reduce(value, op=dist.ReduceOp.MIN)
+    return int(value.item())
+
+
+def find_micro_batch_size(
+    model,
+    T,
+    total_batch_size,
+    device,
+    world_size=1,
+    local_world_size=1,
+    ddp=False,
+    fsdp=False,
+    budget=None,
+):
+    """
+    Returns the largest micro batch size that fits in budget bytes (default: see
+    available_memory), and the lines of a report of how it was picked. Every rank
+    must call it, they all return the same B.
+    """
+    config = model.config
+
+    def estimate(B):
+        return estimate_memory(config, B, T, world_size, ddp, fsdp)
+
+    if budget is None:
+        budget = available_memory(device, local_world_size)
+        if not device.startswith("cuda"):
+            budget += estimate(1)["params"]  # already allocated, not free anymore
+    candidates = candidate_batch_sizes(total_batch_size, T, world_size)
+    # the largest B the estimate fits (the smallest one if none does), on all ranks
+    fitting = [B for B in candidates if estimate(B)["total"] <= SAFETY * budget]
+    i = all_min(candidates.index(fitting[-1]) if fitting else 0, device)
+    B = candidates[i]
+    memory = estimate(B)
+    lines = [
+        f"memory budget: {budget / 2**30:.2f}GB per rank, using up to {SAFETY:.0%}",
+        f"estimate at B={B}, T={T}: "
+        + ", ".join(f"{key} {value / 2**30:.2f}GB" for key, value in memory.items()),
+    ]
+    if device.startswith("cuda") and not fsdp:
+        # the probe allocates the weights, gradients and activations for real, the
+        # optimizer state and DDP buckets don't exist yet and are still estimated
+        def fits(B):
+            peak = probe(model, B, T, device)
+            rest = estimate(B)
+            rest = rest["optimizer"] + rest["buckets"]
+            ok = peak is not None and peak + rest <= SAFETY * budget
+            peak = "out of memory" if peak is None else f"{peak / 2**30:.2f}GB"
+            lines.append(f"probe B={B}: peak {peak} + {rest / 2**30:.2f}GB to come")
+            return all_min(int(ok), device) == 1
+
+        if fits(B):
+            # the estimate may be pessimistic, go up while it still fits
+            while i + 1 < len(candidates) and fits(candidates[i + 1]):
+                i += 1
+        else:
+            while i > 0:
+                i -= 1
+                if fits(candidates[i]):
+                    break
+        B = candidates[i]
+    grad_accum_steps = total_batch_size // (B * T * world_size)
+    lines.append(
+        f"=> micro batch size {B}, {grad_accum_steps} gradient accumulation steps"
+    )
+    return B, lines
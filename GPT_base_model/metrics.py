@@ -0,0 +1,299 @@
+"""
+Per-step performance metrics of train_gpt2.py.
+The forward, backward and optimizer phases of every step are timed with CUDA events
+(the host clock on CPU), and a step is reported one step late, once its events have
+completed, so the training loop never has to wait for the GPU just to log. Every
+record has the loss, lr, grad norm, step time, time blocked on data, forward,
+backward and optimizer time, communication time (DDP), memory (the peak allocated CUDA
+memory of the step, or the resident set at its end on CPU), tok/sec and the model
+FLOPs utilization (MFU) from the FLOPs per token of the GPTConfig. Records are
+appended to log/metrics.jsonl, or written in Prometheus text format to
+log/metrics.prom, replaced every step, for the node exporter's textfile collector:
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py --metrics jsonl
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py --metrics prometheus
+Offline report of a run, with a row per 500 steps:
+$ python metrics.py log/metrics.jsonl --every 500
+The benchmark scripts time and measure their runs with sync, peak_memory and
+run_isolated from here.
+"""
+
+import os
+import json
+import argparse
+import resource
+import multiprocessing as mp
+import numpy as np
+import torch
+from distributed import comm_breakdown, elapsed
+
+# -----------------------------------------------------------------------------
+
+# dense bf16 tensor core peak FLOPS, by a substring of torch.cuda.get_device_name()
+PEAK_FLOPS = {
+    "H100": 989e12,
+    "H200": 989e12,
+    "A100": 312e12,
+    "A10G": 125e12,
+    "L4": 121e12,
+    "4090": 165e12,
+    "3090": 71e12,
+    "V100": 125e12,  # fp16, there are no bf16 tensor cores
+}
+
+# name, Prometheus metric and help of every number in a record
+METRICS = [
+    ("loss", "gpt_train_loss", "training loss"),
+    ("lr", "gpt_train_lr", "learning rate"),
+    ("norm", "gpt_train_grad_norm", "gradient norm before clipping"),
+    ("dt", "gpt_train_step_seconds", "step time"),
+    ("data_wait", "gpt_train_data_wait_seconds", "time blocked on the next batch"),
+    ("forward", "gpt_train_forward_seconds", "forward time of all micro steps"),
+    ("backward", "gpt_train_backward_seconds", "backward time of all micro steps"),
+    ("optimizer", "gpt_train_optimizer_seconds", "clipping and optimizer step time"),
+    ("comm", "gpt_train_comm_seconds", "time a gradient collective was in flight"),
+    ("comm_exposed", "gpt_train_comm_exposed_seconds", "comm not hidden by backward"),
+    ("tokens_per_sec", "gpt_train_tokens_per_second", "tokens per second, all ranks"),
+    ("peak_memory", "gpt_train_peak_memory_bytes", "peak CUDA memory of the step"),
+    ("rss", "gpt_train_resident_memory_bytes", "resident set at the end of the step"),
+    ("mfu", "gpt_train_mfu", "model FLOPs utilization"),
+]
+
+# the numbers in a record that are durations in seconds
+SECONDS = {
+    "dt",
+    "data_wait",
+    "forward",
+    "backward",
+    "optimizer",
+    "comm",
+    "comm_exposed",
+}
+
+
+def peak_flops(device):
+    """Peak bf16 FLOPS of the device, or None if unknown"""
+    if not device.startswith("cuda"):
+        return None
+    name = torch.cuda.get_device_name(device)
+    for key, flops in PEAK_FLOPS.items():
+        if key in name:
+            return flops
+    return None
+
+
+def flops_per_token(config, T):
+    """Training (forward + backward) FLOPs per token of a GPT with config, at length T"""
+    L, d = config.n_layer, config.n_embd
+    # the weights of every matmul: attention and MLP of every block, and the lm_head
+    N = 12 * L * d * d + config.vocab_size * d
+    # 6 FLOPs per weight per token, plus the attention scores and weighted values
+    # (PaLM paper, appendix B). Recompute of checkpointed activations doesn't count
+    return 6 * N + 12 * L * d * T
+
+
+def peak_memory(device):
+    """Peak memory of this process so far in bytes (on CPU over its whole lifetime)"""
+    if device.startswith("cuda"):
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+
+
+def sync(device):
+    """Waits for the queued work of device, before reading the host clock"""
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def run_isolated(fn, *args, **kwargs):
+    """fn(*args, **kwargs) in a fresh process, so its peak memory is its own"""
+    with mp.get_context("spawn").Pool(1) as pool:
+        return pool.apply(fn, args, kwargs)
+
+
+def resident_memory():
+    """The resident set of this process right now in bytes, None where unknown"""
+    if not os.path.exists("/proc/self/statm"):
+        return None
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class StepMetrics:
+    """
+    Collects the stamps (see distributed.stamp) of every training step and turns them
+    into records one step later. push() hands in a step and returns the record of the
+    previous one, flush() the record of the last. Records are written to path (only
+    given on the master process) as jsonl or prometheus.
+    """
+
+    def __init__(
+        self,
+        device,
+        world_size,
+        flops_per_token,
+        peak_flops=None,
+        path=None,
+        fmt="jsonl",
+    ):
+        self.device = device
+        self.world_size = world_size
+        self.flops_per_token = flops_per_token
+        self.peak_flops = peak_flops
+        self.path = path
+        self.fmt = fmt
+        self.pending = None
+
+    def push(self, step, stamps, values):
+        """
+        stamps: start, micro_steps (a (forward start, forward end, backward end) per
+        micro step), backward_end, end, and comm: (launches, completions) of the
+        gradient collectives or None. values: loss and norm (tensors, still being
+        computed), lr, data_wait and tokens (this rank's tokens in the step)
+        """
+        if self.device.startswith("cuda"):
+            values = dict(values, peak_memory=peak_memory(self.device), rss=None)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            # the CPU peak (ru_maxrss) never resets, a sample per step moves with it
+            values = dict(values, peak_memory=None, rss=resident_memory())
+        previous = self.flush()
+        self.pending = (step, stamps, values)
+        return previous
+
+    def flush(self):
+        if self.pending is None:
+            return None
+        step, stamps, values = self.pending
+        self.pending = None
+        if self.device.startswith("cuda"):
+            # long done by now, the GPU is at most one step behind
+            stamps["end"].synchronize()
+        record = self.record(step, stamps, values)
+        if self.path is not None:
+            self.write(record)
+        return record
+
+    def record(self, step, stamps, values):
+        dt = elapsed(stamps["start"], stamps["end"])
+        micro_steps = stamps["micro_steps"]
+        tokens_per_sec = values["tokens"] * self.world_size / dt
+        record = {
+            "step": step,
+            "loss": values["loss"].item(),
+            "lr": values["lr"],
+            "norm": values["norm"].item(),
+            "dt": dt,
+            "data_wait": values["data_wait"],
+            "forward": sum(elapsed(f0, f1) for f0, f1, _ in micro_steps),
+            "backward": sum(elapsed(f1, b1) for _, f1, b1 in micro_steps),
+            "optimizer": elapsed(stamps["backward_end"], stamps["end"]),
+            "comm": None,
+            "comm_exposed": None,
+            "tokens_per_sec": tokens_per_sec,
+            "peak_memory": values["peak_memory"],
+            "rss": values["rss"],
+            "mfu": None,
+        }
+        if stamps["comm"] is not None:
+            record["comm"], record["comm_exposed"] = comm_breakdown(
+                *stamps["comm"], stamps["start"], stamps["backward_end"]
+            )
+        if self.peak_flops is not None:
+            flops = self.flops_per_token * tokens_per_sec / self.world_size
+            record["mfu"] = flops / self.peak_flops
+        return record
+
+    def write(self, record):
+        if self.fmt == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            return
+        # the textfile collector may read at any time, so replace the file atomically
+        lines = []
+        for key, name, help in [("step", "gpt_train_step", "training step")] + METRICS:
+            if record[key] is None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {record[key]}")
+        with open(self.path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+
+
+def load_records(path):
+    with open(path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    # a resumed run logs the steps after its checkpoint again, the last one counts
+    records = {r["step"]: r for r in records}
+    return [records[step] for step in sorted(records)]
+
+
+def report(records, skip=5, every=0):
+    """Prints the summary of a run's records, leaving out the first `skip` steps"""
+    records = records[skip:] if len(records) > skip else records
+    print(f"steps {records[0]['step']}-{records[-1]['step']} ({len(records)} records)")
+    print(f"{'metric':16s} {'mean':>12s} {'p50':>12s} {'p90':>12s} {'max':>12s}")
+    for key, _, _ in METRICS:
+        values = np.array([r[key] for r in records if r.get(key) is not None])
+        if len(values) == 0:
+            continue
+        scale, unit = 1, ""
+        if key in SECONDS:
+            scale, unit = 1000, "ms"
+        elif key in {"peak_memory", "rss"}:
+            scale, unit = 2**-30, "GB"
+        elif key == "mfu":
+            scale, unit = 100, "%"
+        stats = [values.mean(), np.median(values), np.percentile(values, 90)]
+        stats = [s * scale for s in stats + [values.max()]]
+        print(f"{key + ' ' + unit:16s} " + " ".join(f"{s:12.4f}" for s in stats))
+    # where the step time goes, compute phases exclude the comm they wait on
+    dt = np.mean([r["dt"] for r in records])
+    phases = {
+        "data wait": np.mean([r["data_wait"] for r in records]),
+        "forward": np.mean([r["forward"] for r in records]),
+        "backward": np.mean(
+            [r["backward"] - (r["comm_exposed"] or 0) for r in records]
+        ),
+        "exposed comm": np.mean([r["comm_exposed"] or 0 for r in records]),
+        "optimizer": np.mean([r["optimizer"] for r in records]),
+    }
+    phases["other"] = dt - sum(phases.values())
+    print("step time breakdown:")
+    for name, t in phases.items():
+        print(f"  {name:14s} {t*1000:10.2f}ms {t/dt:7.1%}")
+    if every > 0:
+        print(f"{'steps':>13s} {'loss':>9s} {'dt ms':>9s} {'tok/sec':>12s} {'mfu':>7s}")
+        windows = {}
+        for r in records:
+            windows.setdefault(r["step"] // every, []).append(r)
+        for window in windows.values():
+            mfu = [r["mfu"] for r in window if r["mfu"] is not None]
+            print(
+                f"{window[0]['step']:6d}-{window[-1]['step']:<6d} "
+                f"{np.mean([r['loss'] for r in window]):9.4f} "
+                f"{np.mean([r['dt'] for r in window])*1000:9.2f} "
+                f"{np.mean([r['tokens_per_sec'] for r in window]):12.2f} "
+                + (f"{np.mean(mfu):7.2%}" if mfu else f"{'-':>7s}")
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "path",
+        type=str,
+        nargs="?",
+        default="log/metrics.jsonl",
+        help="metrics written by train_gpt2.py --metrics jsonl",
+    )
+    parser.add_argument(
+        "--skip", type=int, default=5, help="warmup steps left out of the statistics"
+    )
+    parser.add_argument(
+        "--every", type=int, default=0, help="also print a row per this many steps"
+    )
+    args = parser.parse_args()
+    report(load_records(args.path), skip=args.skip, every=args.every)
@@ -0,0 +1,569 @@
+"""
+The GPT-2 model: config, transformer blocks, KV cache and sampling.
+Shared by train_gpt2.py and the tools that load its checkpoints.
+"""
+
+import os
+import inspect
+from dataclasses import dataclass
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+
+try:
+    from torch.nn.attention.flex_attention import (
+        BlockMask,
+        create_block_mask,
+        flex_attention,
+    )
+except ImportError:  # torch < 2.5
+    flex_attention = None
+
+# -----------------------------------------------------------------------------
+
+# where GPT.from_pretrained caches the converted huggingface weights
+PRETRAINED_DIR = os.path.join(os.path.dirname(__file__), "pretrained")
+
+
+class CausalSelfAttention(nn.Module):
+
+    def __init__(self, config):
+        super().__init__()
+        assert config.n_embd % config.n_head == 0
+        # key, query, value projections for all heads, but in a batch
+        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
+        # output projection
+        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
+        self.c_proj.NANOGPT_SCALE_INIT = 1
+        # regularization
+        self.n_head = config.n_head
+        self.n_embd = config.n_embd
+
+    def forward(self, x, kv_cache=None, layer=0, attn_mask=None):
+        B, T, C = (
+            x.size()
+        )  # batch size, sequence length, embedding dimensionality (n_embd)
+        # calculate query, key, values for all heads in batch and move head forward to be the batch dim
+        # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
+        # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the Transformer
+        qkv = self.c_attn(x)
+        q, k, v = qkv.split(self.n_embd, dim=2)
+        k = k.view(B, T, self.n_head, C // self.n_head).transpose(
+            1, 2
+        )  # (B, nh, T, hs)
+        q = q.view(B, T, self.n_head, C // self.n_head).transpose(
+            1, 2
+        )  # (B, nh, T, hs)
+        v = v.view(B, T, self.n_head, C // self.n_head).transpose(
+            1, 2
+        )  # (B, nh, T, hs)
+        if kv_cache is None and attn_mask is None:
+            # flash attention
+            y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        elif kv_cache is None:
+            # packed sequences, see document_mask
+            if flex_attention is not None and isinstance(attn_mask, BlockMask):
+                y = flex_attention(q, k, v, block_mask=attn_mask)
+            else:
+                y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        else:
+            # incremental decoding: store the new keys/values, attend over the cache
+            k, v, mask = kv_cache.update(layer, k, v)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        y = (
+            y.transpose(1, 2).contiguous().view(B, T, C)
+        )  # re-assemble all head outputs side by side
+        # output projection
+        y = self.c_proj(y)
+        return y
+
+
+class MLP(nn.Module):
+
+    def __init__(self, config):
+        super().__init__()
+        self.c_fc = nn.Linear(config.n_embd, 4 * config.n_embd)
+        self.gelu = nn.GELU(approximate="tanh")
+        self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
+        self.c_proj.NANOGPT_SCALE_INIT = 1
+
+    def forward(self, x):
+        x = self.c_fc(x)
+        x = self.gelu(x)
+        x = self.c_proj(x)
+        return x
+
+
+class Block(nn.Module):
+
+    def __init__(self, config):
+        super().__init__()
+        self.ln_1 = nn.LayerNorm(config.n_embd)
+        self.attn = CausalSelfAttention(config)
+        self.ln_2 = nn.LayerNorm(config.n_embd)
+        self.mlp = MLP(config)
+
+    def forward(
+        self, x, kv_cache=None, layer=0, attn_mask=None, activation_checkpoint="none"
+    ):
+        # activation_checkpoint: the part of the block ("block", "attn" or "mlp") that
+        # only keeps its input for the backward pass and recomputes everything else
+        if activation_checkpoint == "block":
+            return checkpoint(
+                self.forward, x, kv_cache, layer, attn_mask, use_reentrant=False
+            )
+        if activation_checkpoint == "attn":
+            x = x + checkpoint(
+                self.attn_branch, x, kv_cache, layer, attn_mask, use_reentrant=False
+            )
+        else:
+            x = x + self.attn_branch(x, kv_cache, layer, attn_mask)
+        if activation_checkpoint == "mlp":
+            x = x + checkpoint(self.mlp_branch, x, use_reentrant=False)
+        else:
+            x = x + self.mlp_branch(x)
+        return x
+
+    def attn_branch(self, x, kv_cache=None, layer=0, attn_mask=None):
+        return self.attn(
+            self.ln_1(x), kv_cache=kv_cache, layer=layer, attn_mask=attn_mask
+        )
+
+    def mlp_branch(self, x):
+        return self.mlp(self.ln_2(x))
+
+
+@dataclass
+class GPTConfig:
+    block_size: int = 1024  # max sequence length
+    vocab_size: int = (
+        50257  # number of tokens: 50,000 BPE merges + 256 bytes tokens + 1 <|endoftext|> token
+    )
+    n_layer: int = 12  # number of layers
+    n_head: int = 12  # number of heads
+    n_embd: int = 768  # embedding dimension
+    # > 0: with targets, compute lm_head + loss this many tokens at a time and return
+    # no logits, the full (B, T, vocab_size) logits are never held (see chunked_cross_entropy)
+    loss_chunk_size: int = 0
+    # activation checkpointing in training, trades recompute for activation memory:
+    # "none", "block" (whole blocks), "attn" or "mlp" (only that half of a block),
+    # applied to every activation_checkpoint_every-th block
+    activation_checkpoint: str = "none"
+    activation_checkpoint_every: int = 1
+
+
+class KVCache:
+    """
+    Preallocated per-layer key/value cache for incremental decoding.
+    Every row of the batch stores the key/value of its token at position p in slot p,
+    so prompts of different lengths share one batch without left padding, and a row
+    can start over with a new sequence without clearing anything: a query at position
+    p only ever attends to slots <= p, which it has written itself.
+    Positions >= max_len (padding) go to one extra slot that no real token attends to.
+    Set `rows` to a (B,) tensor of cache rows to run a batch over a subset of the
+    cache (continuous batching), None means row i of the batch is row i of the cache.
+    """
+
+    def __init__(self, config, batch_size, max_len=None):
+        self.n_layer = config.n_layer
+        self.shape = (
+            batch_size,
+            config.n_head,
+            (max_len or config.block_size) + 1,
+            config.n_embd // config.n_head,
+        )
+        self.max_len = self.shape[2] - 1
+        self.k = None  # allocated on first use, in the dtype attention runs in
+        self.v = None
+        self.rows = None
+
+    def prepare(self, pos):
+        # called once per forward with the (B, T) positions of the new tokens
+        B, T = pos.size()
+        self.pos = pos.clamp(max=self.max_len)
+        rows = self.rows
+        if rows is None:
+            rows = torch.arange(B, device=pos.device)
+        self.batch_idx = rows.view(B, 1).expand(B, T)
+        # only attend to the slots anything in this batch can see
+        self.length = int(self.pos.max()) + 1
+        slots = torch.arange(self.length, device=pos.device)
+        self.mask = slots.view(1, 1, 1, -1) <= self.pos.view(B, 1, T, 1)
+
+    def update(self, layer, k, v):
+        # k, v are (B, nh, T, hs) for the new tokens
+        if self.k is None:
+            self.k = torch.zeros(
+                (self.n_layer, *self.shape), dtype=k.dtype, device=k.device
+            )
+            self.v = torch.zeros_like(self.k)
+        self.k[layer][self.batch_idx, :, self.pos] = k.transpose(1, 2)
+        self.v[layer][self.batch_idx, :, self.pos] = v.transpose(1, 2)
+        if self.rows is None:
+            k = self.k[layer][:, :, : self.length]
+            v = self.v[layer][:, :, : self.length]
+        else:
+            k = self.k[layer][self.rows, :, : self.length]
+            v = self.v[layer][self.rows, :, : self.length]
+        return k, v, self.mask
+
+
+def document_ids(idx, eot):
+    """
+    (B, T) id of the document every token of idx belongs to, for packed sequences.
+    Every document starts with the <|endoftext|> token, the tokens before the first
+    one in a row (the tail of the previous document) get id 0.
+    """
+    return torch.cumsum(idx == eot, dim=1)
+
+
+def document_positions(doc_ids):
+    # (B, T) position of every token within its document
+    T = doc_ids.size(1)
+    t = torch.arange(T, device=doc_ids.device).expand_as(doc_ids)
+    starts = torch.ones_like(doc_ids, dtype=torch.bool)
+    starts[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+    return t - torch.cummax(torch.where(starts, t, 0), dim=1).values
+
+
+def document_mask(doc_ids):
+    """
+    Block-diagonal causal attention mask of packed sequences: every token attends to
+    the tokens before it in its own document only. Compiled on CUDA this is a
+    flex_attention BlockMask, which skips the blocks that are masked out entirely
+    (the varlen path), otherwise a dense (B, 1, T, T) mask for SDPA.
+    """
+    B, T = doc_ids.size()
+    if flex_attention is not None and doc_ids.is_cuda and torch.compiler.is_compiling():
+
+        def mask_mod(b, h, q_idx, kv_idx):
+            same_doc = doc_ids[b, q_idx] == doc_ids[b, kv_idx]
+            return same_doc & (q_idx >= kv_idx)
+
+        return create_block_mask(mask_mod, B, None, T, T, device=doc_ids.device)
+    causal = torch.ones(T, T, dtype=torch.bool, device=doc_ids.device).tril()
+    same_doc = doc_ids.view(B, T, 1) == doc_ids.view(B, 1, T)
+    return (same_doc & causal).view(B, 1, T, T)
+
+
+def chunk_loss(x, weight, targets):
+    logits = F.linear(x, weight)
+    return F.cross_entropy(logits, targets, reduction="sum")
+
+
+def chunked_cross_entropy(x, weight, targets, chunk_size):
+    """
+    Mean cross-entropy of the logits x @ weight.T against targets, chunk_size rows at
+    a time. Every chunk is checkpointed, its logits are dropped after the forward and
+    recomputed in the backward, so at most one (chunk_size, vocab_size) block of
+    logits (and its gradient) exists at any time.
+    """
+    x = x.view(-1, x.size(-1))
+    targets = targets.view(-1)
+    loss = 0.0
+    for i in range(0, x.size(0), chunk_size):
+        loss = loss + checkpoint(
+            chunk_loss,
+            x[i : i + chunk_size],
+            weight,
+            targets[i : i + chunk_size],
+            use_reentrant=False,
+        )
+    return loss / x.size(0)
+
+
+def sample_logits(logits, temperature=1.0, top_k=None, top_p=None, generator=None):
+    """Samples one token per row from (B, vocab_size) logits, returns (B, 1)"""
+    if temperature == 0.0:
+        return logits.argmax(dim=-1, keepdim=True)
+    probs = F.softmax(logits.float() / temperature, dim=-1)
+    # do top-k sampling (huggingface pipeline default is 50)
+    # topk_probs here becomes (B, k), topk_indices is (B, k), sorted descending
+    k = top_k if top_k is not None else probs.size(-1)
+    topk_probs, topk_indices = torch.topk(probs, k, dim=-1)
+    if top_p is not None:
+        # nucleus: drop the tail once the tokens before it already cover top_p of
+        # the renormalized top-k distribution (as huggingface does)
+        topk_probs = topk_probs / topk_probs.sum(dim=-1, keepdim=True)
+        cum_probs = torch.cumsum(topk_probs, dim=-1)
+        topk_probs = topk_probs.masked_fill(cum_probs - topk_probs > top_p, 0.0)
+    # select a token from the top-k probabilities
+    # note: multinomial does not demand the input to sum to 1
+    ix = torch.multinomial(topk_probs, 1, generator=generator)  # (B, 1)
+    # gather the corresponding indices
+    return torch.gather(topk_indices, -1, ix)  # (B, 1)
+
+
+def sampling_probs(logits, temperature=1.0, top_k=None, top_p=None):
+    """
+    (B, vocab_size) distribution that sample_logits draws from for these logits and
+    settings, normalized: one-hot at temperature 0, zero outside the top-k / top-p
+    """
+    if temperature == 0.0:
+        return F.one_hot(logits.argmax(dim=-1), logits.size(-1)).float()
+    probs = F.softmax(logits.float() / temperature, dim=-1)
+    if top_k is None and top_p is None:
+        return probs
+    k = top_k if top_k is not None else probs.size(-1)
+    topk_probs, topk_indices = torch.topk(probs, k, dim=-1)
+    if top_p is not None:
+        topk_probs = topk_probs / topk_probs.sum(dim=-1, keepdim=True)
+        cum_probs = torch.cumsum(topk_probs, dim=-1)
+        topk_probs = topk_probs.masked_fill(cum_probs - topk_probs > top_p, 0.0)
+    probs = torch.zeros_like(probs).scatter_(-1, topk_indices, topk_probs)
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+
+class GPT(nn.Module):
+
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+        assert config.activation_checkpoint in {"none", "block", "attn", "mlp"}
+
+        self.transformer = nn.ModuleDict(
+            dict(
+                wte=nn.Embedding(config.vocab_size, config.n_embd),
+                wpe=nn.Embedding(config.block_size, config.n_embd),
+                h=nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+                ln_f=nn.LayerNorm(config.n_embd),
+            )
+        )
+        self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+
+        # weight sharing scheme
+        self.transformer.wte.weight = self.lm_head.weight
+
+        # init params
+        self.apply(self._init_weights)
+
+    def _init_weights(self, module):
+        if isinstance(module, nn.Linear):
+            std = 0.02
+            if hasattr(module, "NANOGPT_SCALE_INIT"):
+                std *= (2 * self.config.n_layer) ** -0.5
+            torch.nn.init.normal_(module.weight, mean=0.0, std=std)
+            if module.bias is not None:
+                torch.nn.init.zeros_(module.bias)
+        elif isinstance(module, nn.Embedding):
+            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
+
+    def forward(self, idx, targets=None, pos=None, kv_cache=None, doc_ids=None):
+        # idx is of shape (B, T)
+        # with a kv_cache, pos (B, T) holds the position of every token in idx
+        # doc_ids (B, T) packs several documents into every row (see document_ids):
+        # positions restart at every document and attention stays within it
+        B, T = idx.size()
+        assert (
+            T <= self.config.block_size
+        ), f"Cannot forward sequence of length {T}, block size is only {self.config.block_size}"
+        attn_mask = None
+        if doc_ids is not None:
+            attn_mask = document_mask(doc_ids)
+            if pos is None:
+                pos = document_positions(doc_ids)
+        # forward the token and posisition embeddings
+        if pos is None:
+            pos = torch.arange(0, T, dtype=torch.long, device=idx.device)  # shape (T)
+        if kv_cache is not None:
+            kv_cache.prepare(pos)
+            pos = pos.clamp(max=self.config.block_size - 1)  # padding may run past
+        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (T, n_embd)
+        tok_emb = self.transformer.wte(idx)  # token embeddings of shape (B, T, n_embd)
+        x = tok_emb + pos_emb
+        # forward the blocks of the transformer
+        for i, block in enumerate(self.transformer.h):
+            activation_checkpoint = "none"
+            if torch.is_grad_enabled() and kv_cache is None:
+                if i % self.config.activation_checkpoint_every == 0:
+                    activation_checkpoint = self.config.activation_checkpoint
+            x = block(
+                x,
+                kv_cache=kv_cache,
+                layer=i,
+                attn_mask=attn_mask,
+                activation_checkpoint=activation_checkpoint,
+            )
+        # forward the final layernorm and the classifier
+        x = self.transformer.ln_f(x)
+        if targets is not None and self.config.loss_chunk_size > 0:
+            loss = chunked_cross_entropy(
+                x, self.lm_head.weight, targets, self.config.loss_chunk_size
+            )
+            return None, loss
+        logits = self.lm_head(x)  # (B, T, vocab_size)
+        loss = None
+        if targets is not None:
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+        return logits, loss
+
+    @torch.no_grad()
+    def generate(
+        self,
+        prompts,
+        max_new_tokens,
+        temperature=1.0,
+        top_k=None,
+        top_p=None,
+        generator=None,
+    ):
+        """
+        Samples max_new_tokens after every prompt (a list of token lists, they may
+        differ in length) and returns the token lists of prompt + completion.
+        The prompts are run through the model once, after that every step only
+        feeds the newest token of each row and attends over the KV cache.
+        Generation stops early if a row would run past block_size.
+        """
+        device = self.lm_head.weight.device
+        B = len(prompts)
+        if any(len(p) == 0 for p in prompts):
+            # there are no logits to sample the first token from, start with <|endoftext|>
+            raise ValueError("every prompt needs at least one token")
+        lengths = torch.tensor([len(p) for p in prompts], device=device)
+        T = int(lengths.max())
+        assert T <= self.config.block_size, "prompt is longer than the block size"
+        max_new_tokens = min(max_new_tokens, self.config.block_size - T)
+        kv_cache = KVCache(self.config, B, max_len=T + max_new_tokens)
+        # right-pad the prompts into one batch, each row continues after its own end
+        idx = torch.zeros((B, T), dtype=torch.long, device=device)
+        for i, prompt in enumerate(prompts):
+            idx[i, : len(prompt)] = torch.tensor(prompt, dtype=torch.long)
+        pos = torch.arange(T, device=device).expand(B, T)
+        logits, _ = self(idx, pos=pos, kv_cache=kv_cache)
+        logits = logits[torch.arange(B, device=device), lengths - 1]  # (B, vocab_size)
+        out = [list(prompt) for prompt in prompts]
+        for step in range(max_new_tokens):
+            xcol = sample_logits(logits, temperature, top_k, top_p, generator)  # (B, 1)
+            for row, token in zip(out, xcol.view(-1).tolist()):
+                row.append(token)
+            if step == max_new_tokens - 1:
+                break
+            logits, _ = self(xcol, pos=lengths.view(B, 1), kv_cache=kv_cache)
+            logits = logits[:, -1, :]
+            lengths = lengths + 1
+        return out
+
+    @classmethod
+    def from_pretrained(cls, model_type, cache_dir=PRETRAINED_DIR):
+        """
+        Loads pretrained GPT-2 model weights. The first call converts the huggingface
+        weights into cache_dir/<model_type>.pt (see convert_pretrained), every call
+        after that memory-maps them straight into the GPT, without transformers
+        """
+        assert model_type in {"gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl"}
+        path = os.path.join(cache_dir, f"{model_type}.pt")
+        if not os.path.exists(path):
+            cls.convert_pretrained(model_type, path)
+        print("loading weights from pretrained gpt: %s" % path)
+        # the checkpoint holds the GPTConfig, not just tensors. mmap=True maps the
+        # tensor storages, pages are read from disk as the weights are first used
+        checkpoint = torch.load(path, map_location="cpu", weights_only=False, mmap=True)
+        # build the modules without allocating or initializing any weights, and
+        # adopt the mapped tensors as they are, so there is never a second copy
+        with torch.device("meta"):
+            model = cls(checkpoint["config"])
+        model.load_state_dict(checkpoint["model"], assign=True)
+        # assign gave the tied embedding and lm_head a parameter each, tie them again
+        model.transformer.wte.weight = model.lm_head.weight
+        return model
+
+    @staticmethod
+    def convert_pretrained(model_type, path):
+        """
+        Converts the huggingface GPT-2 weights of model_type into a checkpoint at path,
+        like the ones train_gpt2.py writes, so serve.py etc. can load it as well
+        """
+        from transformers import GPT2LMHeadModel
+
+        print("converting weights from pretrained gpt: %s" % model_type)
+
+        # n_layer, n_head and n_embd are determined from model_type
+        config_args = {
+            "gpt2": dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
+            "gpt2-medium": dict(n_layer=24, n_head=16, n_embd=1024),  # 350M params
+            "gpt2-large": dict(n_layer=36, n_head=20, n_embd=1280),  # 774M params
+            "gpt2-xl": dict(n_layer=48, n_head=25, n_embd=1600),  # 1558M params
+        }[model_type]
+        config_args["vocab_size"] = 50257  # always 50257 for GPT model checkpoints
+        config_args["block_size"] = 1024  # always 1024 for GPT model checkpoints
+        config = GPTConfig(**config_args)
+        # the names and shapes of our parameters, without allocating them
+        with torch.device("meta"):
+            sd = GPT(config).state_dict()
+        sd_keys = sd.keys()
+        sd_keys = [
+            k for k in sd_keys if not k.endswith(".attn.bias")
+        ]  # discard this mask / buffer, not a param
+
+        # init a huggingface/transformers model
+        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
+        sd_hf = model_hf.state_dict()
+
+        # copy while ensuring all of the parameters are aligned and match in names and shapes
+        sd_keys_hf = sd_hf.keys()
+        sd_keys_hf = [
+            k for k in sd_keys_hf if not k.endswith(".attn.masked_bias")
+        ]  # ignore these, just a buffer
+        sd_keys_hf = [
+            k for k in sd_keys_hf if not k.endswith(".attn.bias")
+        ]  # same, just the mask (buffer)
+        transposed = [
+            "attn.c_attn.weight",
+            "attn.c_proj.weight",
+            "mlp.c_fc.weight",
+            "mlp.c_proj.weight",
+        ]
+        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
+        # this means that we have to transpose these weights, once, before we save them
+        assert len(sd_keys_hf) == len(
+            sd_keys
+        ), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
+        for k in sd_keys_hf:
+            if any(k.endswith(w) for w in transposed):
+                # special treatment for the Conv1D weights we need to transpose
+                assert sd_hf[k].shape[::-1] == sd[k].shape
+                sd[k] = sd_hf[k].t().contiguous()
+            else:
+                # vanilla copy over the other parameters
+                assert sd_hf[k].shape == sd[k].shape
+                sd[k] = sd_hf[k]
+
+        # the tied lm_head and wte are one tensor, torch.save writes it once
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        torch.save({"model": sd, "config": config}, tmp_path)
+        os.replace(tmp_path, path)  # a crash never leaves a half written file behind
+
+    def configure_optimizers(
+        self, weight_decay, learning_rate, device_type, verbose=True
+    ):
+        # start with all of the candidate parameters (that require grad)
+        param_dict = {pn: p for pn, p in self.named_parameters()}
+        param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
+        # create optim groups. Any parameters that is 2D will be weight decayed, otherwise no.
+        # i.e. all weight tensors in matmuls + embeddings decay, all biases and layernorms don't.
+        decay_params = [p for n, p in param_dict.items() if p.dim() >= 2]
+        nodecay_params = [p for n, p in param_dict.items() if p.dim() < 2]
+        optim_groups = [
+            {"params": decay_params, "weight_decay": weight_decay},
+            {"params": nodecay_params, "weight_decay": 0.0},
+        ]
+        num_decay_params = sum(p.numel() for p in decay_params)
+        num_nodecay_params = sum(p.numel() for p in nodecay_params)
+        if verbose:
+            print(
+                f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters"
+            )
+            print(
+                f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters"
+            )
+        # Create AdamW optimizer and use the fused version if it is available
+        fused_available = "fused" in inspect.signature(torch.optim.AdamW).parameters
+        use_fused = fused_available and device_type == "cuda"
+        if verbose:
+            print(f"using fused AdamW: {use_fused}")
+        optimizer = torch.optim.AdamW(
+            optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused
+        )
+        return optimizer
@@ -0,0 +1,159 @@
+"""
+torch.profiler capture windows for train_gpt2.py.
+Profiles a window of training steps on the chosen ranks, with tensor shapes, memory
+allocations and Python stacks, and writes for every rank a Chrome trace (open it in
+chrome://tracing or https://ui.perfetto.dev) and a summary with the top ops and the
+time spent in the forward/backward/optimizer phases and in every CausalSelfAttention
+and MLP. The window start:end is steps start..end-1, e.g. steps 50 to 54 on ranks 0
+and 3:
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py --profile 50:55 --profile_ranks 0 3
+$ GPT_PROFILE=50:55 GPT_PROFILE_RANKS=0,3 torchrun --standalone --nproc_per_node=8 train_gpt2.py
+The files go to log/profile_rank00000_steps00050-00055.{json,txt}.
+"""
+
+import os
+import torch
+from torch.profiler import ProfilerActivity, record_function
+
+# -----------------------------------------------------------------------------
+
+
+def parse_window(window):
+    """'50:55' -> (50, 55), None -> None"""
+    if not window:
+        return None
+    start, end = (int(s) for s in window.split(":"))
+    assert 0 <= start < end, f"bad profile window {window}, expected start:end"
+    return start, end
+
+
+class ModuleRanges:
+    """
+    Wraps the forward of every module of the given types in a profiler range named
+    after its class, so their ops add up to one row of the summary. Only for eager
+    models, torch.compile would trace (and recompile for) the hooks.
+    """
+
+    def __init__(self, model, types):
+        self.handles = []
+        for module in model.modules():
+            if isinstance(module, types):
+                name = type(module).__name__
+                self.handles.append(module.register_forward_pre_hook(self.enter(name)))
+                self.handles.append(module.register_forward_hook(self.exit))
+        self.ranges = []
+
+    def enter(self, name):
+        def hook(module, args):
+            self.ranges.append(record_function(name))
+            self.ranges[-1].__enter__()
+
+        return hook
+
+    def exit(self, module, args, output):
+        self.ranges.pop().__exit__(None, None, None)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+class ProfileWindow:
+    """
+    Call begin(step) at the top of every step of the training loop and end(step) at
+    its bottom. The profiler starts one step before the window (as a warmup step that
+    is not recorded) and stops after its last step.
+    """
+
+    def __init__(
+        self,
+        window,
+        rank,
+        ranks,
+        log_dir,
+        device_type,
+        model=None,
+        module_types=(),
+        first_step=0,
+        top=20,
+    ):
+        self.window = parse_window(window)
+        self.enabled = self.window is not None and rank in ranks
+        if self.enabled:
+            # a resumed run may start inside the window, it profiles what is left
+            self.start = max(self.window[0], first_step)
+            self.stop = self.window[1]
+            self.enabled = self.start < self.stop
+        self.rank = rank
+        self.log_dir = log_dir
+        self.device_type = device_type
+        self.model = model
+        self.module_types = module_types
+        self.first_step = first_step
+        self.top = top
+        self.prof = None
+        self.module_ranges = None
+
+    def begin(self, step):
+        if not self.enabled or self.prof is not None:
+            return
+        warmup = 1 if self.start > self.first_step else 0
+        if step != self.start - warmup:
+            return
+        activities = [ProfilerActivity.CPU]
+        if self.device_type == "cuda":
+            activities.append(ProfilerActivity.CUDA)
+        self.prof = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=0, warmup=warmup, active=self.stop - self.start, repeat=1
+            ),
+            on_trace_ready=self.trace_ready,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=True,
+        )
+        if self.model is not None and self.module_types:
+            self.module_ranges = ModuleRanges(self.model, self.module_types)
+        self.prof.start()
+
+    def end(self, step):
+        if self.prof is None:
+            return
+        self.prof.step()
+        if step == self.stop - 1:
+            self.prof.stop()
+            self.prof = None
+            if self.module_ranges is not None:
+                self.module_ranges.remove()
+                self.module_ranges = None
+            self.enabled = False
+
+    def trace_ready(self, prof):
+        name = f"profile_rank{self.rank:05d}_steps{self.start:05d}-{self.stop:05d}"
+        path = os.path.join(self.log_dir, name)
+        prof.export_chrome_trace(path + ".json")
+        summary = self.summary(prof)
+        with open(path + ".txt", "w") as f:
+            f.write(summary)
+        print(f"rank {self.rank} profile of steps {self.start}-{self.stop - 1}:")
+        print(summary)
+        print(f"rank {self.rank} wrote {path}.json and {path}.txt")
+
+    def summary(self, prof):
+        events = prof.key_averages()
+        device = self.device_type == "cuda"
+        sort_by = "self_device_time_total" if device else "self_cpu_time_total"
+        table = events.table(sort_by=sort_by, row_limit=self.top)
+        # the ranges of the training loop and of the modules, across all steps
+        regions = ["forward", "backward", "optimizer"]
+        regions += [t.__name__ for t in self.module_types]
+        lines = [f"{'region':24s} {'calls':>8s} {'CPU ms':>12s} {'device ms':>12s}"]
+        for event in events:
+            if event.key in regions:
+                lines.append(
+                    f"{event.key:24s} {event.count:8d} "
+                    f"{event.cpu_time_total / 1000:12.2f} "
+                    f"{event.device_time_total / 1000:12.2f}"
+                )
+        return table + "\n" + "\n".join(lines) + "\n"
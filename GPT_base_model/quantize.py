@@ -0,0 +1,373 @@
+"""
+Weight-only post-training quantization of the GPT checkpoints of train_gpt2.py, for
+inference on CPU. The c_attn, c_fc and c_proj weights of every block become int8
+with a scale per output channel, or int4 with a scale and zero point per group of
+--group_size input channels, and the tied lm_head / token embedding becomes int8
+(its rows are gathered as embeddings, and it is the layer int4 hurts most).
+Activations stay in floating point: the matmuls run in bf16 (the fast path of the
+CPU int8/int4 kernels of PyTorch) and dequantize the weights on the fly, so decoding
+reads them from memory at a quarter (an eighth) of their fp32 size. Prompts of more
+than KERNEL_ROWS tokens are compute bound instead, there the int8 weights are
+dequantized once per matmul for a bf16 GEMM. Convert a checkpoint:
+$ python quantize.py --checkpoint log/model_19072.pt --bits 8   # -> log/model_19072_int8.pt
+$ python quantize.py --checkpoint log/model_19072.pt --bits 4 --group_size 32
+serve.py loads the quantized checkpoints like any other (int4 ones on CPU only):
+$ python serve.py --checkpoint log/model_19072_int8.pt --device cpu
+Check the accuracy (val loss and HellaSwag) and the latency and memory against fp32:
+$ python quantize.py --checkpoint log/model_19072.pt --bits 8 --eval --bench
+"""
+
+import os
+import time
+import argparse
+import dataclasses
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from model import GPT, KVCache
+from checkpoint import load_checkpoint
+from metrics import peak_memory, run_isolated
+
+# -----------------------------------------------------------------------------
+
+# up to this many rows an Int8Linear runs the int8 kernel, more are faster dequantized
+KERNEL_ROWS = 32
+
+
+def quantize_int8(w):
+    """(N, K) float weight -> (N, K) int8, (N,) scales, symmetric per output channel"""
+    scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127
+    q = torch.round(w / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scales.float()
+
+
+def quantize_int4(w, group_size):
+    """
+    (N, K) float weight -> (N, K) int32 in 0..15 and (K / group_size, N, 2) scales and
+    zeros, asymmetric per group of group_size input channels: w ~= (q - 8) * scale + zero
+    """
+    N, K = w.size()
+    assert K % group_size == 0, f"{K} input channels don't split into {group_size}"
+    groups = w.float().view(N, K // group_size, group_size)
+    lo = groups.amin(dim=2)
+    hi = groups.amax(dim=2)
+    scales = ((hi - lo) / 15).clamp(min=1e-8)
+    zeros = lo + 8 * scales
+    q = torch.round((groups - lo[..., None]) / scales[..., None]).clamp(0, 15)
+    q = q.view(N, K).to(torch.int32)
+    scales_and_zeros = torch.stack([scales.t(), zeros.t()], dim=2).contiguous()
+    return q, scales_and_zeros
+
+
+class Int8Linear(nn.Module):
+    """nn.Linear with an int8 weight and a float scale per output channel"""
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer(
+            "weight", torch.zeros((out_features, in_features), dtype=torch.int8)
+        )
+        self.register_buffer("scales", torch.ones(out_features))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear):
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None)
+        if linear.weight.is_meta:
+            return module  # only the layout, the weights come from a checkpoint
+        module.weight, module.scales = quantize_int8(linear.weight.detach())
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().float()
+        return module
+
+    def forward(self, x):
+        shape = x.shape[:-1]
+        x2 = x.reshape(-1, self.in_features).to(torch.bfloat16).contiguous()
+        if x2.device.type == "cpu" and x2.size(0) <= KERNEL_ROWS:
+            # x @ weight.T * scales, without materializing the float weight
+            y = torch.ops.aten._weight_int8pack_mm(
+                x2, self.weight, self.scales.to(torch.bfloat16)
+            )
+        else:
+            # many rows (a prefill) are compute bound: dequantize once, one bf16 GEMM
+            weight = (
+                self.weight.to(torch.bfloat16) * self.scales.to(torch.bfloat16)[:, None]
+            )
+            y = F.linear(x2, weight)
+        if self.bias is not None:
+            y = y + self.bias.to(torch.bfloat16)
+        return y.view(*shape, self.out_features).to(x.dtype)
+
+
+class Int4Linear(nn.Module):
+    """
+    nn.Linear with an int4 weight, packed two per byte in the layout of the CPU int4
+    kernel, and a scale and zero point per group of group_size input channels.
+    CPU only.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, group_size=32):
+        super().__init__()
+        assert in_features % group_size == 0
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer(
+            "weight", torch.zeros((out_features, in_features // 2), dtype=torch.uint8)
+        )
+        self.register_buffer(
+            "scales_and_zeros",
+            torch.zeros((in_features // group_size, out_features, 2)),
+        )
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear, group_size=32):
+        module = cls(
+            linear.in_features, linear.out_features, linear.bias is not None, group_size
+        )
+        if linear.weight.is_meta:
+            # only the layout, the packed weights come from a checkpoint. The packing
+            # op has no meta kernel to run on
+            return module
+        q, module.scales_and_zeros = quantize_int4(linear.weight.detach(), group_size)
+        module.weight = torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, 2)
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().float()
+        return module
+
+    def forward(self, x):
+        shape = x.shape[:-1]
+        x2 = x.reshape(-1, self.in_features).to(torch.bfloat16).contiguous()
+        y = torch.ops.aten._weight_int4pack_mm_for_cpu(
+            x2, self.weight, self.group_size, self.scales_and_zeros.to(torch.bfloat16)
+        )
+        if self.bias is not None:
+            y = y + self.bias.to(torch.bfloat16)
+        return y.view(*shape, self.out_features).to(x.dtype)
+
+
+class Int8Embedding(nn.Module):
+    """The token embedding tied to an Int8Linear lm_head: its rows times their scales"""
+
+    def __init__(self, lm_head):
+        super().__init__()
+        self.lm_head = lm_head  # shared, so .to() and load_state_dict keep the tie
+
+    def forward(self, idx):
+        weight, scales = self.lm_head.weight, self.lm_head.scales
+        return weight[idx].to(scales.dtype) * scales[idx].unsqueeze(-1)
+
+
+def quantize_model(model, bits=8, group_size=32):
+    """
+    Replaces the linear layers of a GPT (in place) with Int8Linear, or Int4Linear
+    for bits=4, and the tied lm_head and token embedding with int8 ones. Returns it.
+    """
+    assert bits in {4, 8}, "bits must be 8 or 4"
+    for block in model.transformer.h:
+        for parent, name in [
+            (block.attn, "c_attn"),
+            (block.attn, "c_proj"),
+            (block.mlp, "c_fc"),
+            (block.mlp, "c_proj"),
+        ]:
+            linear = getattr(parent, name)
+            if bits == 8:
+                setattr(parent, name, Int8Linear.from_linear(linear))
+            else:
+                setattr(parent, name, Int4Linear.from_linear(linear, group_size))
+    model.lm_head = Int8Linear.from_linear(model.lm_head)
+    model.transformer.wte = Int8Embedding(model.lm_head)
+    # the chunked loss multiplies by the float lm_head weight itself
+    model.config = dataclasses.replace(model.config, loss_chunk_size=0)
+    return model
+
+
+def model_bytes(model):
+    """Bytes of the parameters and buffers, tied tensors counted once"""
+    tensors = {t.data_ptr(): t for t in [*model.parameters(), *model.buffers()]}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+def load_model(path, device="cpu"):
+    """Builds the GPT of a checkpoint, quantized or not"""
+    checkpoint = load_checkpoint(path)
+    if "quantization" in checkpoint:
+        # the int4 weights are packed for the CPU kernel, there is no other device path
+        if checkpoint["quantization"]["bits"] == 4 and device != "cpu":
+            raise ValueError(f"{path} is int4, which runs on CPU only, load it on cpu")
+        # no float weights to quantize: build the layers empty, take the checkpoint's
+        with torch.device("meta"):
+            model = GPT(checkpoint["config"])
+            quantize_model(model, **checkpoint["quantization"])
+        model.load_state_dict(checkpoint["model"], assign=True)
+    else:
+        model = GPT(checkpoint["config"])
+        model.load_state_dict(checkpoint["model"])
+    model.to(device)
+    model.eval()
+    return model
+
+
+def save_quantized(path, out_path, bits=8, group_size=32):
+    """Quantizes the checkpoint at path and writes model, config and step to out_path"""
+    checkpoint = load_checkpoint(path)
+    model = GPT(checkpoint["config"])
+    model.load_state_dict(checkpoint["model"])
+    quantize_model(model, bits, group_size)
+    quantized = {
+        "model": model.state_dict(),
+        "config": model.config,
+        "step": checkpoint.get("step"),
+        "val_loss": checkpoint.get("val_loss"),
+        "val_loss_step": checkpoint.get("val_loss_step"),
+        "quantization": {"bits": bits, "group_size": group_size},
+    }
+    torch.save(quantized, out_path)
+
+
+# -----------------------------------------------------------------------------
+# accuracy
+
+
+@torch.no_grad()
+def val_loss(model, data_root, B, T, num_batches):
+    """Mean loss over the first num_batches (B, T) batches of the first val shard"""
+    shards = sorted(
+        s for s in os.listdir(data_root) if "val" in s and s.endswith(".npy")
+    )
+    assert len(shards) > 0, f"no val shards in {data_root}"
+    tokens = np.load(os.path.join(data_root, shards[0]), mmap_mode="r")
+    num_batches = min(num_batches, (len(tokens) - 1) // (B * T))
+    losses = []
+    for i in range(num_batches):
+        buf = torch.from_numpy(tokens[i * B * T : (i + 1) * B * T + 1].astype(np.int64))
+        x, y = buf[:-1].view(B, T), buf[1:].view(B, T)
+        logits, _ = model(x)
+        losses.append(F.cross_entropy(logits.view(-1, logits.size(-1)), y.view(-1)))
+    return torch.stack(losses).mean().item()
+
+
+@torch.no_grad()
+def hellaswag_accuracy(model, limit=0):
+    """acc_norm of the model on the HellaSwag val split (its first `limit` examples)"""
+    from hellaswag import evaluate_batched, load_tokenized
+
+    examples = load_tokenized("val")
+    indices = np.arange(min(limit, len(examples)) if limit > 0 else len(examples))
+    _, num_correct_norm, num_total = evaluate_batched(
+        lambda tokens: model(tokens)[0], examples, "cpu", indices=indices
+    )
+    return num_correct_norm / num_total
+
+
+# -----------------------------------------------------------------------------
+# latency and memory
+
+
+@torch.no_grad()
+def bench_inference(path, prompt_len, new_tokens, repeats=3):
+    """
+    Loads the checkpoint at path on CPU and times the prefill of a random prompt and
+    greedy decoding with the KV cache, batch size 1. Returns (prefill seconds, decode
+    seconds per token, weight bytes, peak memory bytes), best of `repeats`.
+    """
+    model = load_model(path)
+    config = model.config
+    torch.manual_seed(1337)
+    idx = torch.randint(config.vocab_size, (1, prompt_len))
+    prefill, decode = float("inf"), float("inf")
+    for _ in range(repeats + 1):  # the first round is warmup
+        kv_cache = KVCache(config, 1, max_len=prompt_len + new_tokens)
+        t0 = time.perf_counter()
+        logits, _ = model(
+            idx, pos=torch.arange(prompt_len).view(1, -1), kv_cache=kv_cache
+        )
+        t1 = time.perf_counter()
+        for i in range(new_tokens):
+            token = logits[:, -1:].argmax(dim=-1)
+            pos = torch.tensor([[prompt_len + i]])
+            logits, _ = model(token, pos=pos, kv_cache=kv_cache)
+        t2 = time.perf_counter()
+        prefill = min(prefill, t1 - t0)
+        decode = min(decode, (t2 - t1) / new_tokens)
+    return prefill, decode, model_bytes(model), peak_memory("cpu")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="log/model_XXXXX.pt or a sharded checkpoint directory",
+    )
+    parser.add_argument("--bits", type=int, default=8, choices=[8, 4])
+    parser.add_argument(
+        "--group_size",
+        type=int,
+        default=32,
+        help="input channels per int4 scale and zero point",
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        type=str,
+        default=None,
+        help="the quantized checkpoint (default: next to the checkpoint, _int8.pt)",
+    )
+    parser.add_argument(
+        "--eval", action="store_true", help="val loss and HellaSwag, fp32 vs quantized"
+    )
+    parser.add_argument("--data_root", type=str, default="edu_fineweb10B")
+    parser.add_argument("--val_batches", type=int, default=20)
+    parser.add_argument("-B", type=int, default=8, help="val loss batch size")
+    parser.add_argument("-T", type=int, default=1024, help="val loss sequence length")
+    parser.add_argument(
+        "--hellaswag_limit",
+        type=int,
+        default=0,
+        help="only the first N HellaSwag examples (0: all 10042)",
+    )
+    parser.add_argument(
+        "--bench", action="store_true", help="CPU latency and memory, fp32 vs quantized"
+    )
+    parser.add_argument("--prompt_len", type=int, default=128)
+    parser.add_argument("--new_tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    out = (
+        args.out
+        or f"{args.checkpoint.rstrip('/').removesuffix('.pt')}_int{args.bits}.pt"
+    )
+    t0 = time.time()
+    # in a fresh process: a child inherits the peak memory (ru_maxrss) of its parent
+    run_isolated(save_quantized, args.checkpoint, out, args.bits, args.group_size)
+    print(f"wrote {out} in {time.time() - t0:.2f}s")
+    names = ["fp32", f"int{args.bits}"]
+
+    if args.bench:
+        results = [
+            run_isolated(bench_inference, path, args.prompt_len, args.new_tokens)
+            for path in [args.checkpoint, out]
+        ]
+        for name, (prefill, decode, weights, peak) in zip(names, results):
+            print(
+                f"{name:5s} | prefill {args.prompt_len} tokens: {prefill*1000:.2f}ms | decode: {decode*1000:.2f}ms/token | weights: {weights / 2**20:.1f}MB | peak memory: {peak / 2**20:.1f}MB"
+            )
+        print(
+            f"int{args.bits} vs fp32: decode {results[0][1] / results[1][1]:.2f}x faster, weights {results[0][2] / results[1][2]:.2f}x smaller"
+        )
+
+    if args.eval:
+        # after the benchmarks, their processes would inherit this one's peak memory
+        models = [load_model(args.checkpoint), load_model(out)]
+        for name, model in zip(names, models):
+            loss = val_loss(model, args.data_root, args.B, args.T, args.val_batches)
+            acc = hellaswag_accuracy(model, args.hellaswag_limit)
+            print(f"{name:5s} | val loss: {loss:.4f} | hellaswag acc_norm: {acc:.4f}")
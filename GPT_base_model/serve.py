@@ -0,0 +1,316 @@
+"""
+Batched inference server for the GPT checkpoints written by train_gpt2.py.
+Loads the checkpoint once and serves completions over HTTP:
+$ python serve.py --checkpoint log/model_19072.pt --port 8000
+$ curl -N localhost:8000/generate -d '{"prompt": "Hello, I am a language model,", "max_new_tokens": 32, "top_k": 50, "seed": 42}'
+
+Concurrent requests are batched continuously: a single engine thread runs one
+forward pass per step over every active request. New requests join at the next
+step (their whole prompt is fed in that step), finished ones leave and free their
+row of the shared KV cache. Tokens are streamed back as newline-delimited JSON as
+soon as they are sampled; pass "stream": false to get one JSON response instead.
+Request fields: prompt, max_new_tokens, temperature, top_k, top_p, seed. Invalid
+values get a 400 for that request only, max_new_tokens <= 0 an empty completion.
+If the engine fails mid-stream, the stream ends with an {"error": ...} line
+instead of the final {"done": true, ...} one.
+"""
+
+import json
+import math
+import time
+import queue
+import codecs
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tiktoken
+import torch
+from model import KVCache, sample_logits
+from quantize import load_model
+
+# -----------------------------------------------------------------------------
+
+
+class Request:
+    def __init__(self, tokens, max_new_tokens, temperature, top_k, top_p, seed, device):
+        self.tokens = tokens  # the prompt, sampled tokens are appended as they come
+        self.num_prompt = len(tokens)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.generator = torch.Generator(device=device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        self.out = queue.Queue()  # sampled token ids, then None (or an exception)
+        self.row = None  # our row of the KV cache while active
+        self.fed = 0  # number of our tokens whose keys/values are in the cache
+
+
+def check_int(name, value, low=None):
+    # bool is an int too, but {"top_k": true} is not a meaningful request
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f"{name} must be an integer")
+    if low is not None and value < low:
+        raise ValueError(f"{name} must be at least {low}")
+
+
+def check_number(name, value, low=None):
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be finite")
+    if low is not None and value < low:
+        raise ValueError(f"{name} must be at least {low}")
+
+
+class BatchEngine:
+    """
+    Owns the model and the KV cache, and runs the decode loop on its own thread.
+    Every step, each active request feeds the tokens that are not in the cache yet:
+    the whole prompt on its first step, the last sampled token afterwards. The
+    rows are right-padded to the longest feed, see KVCache for why that is safe.
+    """
+
+    def __init__(self, model, device, max_batch, eot, vocab_size):
+        self.model = model
+        self.device = device
+        self.device_type = "cuda" if device.startswith("cuda") else "cpu"
+        self.eot = eot
+        self.vocab_size = vocab_size  # the model's vocab may be padded past this
+        self.cache = KVCache(model.config, max_batch)
+        self.free_rows = list(range(max_batch))
+        self.pending = queue.Queue()
+        self.active = []
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        tokens,
+        max_new_tokens=64,
+        temperature=1.0,
+        top_k=None,
+        top_p=None,
+        seed=None,
+    ):
+        """
+        Queues a completion of tokens and returns its Request. Raises ValueError for
+        settings sample_logits can't use, so a bad request fails on its own instead
+        of in the middle of a step, together with every other active one.
+        """
+        check_int("max_new_tokens", max_new_tokens)
+        check_number("temperature", temperature, low=0.0)
+        if top_k is not None:
+            check_int("top_k", top_k, low=1)
+            top_k = min(top_k, self.vocab_size)
+        if top_p is not None:
+            check_number("top_p", top_p)
+            if not 0.0 < top_p <= 1.0:
+                raise ValueError("top_p must be in (0, 1]")
+        if seed is not None:
+            check_int("seed", seed, low=0)
+            if seed >= 2**64:
+                raise ValueError("seed must be less than 2**64")
+        tokens = list(tokens) or [self.eot]  # an empty prompt starts a new document
+        block_size = self.model.config.block_size
+        if len(tokens) >= block_size:
+            raise ValueError(f"prompt is longer than {block_size - 1} tokens")
+        max_new_tokens = min(max_new_tokens, block_size - len(tokens))
+        request = Request(
+            tokens, max_new_tokens, temperature, top_k, top_p, seed, self.device
+        )
+        if max_new_tokens <= 0:
+            request.out.put(None)  # nothing to sample, never takes a row
+            return request
+        self.pending.put(request)
+        return request
+
+    def loop(self):
+        while True:
+            if not self.active:
+                self.admit(self.pending.get())  # block while idle
+            # fill the free rows with whatever is waiting
+            while self.free_rows:
+                try:
+                    self.admit(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.step()
+            except Exception as e:
+                for request in self.active:
+                    request.out.put(e)
+                    self.free_rows.append(request.row)
+                self.active = []
+
+    def admit(self, request):
+        request.row = self.free_rows.pop()
+        self.active.append(request)
+
+    @torch.no_grad()
+    def step(self):
+        feeds = [r.tokens[r.fed :] for r in self.active]
+        B, T = len(feeds), max(len(f) for f in feeds)
+        idx = torch.zeros((B, T), dtype=torch.long)
+        pos = torch.empty((B, T), dtype=torch.long)
+        for i, (request, feed) in enumerate(zip(self.active, feeds)):
+            idx[i, : len(feed)] = torch.tensor(feed, dtype=torch.long)
+            # padding continues the positions, it only writes slots we overwrite later
+            pos[i] = torch.arange(request.fed, request.fed + T)
+        idx, pos = idx.to(self.device), pos.to(self.device)
+        self.cache.rows = torch.tensor([r.row for r in self.active], device=self.device)
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16):
+            logits, _ = self.model(idx, pos=pos, kv_cache=self.cache)
+        last = torch.tensor([len(f) - 1 for f in feeds], device=self.device)
+        logits = logits[torch.arange(B, device=self.device), last, : self.vocab_size]
+        still_active = []
+        for i, (request, feed) in enumerate(zip(self.active, feeds)):
+            request.fed += len(feed)
+            token = sample_logits(
+                logits[i : i + 1],
+                request.temperature,
+                request.top_k,
+                request.top_p,
+                request.generator,
+            ).item()
+            request.tokens.append(token)
+            num_new = len(request.tokens) - request.num_prompt
+            if token != self.eot:
+                request.out.put(token)
+            if token == self.eot or num_new >= request.max_new_tokens:
+                request.out.put(None)
+                self.free_rows.append(request.row)
+            else:
+                still_active.append(request)
+        self.active = still_active
+
+
+class Server(ThreadingHTTPServer):
+    request_queue_size = 1024  # the default backlog of 5 drops bursts of clients
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # chunked transfer encoding for streaming
+    engine = None
+    enc = None
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise ValueError("the body must be a JSON object")
+            if not isinstance(body.get("prompt", ""), str):
+                raise ValueError("prompt must be a string")
+            request = self.engine.submit(
+                self.enc.encode(body.get("prompt", "")),
+                max_new_tokens=body.get("max_new_tokens", 64),
+                temperature=body.get("temperature", 1.0),
+                top_k=body.get("top_k"),
+                top_p=body.get("top_p"),
+                seed=body.get("seed"),
+            )
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        # decode incrementally, a token can end in the middle of a utf-8 character
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        if body.get("stream", True):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            text = ""
+            try:
+                for token in self.tokens(request):
+                    piece = decoder.decode(self.enc.decode_single_token_bytes(token))
+                    text += piece
+                    self.write_chunk({"token": token, "text": piece})
+            except Exception as e:
+                # the 200 is already sent, the client only learns of it from the stream
+                self.write_chunk({"error": str(e)})
+                self.wfile.write(b"0\r\n\r\n")
+                self.close_connection = True
+                return
+            text += decoder.decode(b"", final=True)
+            self.write_chunk({"done": True, "text": text})
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            try:
+                tokens = list(self.tokens(request))
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            payload = json.dumps({"tokens": tokens, "text": self.enc.decode(tokens)})
+            payload = payload.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    def tokens(self, request):
+        while (token := request.out.get()) is not None:
+            if isinstance(token, Exception):
+                raise token
+            yield token
+
+    def write_chunk(self, obj):
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass  # one line per request is too chatty at high concurrency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="log/model_XXXXX.pt or a sharded checkpoint directory",
+    )
+    parser.add_argument(
+        "-d",
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="the device to use",
+    )
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="the address to listen on"
+    )
+    parser.add_argument(
+        "-p", "--port", type=int, default=8000, help="the port to listen on"
+    )
+    parser.add_argument(
+        "-b",
+        "--max_batch",
+        type=int,
+        default=16,
+        help="the most requests decoded together",
+    )
+    args = parser.parse_args()
+
+    torch.set_float32_matmul_precision("high")
+    t0 = time.time()
+    model = load_model(args.checkpoint, args.device)
+    enc = tiktoken.get_encoding("gpt2")
+    Handler.enc = enc
+    Handler.engine = BatchEngine(
+        model, args.device, args.max_batch, enc.eot_token, enc.n_vocab
+    )
+    print(
+        f"loaded {args.checkpoint} in {time.time() - t0:.2f}s, serving on {args.host}:{args.port}"
+    )
+    Server((args.host, args.port), Handler).serve_forever()
@@ -0,0 +1,186 @@
+"""
+Document index of the token shards written by fineweb.py.
+Next to every shard edufineweb_{split}_XXXXXX.npy there is a sidecar
+edufineweb_{split}_XXXXXX.idx: an int64 (num_docs, 3) array with the start, the length
+and the global document id of every document in the shard (the first and the last one
+can be pieces of documents that straddle two shards). manifest.json in the same
+directory lists every shard with its token and document counts. Together they give
+O(1) random access to documents and exact epoch accounting without scanning the tokens.
+Shards written before the index existed can be indexed once, after the fact:
+$ python shards.py edu_fineweb10B --build
+$ python shards.py edu_fineweb10B            # statistics of every split
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+
+# -----------------------------------------------------------------------------
+
+
+def index_filename(shard_filename):
+    return os.path.splitext(shard_filename)[0] + ".idx"
+
+
+def write_index(filename, starts, doc_ids, num_tokens):
+    """Writes the index of a shard of num_tokens tokens, given where its documents start"""
+    lengths = np.diff(np.append(starts, num_tokens))
+    index = np.stack([starts, lengths, doc_ids], axis=1).astype(np.int64)
+    with open(filename + ".tmp", "wb") as f:
+        np.save(f, index)
+    os.replace(filename + ".tmp", filename)
+
+
+def scan_shard(tokens, eot, next_doc):
+    """
+    Recovers (starts, doc_ids) of a shard from its <|endoftext|> delimiters, for shards
+    without an index. next_doc is the id of the first document that starts in this shard,
+    tokens before it belong to the last document of the previous shard.
+    """
+    starts = np.flatnonzero(tokens == eot)
+    continued = len(starts) == 0 or starts[0] != 0
+    if continued:
+        starts = np.concatenate([[0], starts])
+    doc_ids = next_doc - int(continued) + np.arange(len(starts))
+    return starts, doc_ids
+
+
+def save_manifest(data_root, manifest):
+    path = os.path.join(data_root, "manifest.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def mix(x, key):
+    # splitmix64 finalizer of x ^ key, wrapping uint64 arithmetic
+    x = (x ^ key) * np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(31)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(29)
+    return x
+
+
+def permute(indices, n, seed, rounds=4):
+    """
+    Maps indices through a pseudo-random permutation of range(n) chosen by seed, without
+    materializing it: a Feistel network over the smallest even power of two >= n, applied
+    again to any value that lands outside of range(n) (cycle walking). Same seed, same
+    permutation, whatever the indices asked for.
+    """
+    half = max(1, (int(n - 1).bit_length() + 1) // 2)
+    mask = np.uint64((1 << half) - 1)
+    keys = np.random.default_rng(seed).integers(2**63, size=rounds, dtype=np.uint64)
+    x = np.array(indices, dtype=np.uint64)
+    todo = np.ones(len(x), dtype=bool)
+    while todo.any():
+        left, right = x[todo] >> np.uint64(half), x[todo] & mask
+        for key in keys:
+            left, right = right, left ^ (mix(right, key) & mask)
+        x[todo] = (left << np.uint64(half)) | right
+        todo = x >= n
+    return x.astype(np.int64)
+
+
+class ShardIndex:
+    """
+    The shards of one split and their document indexes, memory-mapped. Document i is the
+    i-th entry across the indexes of the split's shards, in order: a document that
+    straddles two shards is one entry in each.
+    """
+
+    def __init__(self, data_root, split):
+        with open(os.path.join(data_root, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        entries = [s for s in manifest["shards"] if split in s["filename"]]
+        assert len(entries) > 0, f"no shards found for split {split}"
+        assert all(
+            "index" in s for s in entries
+        ), f"{data_root} has no document index, run python shards.py {data_root} --build"
+        self.filenames = [os.path.join(data_root, s["filename"]) for s in entries]
+        self.indexes = [
+            np.load(os.path.join(data_root, s["index"]), mmap_mode="r") for s in entries
+        ]
+        self.shard_tokens = np.array([s["tokens"] for s in entries], dtype=np.int64)
+        # the id of the first document of every shard, and the total at the end
+        self.shard_docs = np.cumsum([0] + [s["num_docs"] for s in entries])
+        self.num_tokens = int(self.shard_tokens.sum())
+        self.tokens = [None] * len(entries)
+
+    def __len__(self):
+        return int(self.shard_docs[-1])
+
+    def shard(self, shard):
+        """The tokens of a shard, memory-mapped on first use"""
+        if self.tokens[shard] is None:
+            self.tokens[shard] = np.load(self.filenames[shard], mmap_mode="r")
+        return self.tokens[shard]
+
+    def locate(self, i):
+        """Returns (shard, start, length, doc_id) of document i"""
+        shard = int(np.searchsorted(self.shard_docs, i, side="right")) - 1
+        start, length, doc_id = self.indexes[shard][i - self.shard_docs[shard]]
+        return shard, int(start), int(length), int(doc_id)
+
+    def document(self, i):
+        """The tokens of document i"""
+        shard, start, length, _ = self.locate(i)
+        return self.shard(shard)[start : start + length]
+
+
+def build(data_root, eot):
+    """Indexes the shards of data_root by scanning them, and records them in its manifest"""
+    path = os.path.join(data_root, "manifest.json")
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    else:
+        # shards from before the manifest existed, in the order they were written
+        filenames = [
+            s
+            for s in os.listdir(data_root)
+            if s.startswith("edufineweb_") and s.endswith(".npy")
+        ]
+        filenames = sorted(filenames, key=lambda s: s.split("_")[-1])
+        manifest = {"shards": [{"filename": s} for s in filenames], "complete": True}
+    next_doc = 0
+    for entry in manifest["shards"]:
+        shard_filename = os.path.join(data_root, entry["filename"])
+        tokens = np.load(shard_filename, mmap_mode="r")
+        starts, doc_ids = scan_shard(tokens, eot, next_doc)
+        write_index(index_filename(shard_filename), starts, doc_ids, len(tokens))
+        entry["tokens"] = len(tokens)
+        entry["index"] = os.path.basename(index_filename(shard_filename))
+        entry["first_doc"] = int(doc_ids[0])
+        entry["num_docs"] = len(starts)
+        next_doc = int(doc_ids[-1]) + 1
+        print(f"indexed {entry['filename']}: {len(starts)} documents")
+    save_manifest(data_root, manifest)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "data_root",
+        type=str,
+        nargs="?",
+        default="edu_fineweb10B",
+        help="shard directory",
+    )
+    parser.add_argument(
+        "--build", action="store_true", help="index shards written without an index"
+    )
+    args = parser.parse_args()
+
+    if args.build:
+        import tiktoken
+
+        enc = tiktoken.get_encoding("gpt2")
+        build(args.data_root, enc._special_tokens["<|endoftext|>"])
+    for split in ["train", "val"]:
+        index = ShardIndex(args.data_root, split)
+        print(
+            f"{split}: {len(index.filenames)} shards | {len(index)} documents | "
+            f"{index.num_tokens} tokens | {index.num_tokens / len(index):.1f} tokens/document"
+        )
@@ -0,0 +1,201 @@
+"""
+Speculative decoding: a small draft GPT proposes k tokens one at a time, the large
+GPT scores all of them in one forward pass, and a prefix of them is accepted by
+speculative sampling (Leviathan et al. 2022, Chen et al. 2023). Every round yields
+between 1 and k + 1 tokens for one forward pass of the large model, and the tokens
+are distributed exactly as if they were sampled from the large model alone (with
+the same temperature / top-k / top-p). The draft must share the tokenizer and
+vocab, e.g. a 2-4 layer GPT trained on the same data:
+$ torchrun --standalone --nproc_per_node=8 train_gpt2.py --n_layer 4 --n_head 4 --n_embd 256 --log_dir log_draft
+$ python speculative.py --checkpoint log/model_19072.pt --draft log_draft/model_19072.pt -k 2 4 8
+Reports the acceptance rate of the drafted tokens and tok/sec against plain sampling
+with GPT.generate.
+"""
+
+import time
+import argparse
+import contextlib
+from collections import Counter
+import tiktoken
+import torch
+from model import KVCache, sampling_probs
+from quantize import load_model
+from metrics import sync
+
+# -----------------------------------------------------------------------------
+
+
+@torch.no_grad()
+def speculative_generate(
+    model,
+    draft,
+    prompt,
+    max_new_tokens,
+    k=4,
+    temperature=1.0,
+    top_k=None,
+    top_p=None,
+    generator=None,
+):
+    """
+    Samples max_new_tokens after prompt (a token list) from model, with k tokens
+    drafted by draft per round. Returns prompt + completion as a list, and a dict
+    with the number of rounds (forward passes of model), drafted and accepted tokens.
+    Both KV caches are indexed by position (see KVCache), so rejected tokens are
+    rolled back by just feeding their positions again.
+    """
+    assert (
+        draft.config.vocab_size == model.config.vocab_size
+    ), "the draft model must have the same vocab as the model"
+    device = model.lm_head.weight.device
+    block_size = min(model.config.block_size, draft.config.block_size)
+    assert len(prompt) <= block_size, "prompt is longer than the block size"
+    max_new_tokens = min(max_new_tokens, block_size - len(prompt))
+    max_len = len(prompt) + max_new_tokens
+    model_cache = KVCache(model.config, 1, max_len)
+    draft_cache = KVCache(draft.config, 1, max_len)
+
+    def forward(m, kv_cache, start, feed):
+        # the logits after every token of feed, which goes at positions start...
+        idx = torch.tensor([feed], dtype=torch.long, device=device)
+        pos = torch.arange(start, start + len(feed), device=device).view(1, -1)
+        logits, _ = m(idx, pos=pos, kv_cache=kv_cache)
+        return logits[0]
+
+    def probs(logits):
+        return sampling_probs(logits, temperature, top_k, top_p)
+
+    def sample(p):
+        return torch.multinomial(p, 1, generator=generator).item()
+
+    tokens = list(prompt)
+    model_len = draft_len = 0  # the tokens already in each cache
+    stats = {"rounds": 0, "drafted": 0, "accepted": 0}
+    while len(tokens) < max_len:
+        n = len(tokens)
+        # the last round can only take one token more than it drafts
+        num_draft = min(k, max_len - n - 1)
+        # the draft catches up with tokens and proposes num_draft more, one at a time
+        proposals, draft_probs = [], []
+        feed = tokens[draft_len:]
+        for _ in range(num_draft):
+            logits = forward(draft, draft_cache, draft_len, feed)
+            draft_len += len(feed)
+            draft_probs.append(probs(logits[-1:]))
+            proposals.append(sample(draft_probs[-1][0]))
+            feed = proposals[-1:]
+        # the model scores them all at once: row i is its distribution for proposal i,
+        # the last row the one after all of them
+        logits = forward(model, model_cache, model_len, tokens[model_len:] + proposals)
+        p = probs(logits[-(num_draft + 1) :])
+        # accept proposal i with probability min(1, p_i(x) / q_i(x))
+        num_accepted = num_draft
+        if num_draft > 0:
+            q = torch.cat(draft_probs)
+            rows = torch.arange(num_draft, device=device)
+            x = torch.tensor(proposals, device=device)
+            r = torch.rand(num_draft, device=device, generator=generator)
+            rejected = (r * q[rows, x] >= p[rows, x]).tolist()
+            num_accepted = rejected.index(True) if True in rejected else num_draft
+        if num_accepted < num_draft:
+            # resample the rejected position from what p has in excess of q there
+            residual = (p[num_accepted] - q[num_accepted]).clamp(min=0)
+            token = sample(residual / residual.sum())
+        else:
+            token = sample(p[num_draft])
+        tokens += proposals[:num_accepted] + [token]
+        # cached keys/values past the accepted tokens are stale, they get overwritten
+        model_len = len(tokens) - 1
+        draft_len = min(draft_len, len(tokens) - 1)
+        stats["rounds"] += 1
+        stats["drafted"] += num_draft
+        stats["accepted"] += num_accepted
+    return tokens, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--checkpoint", type=str, required=True, help="the model to sample from"
+    )
+    parser.add_argument(
+        "--draft", type=str, required=True, help="checkpoint of the small draft model"
+    )
+    parser.add_argument(
+        "-k",
+        type=int,
+        nargs="+",
+        default=[4],
+        help="tokens drafted per round, one run per value",
+    )
+    parser.add_argument(
+        "-d",
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="the device to use",
+    )
+    parser.add_argument("--prompt", type=str, default="Hello, I'm a language model,")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument(
+        "--num_samples", type=int, default=5, help="completions per run"
+    )
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=None)
+    parser.add_argument("--top_p", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    torch.set_float32_matmul_precision("high")
+    model = load_model(args.checkpoint, args.device)
+    draft = load_model(args.draft, args.device)
+    enc = tiktoken.get_encoding("gpt2")
+    prompt = enc.encode(args.prompt)
+    sampling = dict(temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+    autocast = contextlib.nullcontext()
+    if args.device.startswith("cuda"):
+        autocast = torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+
+    def run(sample_fn):
+        # tok/sec of num_samples completions of sample_fn(generator) -> token list
+        generator = torch.Generator(device=args.device).manual_seed(args.seed)
+        num_tokens = 0
+        sync(args.device)
+        t0 = time.time()
+        for _ in range(args.num_samples):
+            with autocast:
+                tokens = sample_fn(generator)
+            num_tokens += len(tokens) - len(prompt)
+        sync(args.device)
+        return num_tokens / (time.time() - t0), tokens
+
+    def plain(generator, max_new_tokens=args.max_new_tokens):
+        out = model.generate([prompt], max_new_tokens, generator=generator, **sampling)
+        return out[0]
+
+    run(lambda generator: plain(generator, 8))  # warmup
+    base, _ = run(plain)
+    print(f"plain sampling | tok/sec: {base:.2f}")
+    for k in args.k:
+        stats = Counter()
+
+        def speculative(generator):
+            tokens, sample_stats = speculative_generate(
+                model,
+                draft,
+                prompt,
+                args.max_new_tokens,
+                k,
+                generator=generator,
+                **sampling,
+            )
+            stats.update(sample_stats)
+            return tokens
+
+        tok_per_sec, tokens = run(speculative)
+        acceptance = stats["accepted"] / max(1, stats["drafted"])
+        per_round = (stats["accepted"] + stats["rounds"]) / stats["rounds"]
+        print(
+            f"speculative k={k} | tok/sec: {tok_per_sec:.2f} | acceptance rate: {acceptance:.2%} | tokens per forward: {per_round:.2f} | speedup: {tok_per_sec / base:.2f}x"
+        )
+    print(enc.decode(tokens))
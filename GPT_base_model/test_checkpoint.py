@@ -0,0 +1,97 @@
+"""
+Checks that a sharded checkpoint written by 2 ranks loads back exactly on 1 and on
+3 ranks (CPU, gloo), with the tied wte/lm_head weight stored once and tied again:
+$ python -m pytest test_checkpoint.py
+"""
+
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from checkpoint import AsyncCheckpointWriter, ShardedCheckpoint, load_checkpoint
+from model import GPT, GPTConfig
+
+# -----------------------------------------------------------------------------
+
+CONFIG = GPTConfig(block_size=16, vocab_size=96, n_layer=2, n_head=2, n_embd=32)
+
+
+def make_checkpoint():
+    # the same model and optimizer state on every rank, like DDP
+    torch.manual_seed(0)
+    model = GPT(CONFIG)
+    optimizer = model.configure_optimizers(0.1, 1e-3, "cpu", verbose=False)
+    x = torch.randint(CONFIG.vocab_size, (2, CONFIG.block_size))
+    for _ in range(2):
+        _, loss = model(x, x)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    return {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "config": CONFIG,
+        "step": 2,
+    }
+
+
+def init(rank, world_size, store):
+    dist.init_process_group(
+        "gloo", init_method=f"file://{store}", rank=rank, world_size=world_size
+    )
+
+
+def write(rank, world_size, store, path):
+    init(rank, world_size, store)
+    writer = AsyncCheckpointWriter()
+    rank_state = {"rng": rank, "loader": {"current_shard": 0, "current_position": rank}}
+    writer.save_sharded(make_checkpoint(), rank_state, path, rank, world_size)
+    writer.wait()
+    dist.barrier()  # rank 0 writes index.json last, after its own slice only
+    dist.destroy_process_group()
+
+
+def read(rank, world_size, store, path):
+    if world_size > 1:
+        init(rank, world_size, store)
+    checkpoint = load_checkpoint(path, rank, world_size, "cpu")
+    expected = make_checkpoint()
+    assert checkpoint["step"] == 2 and checkpoint["config"] == CONFIG
+    assert checkpoint["world_size"] == 2
+    assert [s["current_position"] for s in checkpoint["loader"]] == [0, 1]
+
+    model = checkpoint["model"]
+    assert model.keys() == expected["model"].keys()
+    for key, value in expected["model"].items():
+        assert torch.equal(model[key], value), key
+    assert model["lm_head.weight"] is model["transformer.wte.weight"]
+    GPT(CONFIG).load_state_dict(model)
+
+    optimizer = checkpoint["optimizer"]
+    assert optimizer["param_groups"] == expected["optimizer"]["param_groups"]
+    assert optimizer["state"].keys() == expected["optimizer"]["state"].keys()
+    for i, state in expected["optimizer"]["state"].items():
+        for name, value in state.items():
+            assert torch.equal(optimizer["state"][i][name], value), (i, name)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def test_sharded_round_trip(tmp_path):
+    path = str(tmp_path / "model_00002")
+    mp.spawn(write, args=(2, str(tmp_path / "store_write"), path), nprocs=2)
+    assert sorted(os.listdir(path)) == [
+        "index.json",
+        "meta.pt",
+        "rank_00000.bin",
+        "rank_00000.pt",
+        "rank_00001.bin",
+        "rank_00001.pt",
+    ]
+    # the tied weight is stored once, under the name it was first seen by
+    tensors = ShardedCheckpoint(path).index["tensors"]
+    assert "/model/transformer.wte.weight" in tensors
+    assert "/model/lm_head.weight" not in tensors
+
+    read(0, 1, None, path)
+    mp.spawn(read, args=(3, str(tmp_path / "store_read"), path), nprocs=3)
@@ -0,0 +1,104 @@
+"""
+Checks the document shuffling of DataLoaderLite on a few tiny synthetic shards:
+$ python -m pytest test_dataloader.py
+"""
+
+import os
+import numpy as np
+import pytest
+import torch
+from dataloader import DataLoaderLite, PrefetchLoader
+from shards import build, permute
+
+# -----------------------------------------------------------------------------
+
+EOT = 50256
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    # 400 documents over 4 train shards (and a val one), every token but the
+    # <|endoftext|> delimiters is a different number, so a token tells where it was read
+    rng = np.random.default_rng(0)
+    docs, next_token = [], 1
+    for _ in range(400):
+        length = int(rng.integers(1, 80))
+        docs.append([EOT] + list(range(next_token, next_token + length)))
+        next_token += length
+    tokens = np.array(sum(docs, []), dtype=np.uint16)
+    pieces = np.array_split(tokens, 5)  # documents straddle the shard boundaries
+    for i, piece in enumerate(pieces):
+        split = "val" if i == 0 else "train"
+        np.save(tmp_path / f"edufineweb_{split}_{i:06d}.npy", piece)
+    build(str(tmp_path), EOT)
+    return str(tmp_path)
+
+
+def make_loader(data_root, rank, world_size, shuffle=True, B=2, T=16):
+    return DataLoaderLite(
+        B=B,
+        T=T,
+        process_rank=rank,
+        num_processes=world_size,
+        split="train",
+        memmap=True,
+        shuffle=shuffle,
+        data_root=data_root,
+        verbose=False,
+    )
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 10, 64, 1000, 4097])
+def test_permute_is_a_bijection(n):
+    for seed in [(0, 0), (1337, 1), (1337, 2)]:
+        values = permute(np.arange(n), n, seed)
+        assert sorted(values.tolist()) == list(range(n))
+        # any subset of the indices maps the same way as in the full permutation
+        assert np.array_equal(permute(np.arange(n)[::3], n, seed), values[::3])
+
+
+def test_ranks_read_disjoint_documents(data_root):
+    world_size = 3
+    loaders = [make_loader(data_root, rank, world_size) for rank in range(world_size)]
+    step_tokens = 2 * 16 * world_size
+    num_steps = (loaders[0].index.num_tokens - 1) // step_tokens  # one epoch
+    seen = []
+    for _ in range(num_steps):
+        for loader in loaders:
+            x, y = loader.next_batch()
+            # the targets are the inputs shifted by one token, across the windows too
+            assert torch.equal(x.view(-1)[1:], y.view(-1)[:-1])
+            seen.append(x.view(-1).numpy())
+    seen = np.concatenate(seen)
+    seen = seen[seen != EOT]
+    assert len(np.unique(seen)) == len(seen), "a token was read twice in one epoch"
+    assert all(loader.epoch == 0 for loader in loaders)
+    # the next step starts the next epoch, in a different order
+    first = make_loader(data_root, 0, world_size).next_batch()[0]
+    x, _ = loaders[0].next_batch()
+    assert loaders[0].epoch == 1 and not torch.equal(x, first)
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_resume_from_consumed_state(data_root, shuffle):
+    batches = PrefetchLoader(make_loader(data_root, 1, 2, shuffle), "cpu", depth=2)
+    for _ in range(5):
+        batches.next_batch()
+    state = batches.state_dict()  # the prefetch thread is further ahead by now
+    expected = [batches.next_batch() for _ in range(20)]
+
+    loader = make_loader(data_root, 1, 2, shuffle)
+    loader.load_state_dict(state)
+    resumed = PrefetchLoader(loader, "cpu", depth=2)
+    for x, y in expected:
+        rx, ry = resumed.next_batch()
+        assert torch.equal(rx, x) and torch.equal(ry, y)
+
+
+def test_resume_in_the_other_mode_fails(data_root):
+    shuffled = make_loader(data_root, 0, 1, shuffle=True)
+    sequential = make_loader(data_root, 0, 1, shuffle=False)
+    with pytest.raises(AssertionError, match="without --shuffle"):
+        shuffled.load_state_dict(sequential.state_dict())
+    with pytest.raises(AssertionError, match="with --shuffle"):
+        sequential.load_state_dict(shuffled.state_dict())
@@ -0,0 +1,74 @@
+"""
+Checks that fineweb.py resumed after a crash writes the same shards as a run that
+was never interrupted (tokenizes a small local .jsonl, needs the gpt2 encoding):
+$ python -m pytest test_fineweb.py
+"""
+
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+
+# -----------------------------------------------------------------------------
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# runs fineweb.py, but raises once the manifest records crash_after shards, like a
+# run killed between two shards. The shard after that one may already be on disk
+RUN = """
+import sys, runpy, shards
+crash_after = int(sys.argv.pop(1))
+save_manifest = shards.save_manifest
+def crashing_save_manifest(data_root, manifest):
+    save_manifest(data_root, manifest)
+    if len(manifest["shards"]) == crash_after and not manifest["complete"]:
+        raise SystemExit("killed")
+shards.save_manifest = crashing_save_manifest
+sys.argv[0] = "fineweb.py"
+runpy.run_path("fineweb.py", run_name="__main__")
+"""
+
+
+def write_documents(path, num_docs=200):
+    rng = np.random.default_rng(0)
+    words = ["the", "model", "reads", "tokens", "of", "every", "document", "once"]
+    with open(path, "w") as f:
+        for i in range(num_docs):
+            text = " ".join(rng.choice(words, size=rng.integers(1, 60)))
+            f.write(json.dumps({"text": f"document {i}: {text}"}) + "\n")
+
+
+def tokenize(documents, output_dir, crash_after=-1):
+    command = [sys.executable, "-c", RUN, str(crash_after), "--local", documents]
+    command += ["--output_dir", output_dir, "--shard_size", "500", "-n", "2", "-w", "2"]
+    return subprocess.run(command, cwd=HERE, capture_output=True, text=True)
+
+
+def shard_files(output_dir):
+    return sorted(s for s in os.listdir(output_dir) if s.startswith("edufineweb_"))
+
+
+def test_resume_is_byte_identical(tmp_path):
+    documents = str(tmp_path / "documents.jsonl")
+    write_documents(documents)
+    reference, resumed = str(tmp_path / "reference"), str(tmp_path / "resumed")
+    result = tokenize(documents, reference)
+    assert result.returncode == 0, result.stderr
+    expected = shard_files(reference)
+    assert len(expected) > 2 * 4  # shards and their .idx sidecars
+
+    for crash_after in (1, 3):
+        result = tokenize(documents, resumed, crash_after)
+        assert result.returncode != 0 and "killed" in result.stderr
+        with open(os.path.join(resumed, "manifest.json"), "r") as f:
+            assert len(json.load(f)["shards"]) == crash_after
+    result = tokenize(documents, resumed)
+    assert result.returncode == 0, result.stderr
+
+    assert shard_files(resumed) == expected
+    for filename in expected:
+        with open(os.path.join(reference, filename), "rb") as f:
+            want = f.read()
+        with open(os.path.join(resumed, filename), "rb") as f:
+            assert f.read() == want, filename
@@ -0,0 +1,120 @@
+"""
+Checks that the batched, length-bucketed HellaSwag scoring (evaluate_batched) picks
+the same endings as scoring every example on its own, as evaluate() used to:
+$ python -m pytest test_hellaswag.py
+"""
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+from hellaswag import (
+    TokenizedExamples,
+    evaluate_batched,
+    render_example,
+    tokenize_examples,
+)
+from model import GPT, GPTConfig
+
+# -----------------------------------------------------------------------------
+
+EXAMPLES = [
+    {
+        "ctx": "A man is sitting on a roof. he",
+        "endings": [
+            "is using wrap to wrap a pair of skis.",
+            "is ripping level tiles off.",
+            "is holding a rubik's cube.",
+            "starts pulling up roofing on a roof.",
+        ],
+        "label": 3,
+    },
+    {
+        "ctx": "A woman is outside with a bucket and a dog. The dog is running around trying to avoid a bath. she",
+        "endings": [
+            "rinses the bucket off with soap and blow dry the dog's head.",
+            "uses a hose to keep it from getting soapy.",
+            "gets the dog wet, then it runs away again.",
+            "gets into a bath tub with the dog.",
+        ],
+        "label": 2,
+    },
+    {
+        "ctx": "Kids are playing.",
+        "endings": ["They", "run", "sing loudly in a circle while the teacher claps along.", "sleep."],
+        "label": 0,
+    },
+    {
+        "ctx": "How to make tea. Boil the water in a kettle, then",
+        "endings": [
+            "pour it over the leaves and let them steep for three to five minutes.",
+            "put the kettle in the freezer.",
+            "drink the water.",
+            "throw the leaves away before you start.",
+        ],
+        "label": 0,
+    },
+    {
+        "ctx": "A person is skiing down a hill. They",
+        "endings": ["fall.", "stop at the bottom.", "wave.", "keep going over a jump and land it."],
+        "label": 1,
+    },
+    {
+        "ctx": "The chef chops the onions finely and adds them to the hot pan with a little oil, stirring",
+        "endings": ["constantly.", "the soup.", "nothing at all.", "until they turn golden brown and soft."],
+        "label": 3,
+    },
+]
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = GPTConfig(block_size=64, vocab_size=50304, n_layer=2, n_head=2, n_embd=32)
+    model = GPT(config)
+    model.eval()
+    return model
+
+
+@torch.no_grad()
+def score_example(model, example):
+    # the per-example scoring of evaluate() before the batched path existed
+    _, tokens, mask, _ = render_example(example)
+    logits, _ = model(tokens)
+    shift_logits = (logits[..., :-1, :]).contiguous()
+    shift_tokens = (tokens[..., 1:]).contiguous()
+    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
+    flat_shift_tokens = shift_tokens.view(-1)
+    shift_losses = F.cross_entropy(
+        flat_shift_logits, flat_shift_tokens, reduction="none"
+    )
+    shift_losses = shift_losses.view(tokens.size(0), -1)
+    shift_mask = (mask[..., 1:]).contiguous()
+    masked_shift_losses = shift_losses * shift_mask
+    sum_loss = masked_shift_losses.sum(dim=1)
+    avg_loss = sum_loss / shift_mask.sum(dim=1)
+    return sum_loss.argmin().item(), avg_loss.argmin().item()
+
+
+def test_batched_matches_per_example():
+    model = make_model()
+    preds = [score_example(model, example) for example in EXAMPLES]
+    examples = tokenize_examples(EXAMPLES)
+    model_fn = lambda tokens: model(tokens)[0]
+    # small batches, so examples of different lengths are padded into the same one
+    for max_batch_tokens in [64, 256, 16384]:
+        num_correct, num_correct_norm, num_total = evaluate_batched(
+            model_fn, examples, "cpu", max_batch_tokens=max_batch_tokens
+        )
+        assert num_total == len(EXAMPLES)
+        labels = [example["label"] for example in EXAMPLES]
+        assert num_correct == sum(p == l for (p, _), l in zip(preds, labels))
+        assert num_correct_norm == sum(p == l for (_, p), l in zip(preds, labels))
+        # with the per-example predictions as labels, every single one has to agree
+        for i in range(2):
+            agreeing = np.array([pred[i] for pred in preds], dtype=np.int64)
+            agreed = evaluate_batched(
+                model_fn,
+                TokenizedExamples(examples.tokens, examples.offsets, agreeing),
+                "cpu",
+                max_batch_tokens=max_batch_tokens,
+            )[i]
+            assert agreed == len(EXAMPLES)
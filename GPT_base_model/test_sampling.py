@@ -0,0 +1,33 @@
+"""
+Checks sample_logits / sampling_probs against hand-computed distributions:
+$ python -m pytest test_sampling.py
+"""
+
+import math
+import torch
+from model import sample_logits, sampling_probs
+
+# -----------------------------------------------------------------------------
+
+# logits of the distribution [0.4, 0.3, 0.2, 0.1]
+LOGITS = torch.tensor([[math.log(0.4), math.log(0.3), math.log(0.2), math.log(0.1)]])
+
+
+def test_top_k_top_p():
+    # top-k 3 renormalizes to [4/9, 3/9, 2/9], cumulative [4/9, 7/9, 1]. The third
+    # token starts past top_p 0.75, so [4/7, 3/7] remain. Without renormalizing
+    # (cumulative [0.4, 0.7, 0.9]) the third one would wrongly be kept
+    expected = torch.tensor([[4 / 7, 3 / 7, 0.0, 0.0]])
+    probs = sampling_probs(LOGITS, top_k=3, top_p=0.75)
+    torch.testing.assert_close(probs, expected)
+    generator = torch.Generator().manual_seed(0)
+    samples = sample_logits(
+        LOGITS.expand(20000, -1), top_k=3, top_p=0.75, generator=generator
+    )
+    counts = torch.bincount(samples.view(-1), minlength=4) / samples.numel()
+    torch.testing.assert_close(counts, expected[0], atol=0.02, rtol=0)
+
+
+def test_top_k_only():
+    expected = torch.tensor([[4 / 9, 3 / 9, 2 / 9, 0.0]])
+    torch.testing.assert_close(sampling_probs(LOGITS, top_k=3), expected)
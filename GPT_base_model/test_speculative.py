@@ -0,0 +1,52 @@
+"""
+Checks that greedy speculative decoding returns exactly the greedy output of the
+large model, whatever the draft proposes:
+$ python -m pytest test_speculative.py
+"""
+
+import pytest
+import torch
+from model import GPT, GPTConfig
+from speculative import speculative_generate
+
+# -----------------------------------------------------------------------------
+
+
+def make_model(seed, n_layer):
+    torch.manual_seed(seed)
+    config = GPTConfig(
+        block_size=48, vocab_size=64, n_layer=n_layer, n_head=2, n_embd=32
+    )
+    model = GPT(config)
+    model.eval()
+    return model
+
+
+@torch.no_grad()
+def greedy(model, prompt, max_new_tokens):
+    # one full forward pass per token, no KV cache
+    tokens = list(prompt)
+    for _ in range(max_new_tokens):
+        logits, _ = model(torch.tensor([tokens]))
+        tokens.append(logits[0, -1].argmax().item())
+    return tokens
+
+
+@pytest.mark.parametrize("k", [1, 3, 8])
+def test_greedy_matches_the_model(k):
+    model = make_model(0, n_layer=3)
+    prompt = [5, 17, 3, 42, 8]
+    expected = greedy(model, prompt, 30)
+    assert model.generate([prompt], 30, temperature=0.0)[0] == expected
+    # a draft that disagrees a lot, and one that always agrees
+    for draft in [make_model(1, n_layer=1), model]:
+        tokens, stats = speculative_generate(
+            model, draft, prompt, 30, k=k, temperature=0.0
+        )
+        assert tokens == expected
+        if draft is model:
+            assert stats["accepted"] == stats["drafted"]
+    # up to the end of the block, where the last round drafts fewer tokens
+    draft = make_model(1, n_layer=1)
+    tokens, _ = speculative_generate(model, draft, prompt, 100, k=k, temperature=0.0)
+    assert tokens == greedy(model, prompt, 48 - len(prompt))
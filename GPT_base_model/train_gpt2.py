@@ -1,329 +1,47 @@
 import os
 import math
 import time
-import inspect
-from dataclasses import dataclass
+import contextlib
 import torch
-import torch.nn as nn
-from torch.nn import functional as F
-from hellaswag import render_example, iterate_examples
-
-# -----------------------------------------------------------------------------
-
-
-class CausalSelfAttention(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        assert config.n_embd % config.n_head == 0
-        # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
-        # output projection
-        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
-        self.c_proj.NANOGPT_SCALE_INIT = 1
-        # regularization
-        self.n_head = config.n_head
-        self.n_embd = config.n_embd
-
-    def forward(self, x):
-        B, T, C = (
-            x.size()
-        )  # batch size, sequence length, embedding dimensionality (n_embd)
-        # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
-        # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the Transformer
-        qkv = self.c_attn(x)
-        q, k, v = qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(
-            1, 2
-        )  # (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C // self.n_head).transpose(
-            1, 2
-        )  # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(
-            1, 2
-        )  # (B, nh, T, hs)
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True)  # flash attention
-        y = (
-            y.transpose(1, 2).contiguous().view(B, T, C)
-        )  # re-assemble all head outputs side by side
-        # output projection
-        y = self.c_proj(y)
-        return y
-
-
-class MLP(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        self.c_fc = nn.Linear(config.n_embd, 4 * config.n_embd)
-        self.gelu = nn.GELU(approximate="tanh")
-        self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
-        self.c_proj.NANOGPT_SCALE_INIT = 1
-
-    def forward(self, x):
-        x = self.c_fc(x)
-        x = self.gelu(x)
-        x = self.c_proj(x)
-        return x
-
-
-class Block(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        self.ln_1 = nn.LayerNorm(config.n_embd)
-        self.attn = CausalSelfAttention(config)
-        self.ln_2 = nn.LayerNorm(config.n_embd)
-        self.mlp = MLP(config)
-
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
-        x = x + self.mlp(self.ln_2(x))
-        return x
-
-
-@dataclass
-class GPTConfig:
-    block_size: int = 1024  # max sequence length
-    vocab_size: int = (
-        50257  # number of tokens: 50,000 BPE merges + 256 bytes tokens + 1 <|endoftext|> token
-    )
-    n_layer: int = 12  # number of layers
-    n_head: int = 12  # number of heads
-    n_embd: int = 768  # embedding dimension
-
-
-class GPT(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        self.config = config
-
-        self.transformer = nn.ModuleDict(
-            dict(
-                wte=nn.Embedding(config.vocab_size, config.n_embd),
-                wpe=nn.Embedding(config.block_size, config.n_embd),
-                h=nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
-                ln_f=nn.LayerNorm(config.n_embd),
-            )
-        )
-        self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
-
-        # weight sharing scheme
-        self.transformer.wte.weight = self.lm_head.weight
-
-        # init params
-        self.apply(self._init_weights)
-
-    def _init_weights(self, module):
-        if isinstance(module, nn.Linear):
-            std = 0.02
-            if hasattr(module, "NANOGPT_SCALE_INIT"):
-                std *= (2 * self.config.n_layer) ** -0.5
-            torch.nn.init.normal_(module.weight, mean=0.0, std=std)
-            if module.bias is not None:
-                torch.nn.init.zeros_(module.bias)
-        elif isinstance(module, nn.Embedding):
-            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
-
-    def forward(self, idx, targets=None):
-        # idx is of shape (B, T)
-        B, T = idx.size()
-        assert (
-            T <= self.config.block_size
-        ), f"Cannot forward sequence of length {T}, block size is only {self.config.block_size}"
-        # forward the token and posisition embeddings
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device)  # shape (T)
-        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (T, n_embd)
-        tok_emb = self.transformer.wte(idx)  # token embeddings of shape (B, T, n_embd)
-        x = tok_emb + pos_emb
-        # forward the blocks of the transformer
-        for block in self.transformer.h:
-            x = block(x)
-        # forward the final layernorm and the classifier
-        x = self.transformer.ln_f(x)
-        logits = self.lm_head(x)  # (B, T, vocab_size)
-        loss = None
-        if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
-        return logits, loss
-
-    @classmethod
-    def from_pretrained(cls, model_type):
-        """Loads pretrained GPT-2 model weights from huggingface"""
-        assert model_type in {"gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl"}
-        from transformers import GPT2LMHeadModel
-
-        print("loading weights from pretrained gpt: %s" % model_type)
-
-        # n_layer, n_head and n_embd are determined from model_type
-        config_args = {
-            "gpt2": dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
-            "gpt2-medium": dict(n_layer=24, n_head=16, n_embd=1024),  # 350M params
-            "gpt2-large": dict(n_layer=36, n_head=20, n_embd=1280),  # 774M params
-            "gpt2-xl": dict(n_layer=48, n_head=25, n_embd=1600),  # 1558M params
-        }[model_type]
-        config_args["vocab_size"] = 50257  # always 50257 for GPT model checkpoints
-        config_args["block_size"] = 1024  # always 1024 for GPT model checkpoints
-        # create a from-scratch initialized minGPT model
-        config = GPTConfig(**config_args)
-        model = GPT(config)
-        sd = model.state_dict()
-        sd_keys = sd.keys()
-        sd_keys = [
-            k for k in sd_keys if not k.endswith(".attn.bias")
-        ]  # discard this mask / buffer, not a param
-
-        # init a huggingface/transformers model
-        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
-        sd_hf = model_hf.state_dict()
-
-        # copy while ensuring all of the parameters are aligned and match in names and shapes
-        sd_keys_hf = sd_hf.keys()
-        sd_keys_hf = [
-            k for k in sd_keys_hf if not k.endswith(".attn.masked_bias")
-        ]  # ignore these, just a buffer
-        sd_keys_hf = [
-            k for k in sd_keys_hf if not k.endswith(".attn.bias")
-        ]  # same, just the mask (buffer)
-        transposed = [
-            "attn.c_attn.weight",
-            "attn.c_proj.weight",
-            "mlp.c_fc.weight",
-            "mlp.c_proj.weight",
-        ]
-        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
-        # this means that we have to transpose these weights when we import them
-        assert len(sd_keys_hf) == len(
-            sd_keys
-        ), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
-        for k in sd_keys_hf:
-            if any(k.endswith(w) for w in transposed):
-                # special treatment for the Conv1D weights we need to transpose
-                assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
-            else:
-                # vanilla copy over the other parameters
-                assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
-
-        return model
-
-    def configure_optimizers(self, weight_decay, learning_rate, device_type):
-        # start with all of the candidate parameters (that require grad)
-        param_dict = {pn: p for pn, p in self.named_parameters()}
-        param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
-        # create optim groups. Any parameters that is 2D will be weight decayed, otherwise no.
-        # i.e. all weight tensors in matmuls + embeddings decay, all biases and layernorms don't.
-        decay_params = [p for n, p in param_dict.items() if p.dim() >= 2]
-        nodecay_params = [p for n, p in param_dict.items() if p.dim() < 2]
-        optim_groups = [
-            {"params": decay_params, "weight_decay": weight_decay},
-            {"params": nodecay_params, "weight_decay": 0.0},
-        ]
-        num_decay_params = sum(p.numel() for p in decay_params)
-        num_nodecay_params = sum(p.numel() for p in nodecay_params)
-        if master_process:
-            print(
-                f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters"
-            )
-            print(
-                f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters"
-            )
-        # Create AdamW optimizer and use the fused version if it is available
-        fused_available = "fused" in inspect.signature(torch.optim.AdamW).parameters
-        use_fused = fused_available and device_type == "cuda"
-        if master_process:
-            print(f"using fused AdamW: {use_fused}")
-        optimizer = torch.optim.AdamW(
-            optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused
-        )
-        return optimizer
-
+from model import GPT, MLP, CausalSelfAttention, GPTConfig, document_ids
+from hellaswag import evaluate_batched, load_tokenized
+from dataloader import DataLoaderLite, PrefetchLoader
+from distributed import BucketHookState, bucket_hook, pin_threads, stamp
+from metrics import StepMetrics, flops_per_token, peak_flops
+from profiling import ProfileWindow
+from memory import find_micro_batch_size
+from checkpoint import (
+    AsyncCheckpointWriter,
+    find_latest_checkpoint,
+    get_rng_state,
+    load_checkpoint,
+    optimizer_state_by_id,
+    optimizer_state_by_name,
+    set_rng_state,
+)
 
 # -----------------------------------------------------------------------------
 import tiktoken
 import numpy as np
 
 
-def load_tokens(filename):
-    npt = np.load(filename)
-    npt = npt.astype(np.int32)  # added after video
-    ptt = torch.tensor(npt, dtype=torch.long)
-    return ptt
-
-
-class DataLoaderLite:
-    def __init__(self, B, T, process_rank, num_processes, split):
-        self.B = B
-        self.T = T
-        self.process_rank = process_rank
-        self.num_processes = num_processes
-        assert split in {"train", "val"}
-
-        # get the shard filenames
-        data_root = "edu_fineweb10B"
-        shards = os.listdir(data_root)
-        shards = [s for s in shards if split in s]
-        shards = sorted(shards)
-        shards = [os.path.join(data_root, s) for s in shards]
-        self.shards = shards
-        assert len(shards) > 0, f"no shards found for split {split}"
-        if master_process:
-            print(f"found {len(shards)} shards for split {split}")
-        self.reset()
-
-    def reset(self):
-        # state, init at shard zero
-        self.current_shard = 0
-        self.tokens = load_tokens(self.shards[self.current_shard])
-        self.current_position = self.B * self.T * self.process_rank
-
-    def next_batch(self):
-        B, T = self.B, self.T
-        buf = self.tokens[self.current_position : self.current_position + B * T + 1]
-        x = (buf[:-1]).view(B, T)  # inputs
-        y = (buf[1:]).view(B, T)  # targets
-        # advance the position in the tensor
-        self.current_position += B * T * self.num_processes
-        # if loading the next batch would be out of bounds, advance to next shard
-        if self.current_position + (B * T * self.num_processes + 1) > len(self.tokens):
-            self.current_shard = (self.current_shard + 1) % len(self.shards)
-            self.tokens = load_tokens(self.shards[self.current_shard])
-            self.current_position = B * T * self.process_rank
-        return x, y
-
-
-# -----------------------------------------------------------------------------
-# helper function for HellaSwag eval
-# takes tokens, mask, and logits, returns the index of the completion with the lowest loss
-
-
-def get_most_likely_row(tokens, mask, logits):
-    # evaluate the autoregressive loss at all positions
-    shift_logits = (logits[..., :-1, :]).contiguous()
-    shift_tokens = (tokens[..., 1:]).contiguous()
-    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-    flat_shift_tokens = shift_tokens.view(-1)
-    shift_losses = F.cross_entropy(
-        flat_shift_logits, flat_shift_tokens, reduction="none"
-    )
-    shift_losses = shift_losses.view(tokens.size(0), -1)
-    # now get the average loss just for the completion region (where mask == 1), in each row
-    shift_mask = (
-        mask[..., 1:]
-    ).contiguous()  # we must shift mask, so we start at the last prompt token
-    masked_shift_losses = shift_losses * shift_mask
-    # sum and divide by the number of 1s in the mask
-    sum_loss = masked_shift_losses.sum(dim=1)
-    avg_loss = sum_loss / shift_mask.sum(dim=1)
-    # now we have a loss for each of the 4 completions
-    # the one with the lowest loss should be the most likely
-    pred_norm = avg_loss.argmin().item()
-    return pred_norm
+@contextlib.contextmanager
+def gathered(model):
+    """
+    Under FSDP, all-gathers the full parameters of model for the duration of the block,
+    so its forward passes don't communicate and every rank can run a different number
+    of them (HellaSwag, sampling). A no-op for a model that is not sharded.
+    """
+    modules = [m for m in model.modules() if isinstance(m, FSDPModule)]
+    for m in modules:
+        m.unshard()
+        m.set_reshard_after_forward(False, recurse=False)
+    try:
+        yield
+    finally:
+        for m in modules:
+            m.reshard()
+            m.set_reshard_after_forward(True, recurse=False)
 
 
 # -----------------------------------------------------------------------------
@@ -331,24 +49,202 @@ def get_most_likely_row(tokens, mask, logits):
 # python train_gpt2.py
 # DDP launch for e.g. 8 GPUs:
 # torchrun --standalone --nproc_per_node=8 train_gpt2.py
+# the same on a machine without GPUs runs 8 CPU processes over gloo, each on its own cores
+# resume a preempted run from the latest checkpoint in log/ (or a given path):
+# torchrun --standalone --nproc_per_node=8 train_gpt2.py --resume
+# train on the documents of all shards in a shuffled order (needs the shard index):
+# torchrun --standalone --nproc_per_node=8 train_gpt2.py --shuffle
+# attend within documents only, with positions restarting at every document:
+# torchrun --standalone --nproc_per_node=8 train_gpt2.py --packed
+# shard parameters, gradients and AdamW state across the ranks instead of replicating:
+# torchrun --standalone --nproc_per_node=8 train_gpt2.py --fsdp
+# profile steps 50 to 54 on rank 0, traces and op summaries go to log/:
+# torchrun --standalone --nproc_per_node=8 train_gpt2.py --profile 50:55
+# tune the gradient all-reduce of a multi-node run (see the compute/comm breakdown):
+# torchrun --nnodes=2 --nproc_per_node=8 ... train_gpt2.py --bucket_cap_mb 100 --comm_hook bf16
 
 # run the training loop
+import argparse
 from torch.distributed import init_process_group, destroy_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.profiler import record_function
+from torch.distributed.fsdp import FSDPModule, fully_shard
+from torch.distributed.checkpoint.state_dict import (
+    StateDictOptions,
+    get_model_state_dict,
+    get_optimizer_state_dict,
+    set_optimizer_state_dict,
+)
 import torch.distributed as dist
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--resume",
+    type=str,
+    nargs="?",
+    const="latest",
+    default=None,
+    help="checkpoint to resume from, or the latest one in log/ if no path is given",
+)
+parser.add_argument(
+    "--checkpoint_every", type=int, default=5000, help="steps between checkpoints"
+)
+parser.add_argument(
+    "--checkpoint_format",
+    type=str,
+    choices=["single", "sharded"],
+    default=None,
+    help="one file written by rank 0, or a directory every rank writes its slice to"
+    " (default: sharded for DDP runs, single otherwise, and always with --fsdp)",
+)
+parser.add_argument(
+    "--compile",
+    action=argparse.BooleanOptionalAction,
+    default=None,
+    help="torch.compile the training model (default: on for CUDA)",
+)
+parser.add_argument(
+    "--shuffle",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="train on the documents of all shards in a seeded random order per epoch",
+)
+parser.add_argument(
+    "--data_seed", type=int, default=1337, help="seed of the --shuffle data order"
+)
+parser.add_argument(
+    "--packed",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="treat every window as packed documents: attention and positions restart"
+    " at every <|endoftext|>",
+)
+parser.add_argument(
+    "--loss_chunk_size",
+    type=int,
+    default=0,
+    help="compute lm_head + loss this many tokens at a time, without ever holding"
+    " the full logits (0: off)",
+)
+parser.add_argument(
+    "--activation_checkpoint",
+    type=str,
+    choices=["none", "block", "attn", "mlp"],
+    default="none",
+    help="recompute these activations in backward instead of storing them",
+)
+parser.add_argument(
+    "--activation_checkpoint_every",
+    type=int,
+    default=1,
+    help="apply --activation_checkpoint to every N-th block",
+)
+parser.add_argument(
+    "-B",
+    "--micro_batch_size",
+    type=int,
+    default=None,
+    help="micro batch size, larger ones need fewer gradient accumulation steps"
+    " (default: the largest that fits in memory, see memory.py)",
+)
+parser.add_argument(
+    "--memory_budget",
+    type=float,
+    default=None,
+    help="GB per rank the automatic micro batch size may use"
+    " (default: free device memory, or the rank's share of the available RAM)",
+)
+parser.add_argument(
+    "--fsdp",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="fully sharded data parallel: every rank holds only its slice of the"
+    " parameters, gradients and AdamW state (DDP runs only)",
+)
+parser.add_argument(
+    "--cpu_threads",
+    type=int,
+    default=None,
+    help="threads (and cores) per rank of a DDP run on CPU"
+    " (default: the cores divided among the ranks on the host)",
+)
+parser.add_argument(
+    "--bucket_cap_mb",
+    type=float,
+    default=25,
+    help="size of the DDP gradient buckets, each is all-reduced as soon as it is ready",
+)
+parser.add_argument(
+    "--comm_hook",
+    type=str,
+    choices=["none", "fp16", "bf16", "powersgd"],
+    default="none",
+    help="compression of the DDP gradient all-reduce",
+)
+parser.add_argument(
+    "--powersgd_rank",
+    type=int,
+    default=1,
+    help="rank of the low-rank gradient approximation of --comm_hook powersgd",
+)
+parser.add_argument(
+    "--metrics",
+    type=str,
+    choices=["jsonl", "prometheus", "none"],
+    default="jsonl",
+    help="per-step metrics to log/metrics.jsonl, or log/metrics.prom for Prometheus",
+)
+parser.add_argument(
+    "--peak_tflops",
+    type=float,
+    default=None,
+    help="peak bf16 TFLOPS of one device for MFU (default: known GPUs only)",
+)
+parser.add_argument(
+    "--profile",
+    type=str,
+    default=os.environ.get("GPT_PROFILE"),
+    help="start:end, torch.profiler trace of steps start..end-1 (env GPT_PROFILE)",
+)
+parser.add_argument(
+    "--profile_ranks",
+    type=int,
+    nargs="+",
+    default=[int(r) for r in os.environ.get("GPT_PROFILE_RANKS", "0").split(",")],
+    help="ranks that profile (env GPT_PROFILE_RANKS, comma separated)",
+)
+parser.add_argument(
+    "--profile_top", type=int, default=20, help="ops in the profile summary"
+)
+parser.add_argument(
+    "--n_layer", type=int, default=12, help="e.g. 2-4 for a speculative draft model"
+)
+parser.add_argument("--n_head", type=int, default=12)
+parser.add_argument("--n_embd", type=int, default=768)
+parser.add_argument(
+    "--log_dir", type=str, default="log", help="where the logs and checkpoints go"
+)
+args = parser.parse_args()
+
 # set up DDP (distributed data parallel).
 # torchrun command sets the env variables RANK, LOCAL_RANK, and WORLD_SIZE
 ddp = int(os.environ.get("RANK", -1)) != -1  # is this a ddp run?
 if ddp:
-    # use of DDP atm demands CUDA, we set the device appropriately according to rank
-    assert torch.cuda.is_available(), "for now i think we need CUDA for DDP"
-    init_process_group(backend="nccl")
+    # one GPU per rank over nccl, or CPU processes over gloo if there are no GPUs
+    init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
     ddp_rank = int(os.environ["RANK"])
     ddp_local_rank = int(os.environ["LOCAL_RANK"])
     ddp_world_size = int(os.environ["WORLD_SIZE"])
-    device = f"cuda:{ddp_local_rank}"
-    torch.cuda.set_device(device)
+    device = "cpu"
+    if torch.cuda.is_available():
+        device = f"cuda:{ddp_local_rank}"
+        torch.cuda.set_device(device)
+    else:
+        # the ranks on this host share its cores, give each its own slice of them
+        ddp_local_world_size = int(os.environ["LOCAL_WORLD_SIZE"])
+        cores = pin_threads(ddp_local_rank, ddp_local_world_size, args.cpu_threads)
+        if ddp_rank == 0:
+            print(f"using {ddp_world_size} CPU processes, {len(cores)} threads each")
     master_process = ddp_rank == 0  # this process will do logging, checkpointing etc.
 else:
     # vanilla, non-DDP run
@@ -366,16 +262,87 @@ else:
 
 # added after video, pytorch can be serious about it's device vs. device_type distinction
 device_type = "cuda" if device.startswith("cuda") else "cpu"
+fsdp = ddp and args.fsdp
 
 torch.manual_seed(1337)
 if torch.cuda.is_available():
     torch.cuda.manual_seed(1337)
 
+# the log directory we will write checkpoints to and log to
+log_dir = args.log_dir
+checkpoint_format = args.checkpoint_format or (
+    "sharded" if ddp and not fsdp else "single"
+)
+# the sharded format has every rank write a slice of the full state, FSDP only ever
+# gathers the full state on rank 0
+assert not (
+    fsdp and checkpoint_format == "sharded"
+), "--fsdp writes single-file checkpoints"
+resume_checkpoint = None
+if args.resume is not None:
+    resume_path = args.resume
+    if resume_path == "latest":
+        resume_path = find_latest_checkpoint(log_dir)
+        assert resume_path is not None, f"no checkpoint to resume from in {log_dir}"
+    # every rank reads only its slice of a sharded checkpoint, the model and
+    # optimizer tensors are all-gathered when they are first used below
+    resume_checkpoint = load_checkpoint(resume_path, ddp_rank, ddp_world_size, device)
+    if master_process:
+        print(f"resuming from {resume_path} at step {resume_checkpoint['step']}")
+
 enc = tiktoken.get_encoding("gpt2")
 
+torch.set_float32_matmul_precision("high")
+
+# create model
+model = GPT(
+    GPTConfig(
+        vocab_size=50304,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        n_embd=args.n_embd,
+        loss_chunk_size=args.loss_chunk_size,
+        activation_checkpoint=args.activation_checkpoint,
+        activation_checkpoint_every=args.activation_checkpoint_every,
+    )
+)
+# model = GPT.from_pretrained("gpt2") # or init from OpenAI GPT-2
+if resume_checkpoint is not None:
+    model.load_state_dict(resume_checkpoint["model"])
+model.to(device)
+if fsdp:
+    # shard every block and then the rest (embeddings, final layernorm) in place.
+    # A block's full parameters are all-gathered just before its forward and its
+    # backward and freed after, its gradients are reduce-scattered to their owners
+    for block in model.transformer.h:
+        fully_shard(block)
+    fully_shard(model)
+
 total_batch_size = 524288  # 2**19, ~0.5M, in number of tokens
-B = 64  # micro batch size
 T = 1024  # sequence length
+B = args.micro_batch_size  # micro batch size
+if B is None and resume_checkpoint is not None:
+    # the data positions in the checkpoint are strided by its B, keep it rather than
+    # pick one that may differ (another GPU, a driver with more free memory)
+    if resume_checkpoint.get("world_size") == ddp_world_size:
+        B = resume_checkpoint.get("micro_batch_size")
+    if B is not None and master_process:
+        print(f"micro batch size {B} from the checkpoint")
+if B is None:
+    # the largest that fits, probed on the model before DDP/compile wrap it
+    B, report = find_micro_batch_size(
+        model,
+        T,
+        total_batch_size,
+        device,
+        world_size=ddp_world_size,
+        local_world_size=int(os.environ.get("LOCAL_WORLD_SIZE", 1)),
+        ddp=ddp,
+        fsdp=fsdp,
+        budget=args.memory_budget and args.memory_budget * 2**30,
+    )
+    if master_process:
+        print("\n".join(report))
 assert (
     total_batch_size % (B * T * ddp_world_size) == 0
 ), "make sure total_batch_size is divisible by B * T * ddp_world_size"
@@ -385,26 +352,68 @@ if master_process:
     print(f"=> calculated gradient accumulation steps: {grad_accum_steps}")
 
 train_loader = DataLoaderLite(
-    B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="train"
+    B=B,
+    T=T,
+    process_rank=ddp_rank,
+    num_processes=ddp_world_size,
+    split="train",
+    memmap=True,
+    shuffle=args.shuffle,
+    seed=args.data_seed,
+    verbose=master_process,
 )
 val_loader = DataLoaderLite(
-    B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="val"
-)
-
-torch.set_float32_matmul_precision("high")
-
-# create model
-model = GPT(GPTConfig(vocab_size=50304))
-# model = GPT.from_pretrained("gpt2") # or init from OpenAI GPT-2
-model.to(device)
-use_compile = (
-    False  # torch.compile interferes with HellaSwag eval and Generation. TODO fix
+    B=B,
+    T=T,
+    process_rank=ddp_rank,
+    num_processes=ddp_world_size,
+    split="val",
+    memmap=True,
+    verbose=master_process,
 )
+if resume_checkpoint is not None:
+    # the two modes keep different positions, neither carries over to the other
+    shuffled = "doc" in resume_checkpoint["loader"][0]
+    assert (
+        shuffled == args.shuffle
+    ), f"the checkpoint was taken {'with' if shuffled else 'without'} --shuffle"
+    if args.shuffle:
+        # every rank has the same position (windows taken by all ranks), it carries
+        # over to any number of ranks without repeating or skipping a window
+        train_loader.load_state_dict(resume_checkpoint["loader"][0])
+    elif resume_checkpoint["world_size"] == ddp_world_size and (
+        resume_checkpoint.get("micro_batch_size", B) == B
+    ):
+        train_loader.load_state_dict(resume_checkpoint["loader"][ddp_rank])
+        assert (train_loader.current_position - B * T * ddp_rank) % (
+            B * T * ddp_world_size
+        ) == 0, "the checkpoint's data position is not on this rank's stride of B*T"
+    else:
+        # the rank striding (world size or -B) changed, so the positions of the old
+        # ranks don't carry over; restart every rank at the shard old rank 0 reached
+        train_loader.current_shard = resume_checkpoint["loader"][0]["current_shard"]
+        train_loader.load_shard()
+        train_loader.current_position = B * T * ddp_rank
+# host slicing and H2D copies of the train batches happen off the critical path
+train_batches = PrefetchLoader(train_loader, device=device)
+# always contains the "raw" unwrapped, uncompiled model. It shares its parameters with
+# the compiled/DDP one, and HellaSwag and generation run on it: their shapes change
+# every call, which would keep recompiling the training graph
+raw_model = model
+use_compile = args.compile if args.compile is not None else device_type == "cuda"
 if use_compile:
     model = torch.compile(model)
-if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model  # always contains the "raw" unwrapped model
+comm_state = None
+if ddp and not fsdp:
+    model = DDP(
+        model,
+        device_ids=[ddp_local_rank] if device_type == "cuda" else None,
+        bucket_cap_mb=args.bucket_cap_mb,
+    )
+    # reduces (and optionally compresses) the gradient buckets, carries the loss
+    # along, and times the communication
+    comm_state = BucketHookState(device, args.comm_hook, args.powersgd_rank)
+    model.register_comm_hook(comm_state, bucket_hook)
 
 max_lr = 6e-4
 min_lr = max_lr * 0.1
@@ -430,24 +439,114 @@ def get_lr(it):
     return min_lr + coeff * (max_lr - min_lr)
 
 
-# optimize!
+# optimize! Under FSDP the parameters are already sharded, so the optimizer (and the
+# AdamW state it creates) only ever sees this rank's slices
 optimizer = raw_model.configure_optimizers(
-    weight_decay=0.1, learning_rate=6e-4, device_type=device_type
+    weight_decay=0.1,
+    learning_rate=6e-4,
+    device_type=device_type,
+    verbose=master_process,
 )
 
+start_step = 0
+if resume_checkpoint is not None:
+    if fsdp:
+        # full state keyed by parameter name, every rank keeps only its slices
+        set_optimizer_state_dict(
+            raw_model,
+            optimizer,
+            optimizer_state_by_name(
+                resume_checkpoint["optimizer"], raw_model, optimizer
+            ),
+            options=StateDictOptions(full_state_dict=True),
+        )
+    else:
+        optimizer.load_state_dict(resume_checkpoint["optimizer"])
+    start_step = resume_checkpoint["step"]
+    rng_states = resume_checkpoint["rng"]
+    # restored last, model init above draws from the torch RNG
+    set_rng_state(rng_states[ddp_rank % len(rng_states)])
+    del resume_checkpoint  # don't hold a second copy of the state for the whole run
+
 # create the log directory we will write checkpoints to and log to
-log_dir = "log"
 os.makedirs(log_dir, exist_ok=True)
 log_file = os.path.join(log_dir, f"log.txt")
-with open(log_file, "w") as f:  # open for writing to clear the file
-    pass
+if start_step == 0:
+    with open(log_file, "w") as f:  # open for writing to clear the file
+        pass
+# per-step timings, memory and MFU, reported one step late so nothing waits on the GPU
+metrics_path = None
+if master_process and args.metrics != "none":
+    metrics_path = os.path.join(
+        log_dir, "metrics.jsonl" if args.metrics == "jsonl" else "metrics.prom"
+    )
+    if start_step == 0 and args.metrics == "jsonl":
+        with open(metrics_path, "w") as f:
+            pass
+step_metrics = StepMetrics(
+    device,
+    ddp_world_size,
+    flops_per_token(raw_model.config, T),
+    peak_flops=(
+        args.peak_tflops * 1e12 if args.peak_tflops is not None else peak_flops(device)
+    ),
+    path=metrics_path,
+    fmt=args.metrics,
+)
+
+# torch.profiler window, the module ranges need the eager model
+profiler = ProfileWindow(
+    args.profile,
+    ddp_rank,
+    args.profile_ranks,
+    log_dir,
+    device_type,
+    model=None if use_compile else raw_model,
+    module_types=(CausalSelfAttention, MLP),
+    first_step=start_step,
+    top=args.profile_top,
+)
+
 
-for step in range(max_steps):
-    t0 = time.time()
+def log_step(record):
+    if record is None or not master_process:
+        return
+    comm_info = ""
+    if record["comm"] is not None:
+        # how much of forward + backward was compute, and how much communication
+        # was left over once the last bucket was ready (exposed)
+        compute = record["forward"] + record["backward"] - record["comm_exposed"]
+        comm_info = f" | compute: {compute*1000:.2f}ms | comm: {record['comm']*1000:.2f}ms (exposed {record['comm_exposed']*1000:.2f}ms)"
+    mfu_info = f" | mfu: {record['mfu']:.2%}" if record["mfu"] is not None else ""
+    print(
+        f"step {record['step']:5d} | loss: {record['loss']:.6f} | lr {record['lr']:.4e} | norm: {record['norm']:.4f} | dt: {record['dt']*1000:.2f}ms | data: {record['data_wait']*1000:.2f}ms{comm_info} | tok/sec: {record['tokens_per_sec']:.2f}{mfu_info}"
+    )
+    with open(log_file, "a") as f:
+        f.write(f"{record['step']} train {record['loss']:.6f}\n")
+
+
+checkpoint_writer = AsyncCheckpointWriter()
+
+# tokenize hellaswag once (cached on disk), every eval only slices the arrays;
+# rank 0 builds the cache so the other ranks don't race to write it
+if master_process:
+    load_tokenized("val")
+if ddp:
+    dist.barrier()
+hellaswag_val = load_tokenized("val")
+# only process examples where i % ddp_world_size == ddp_rank
+hellaswag_indices = np.arange(ddp_rank, len(hellaswag_val), ddp_world_size)
+val_loss = None
+val_loss_step = None  # the step val_loss was measured at, not every checkpoint's
+
+for step in range(start_step, max_steps):
     last_step = step == max_steps - 1
+    profiler.begin(step)
 
     # once in a while evaluate our validation loss
     if step % 250 == 0 or last_step:
+        # the eval waits for the GPU anyway, report the previous step before it
+        log_step(step_metrics.flush())
         model.eval()
         val_loader.reset()
         with torch.no_grad():
@@ -456,48 +555,83 @@ for step in range(max_steps):
             for _ in range(val_loss_steps):
                 x, y = val_loader.next_batch()
                 x, y = x.to(device), y.to(device)
+                doc_ids = document_ids(x, enc.eot_token) if args.packed else None
                 with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(x, y)
+                    logits, loss = model(x, y, doc_ids=doc_ids)
                 loss = loss / val_loss_steps
                 val_loss_accum += loss.detach()
         if ddp:
             dist.all_reduce(val_loss_accum, op=dist.ReduceOp.AVG)
+        val_loss = val_loss_accum.item()
+        val_loss_step = step
         if master_process:
-            print(f"validation loss: {val_loss_accum.item():.4f}")
+            print(f"validation loss: {val_loss:.4f}")
             with open(log_file, "a") as f:
-                f.write(f"{step} val {val_loss_accum.item():.4f}\n")
-            if step > 0 and (step % 5000 == 0 or last_step):
-                # optionally write model checkpoints
+                f.write(f"{step} val {val_loss:.4f}\n")
+
+    # write a resumable checkpoint, a resumed run already has the one for start_step
+    if step > start_step and (step % args.checkpoint_every == 0 or last_step):
+        if fsdp:
+            # gather the full tensors into the host memory of rank 0 only, the other
+            # ranks get empty dicts. The checkpoint has the same layout as a DDP one,
+            # and loads in either mode
+            options = StateDictOptions(full_state_dict=True, cpu_offload=True)
+            model_state = get_model_state_dict(raw_model, options=options)
+            optimizer_state = get_optimizer_state_dict(
+                raw_model, optimizer, options=options
+            )
+            if master_process:
+                optimizer_state = optimizer_state_by_id(optimizer_state)
+        else:
+            model_state = raw_model.state_dict()
+            optimizer_state = optimizer.state_dict()
+        checkpoint = {
+            "model": model_state,
+            "optimizer": optimizer_state,
+            "config": raw_model.config,
+            "micro_batch_size": B,
+            "step": step,
+            "val_loss": val_loss,
+            "val_loss_step": val_loss_step,
+        }
+        if checkpoint_format == "sharded":
+            # every rank writes its own slice of every tensor, and its own
+            # RNG streams and data position
+            checkpoint_writer.save_sharded(
+                checkpoint,
+                {"rng": get_rng_state(), "loader": train_batches.state_dict()},
+                os.path.join(log_dir, f"model_{step:05d}"),
+                ddp_rank,
+                ddp_world_size,
+            )
+        else:
+            # every rank has its own RNG streams and data position, gather them on rank 0
+            rng_states = [get_rng_state()]
+            loader_states = [train_batches.state_dict()]
+            if ddp:
+                rng_states = [None] * ddp_world_size
+                loader_states = [None] * ddp_world_size
+                dist.all_gather_object(rng_states, get_rng_state())
+                dist.all_gather_object(loader_states, train_batches.state_dict())
+            if master_process:
+                checkpoint["world_size"] = ddp_world_size
+                checkpoint["rng"] = rng_states
+                checkpoint["loader"] = loader_states
                 checkpoint_path = os.path.join(log_dir, f"model_{step:05d}.pt")
-                checkpoint = {
-                    "model": raw_model.state_dict(),
-                    "config": raw_model.config,
-                    "step": step,
-                    "val_loss": val_loss_accum.item(),
-                }
-                # you might also want to add optimizer.state_dict() and
-                # rng seeds etc., if you wanted to more exactly resume training
-                torch.save(checkpoint, checkpoint_path)
+                checkpoint_writer.save(checkpoint, checkpoint_path)
 
     # once in a while evaluate hellaswag
-    if (step % 250 == 0 or last_step) and (not use_compile):
-        num_correct_norm = 0
-        num_total = 0
-        for i, example in enumerate(iterate_examples("val")):
-            # only process examples where i % ddp_world_size == ddp_rank
-            if i % ddp_world_size != ddp_rank:
-                continue
-            # render the example into tokens and labels
-            _, tokens, mask, label = render_example(example)
-            tokens = tokens.to(device)
-            mask = mask.to(device)
-            # get the logits
-            with torch.no_grad():
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(tokens)
-                pred_norm = get_most_likely_row(tokens, mask, logits)
-            num_total += 1
-            num_correct_norm += int(pred_norm == label)
+    if step % 250 == 0 or last_step:
+        # this rank's examples, many of them packed into every forward pass
+        with gathered(raw_model), torch.autocast(
+            device_type=device_type, dtype=torch.bfloat16
+        ):
+            _, num_correct_norm, num_total = evaluate_batched(
+                lambda tokens: raw_model(tokens)[0],
+                hellaswag_val,
+                device,
+                indices=hellaswag_indices,
+            )
         # reduce the stats across all processes
         if ddp:
             num_total = torch.tensor(num_total, dtype=torch.long, device=device)
@@ -515,82 +649,100 @@ for step in range(max_steps):
                 f.write(f"{step} hella {acc_norm:.4f}\n")
 
     # once in a while generate from the model (except step 0, which is noise)
-    if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile):
+    if (step > 0 and step % 250 == 0) or last_step:
         model.eval()
         num_return_sequences = 4
         max_length = 32
         tokens = enc.encode("Hello, I'm a language model,")
-        tokens = torch.tensor(tokens, dtype=torch.long)
-        tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
-        xgen = tokens.to(device)
         sample_rng = torch.Generator(device=device)
         sample_rng.manual_seed(42 + ddp_rank)
-        while xgen.size(1) < max_length:
-            # forward the model to get the logits
-            with torch.no_grad():
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(xgen)  # (B, T, vocab_size)
-                # take the logits at the last position
-                logits = logits[:, -1, :]  # (B, vocab_size)
-                # get the probabilities
-                probs = F.softmax(logits, dim=-1)
-                # do top-k sampling of 50 (huggingface pipeline default)
-                # topk_probs here becomes (5, 50), topk_indices is (5, 50)
-                topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-                # select a token from the top-k probabilities
-                # note: multinomial does not demand the input to sum to 1
-                ix = torch.multinomial(topk_probs, 1, generator=sample_rng)  # (B, 1)
-                # gather the corresponding indices
-                xcol = torch.gather(topk_indices, -1, ix)  # (B, 1)
-                # append to the sequence
-                xgen = torch.cat((xgen, xcol), dim=1)
+        # KV-cached decoding, top-k sampling of 50 (huggingface pipeline default)
+        with gathered(raw_model), torch.autocast(
+            device_type=device_type, dtype=torch.bfloat16
+        ):
+            samples = raw_model.generate(
+                [tokens] * num_return_sequences,
+                max_length - len(tokens),
+                top_k=50,
+                generator=sample_rng,
+            )
         # print the generated text
         for i in range(num_return_sequences):
-            tokens = xgen[i, :max_length].tolist()
-            decoded = enc.decode(tokens)
+            decoded = enc.decode(samples[i])
             print(f"rank {ddp_rank} sample {i}: {decoded}")
 
     # do one step of the optimization
     model.train()
     optimizer.zero_grad()
     loss_accum = 0.0
+    train_batches.wait_time = 0.0
+    if comm_state is not None:
+        comm_state.reset()
+    step_start = stamp(device)
+    micro_stamps = []
     for micro_step in range(grad_accum_steps):
-        x, y = train_loader.next_batch()
-        x, y = x.to(device), y.to(device)
+        x, y = train_batches.next_batch()
+        # the documents are delimited in-band, so their ids are derived on the device
+        doc_ids = document_ids(x, enc.eot_token) if args.packed else None
         # added after video, this field is also used by the forward pass.
-        if ddp:
+        # FSDP reduce-scatters every micro step instead: skipping it would mean
+        # holding full, unsharded gradients until the last one
+        if ddp and not fsdp:
             model.require_backward_grad_sync = micro_step == grad_accum_steps - 1
-        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-            logits, loss = model(x, y)
+        forward_start = stamp(device)
+        with record_function("forward"), torch.autocast(
+            device_type=device_type, dtype=torch.bfloat16
+        ):
+            logits, loss = model(x, y, doc_ids=doc_ids)
+        forward_end = stamp(device)
         # we have to scale the loss to account for gradient accumulation,
         # because the gradients just add on each successive backward().
         # addition of gradients corresponds to a SUM in the objective, but
         # instead of a SUM we want MEAN. Scale the loss here so it comes out right
         loss = loss / grad_accum_steps
         loss_accum += loss.detach()
-        loss.backward()
-    if ddp:
-        dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)
-    norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-    # determine and set the learning rate for this iteration
-    lr = get_lr(step)
-    for param_group in optimizer.param_groups:
-        param_group["lr"] = lr
-    optimizer.step()
-    if device_type == "cuda":
-        torch.cuda.synchronize()  # wait for the GPU to finish work
-    t1 = time.time()
-    dt = t1 - t0  # time difference in seconds
-    tokens_processed = (
-        train_loader.B * train_loader.T * grad_accum_steps * ddp_world_size
-    )
-    tokens_per_sec = tokens_processed / dt
-    if master_process:
-        print(
-            f"step {step:5d} | loss: {loss_accum.item():.6f} | lr {lr:.4e} | norm: {norm:.4f} | dt: {dt*1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}"
-        )
-        with open(log_file, "a") as f:
-            f.write(f"{step} train {loss_accum.item():.6f}\n")
-
+        if comm_state is not None and micro_step == grad_accum_steps - 1:
+            # averaged across the ranks in the last gradient bucket's all-reduce
+            comm_state.loss = loss_accum
+        with record_function("backward"):
+            loss.backward()
+        micro_stamps.append((forward_start, forward_end, stamp(device)))
+    backward_end = stamp(device)
+    with record_function("optimizer"):
+        if fsdp:
+            dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)
+        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        if fsdp:
+            # the norm over all shards, already used for clipping
+            norm = norm.full_tensor()
+        # determine and set the learning rate for this iteration
+        lr = get_lr(step)
+        for param_group in optimizer.param_groups:
+            param_group["lr"] = lr
+        optimizer.step()
+    # no sync: the events recorded along the way are read once the step is done
+    stamps = {
+        "start": step_start,
+        "micro_steps": micro_stamps,
+        "backward_end": backward_end,
+        "end": stamp(device),
+        "comm": (
+            (comm_state.launches, comm_state.completions)
+            if comm_state is not None
+            else None
+        ),
+    }
+    values = {
+        "loss": loss_accum,
+        "norm": norm,
+        "lr": lr,
+        "data_wait": train_batches.wait_time,  # time spent blocked on the prefetcher
+        "tokens": train_loader.B * train_loader.T * grad_accum_steps,
+    }
+    log_step(step_metrics.push(step, stamps, values))
+    profiler.end(step)
+log_step(step_metrics.flush())
+
+checkpoint_writer.wait()
 if ddp:
     destroy_process_group()
@@ -84,6 +84,9 @@ class Head(nn.Module):
         self.register_buffer("tril", torch.tril(torch.ones(block_size, block_size)))
 
         self.dropout = nn.Dropout(dropout)
+        self.kv_cache = (
+            None  # dict holding keys/values of earlier tokens while generating
+        )
 
     def forward(self, x):
         # input of size (batch, time-step, channels)
@@ -91,16 +94,24 @@ class Head(nn.Module):
         B, T, C = x.shape
         k = self.key(x)  # (B,T,hs)
         q = self.query(x)  # (B,T,hs)
+        v = self.value(x)  # (B,T,hs)
+        if self.kv_cache is not None:
+            # incremental decoding: the new tokens also attend to the cached ones
+            if "k" in self.kv_cache:
+                k = torch.cat((self.kv_cache["k"], k), dim=1)  # (B,Tk,hs)
+                v = torch.cat((self.kv_cache["v"], v), dim=1)  # (B,Tk,hs)
+            self.kv_cache["k"], self.kv_cache["v"] = k, v
+        Tk = k.shape[1]
         # compute attention scores ("affinities")
         wei = (
             q @ k.transpose(-2, -1) * k.shape[-1] ** -0.5
-        )  # (B, T, hs) @ (B, hs, T) -> (B, T, T)
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float("-inf"))  # (B, T, T)
-        wei = F.softmax(wei, dim=-1)  # (B, T, T)
+        )  # (B, T, hs) @ (B, hs, Tk) -> (B, T, Tk)
+        # the queries are the last T of the Tk positions
+        wei = wei.masked_fill(self.tril[Tk - T : Tk, :Tk] == 0, float("-inf"))
+        wei = F.softmax(wei, dim=-1)  # (B, T, Tk)
         wei = self.dropout(wei)
         # perform the weighted aggregation of the values
-        v = self.value(x)  # (B,T,hs)
-        out = wei @ v  # (B, T, T) @ (B, T, hs) -> (B, T, hs)
+        out = wei @ v  # (B, T, Tk) @ (B, Tk, hs) -> (B, T, hs)
         return out
 
 
@@ -177,12 +188,15 @@ class GPTLanguageModel(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, start_pos=0):
         B, T = idx.shape
 
         # idx and targets are both (B,T) tensor of integers
+        # start_pos is the position of idx[:, 0], non-zero when decoding with the kv cache
         tok_emb = self.token_embedding_table(idx)  # (B,T,C)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=device))  # (T,C)
+        pos_emb = self.position_embedding_table(
+            torch.arange(start_pos, start_pos + T, device=device)
+        )  # (T,C)
         x = tok_emb + pos_emb  # (B,T,C)
         x = self.blocks(x)  # (B,T,C)
         x = self.ln_f(x)  # (B,T,C)
@@ -200,11 +214,21 @@ class GPTLanguageModel(nn.Module):
 
     def generate(self, idx, max_new_tokens):
         # idx is (B, T) array of indices in the current context
+        heads = [head for block in self.blocks for head in block.sa.heads]
+        cached = 0  # number of tokens whose keys/values are in the cache
         for _ in range(max_new_tokens):
-            # crop idx to the last block_size tokens
-            idx_cond = idx[:, -block_size:]
-            # get the predictions
-            logits, loss = self(idx_cond)
+            if cached == 0 or idx.size(1) > block_size:
+                # (re)fill the cache from the last block_size tokens. Once the context is
+                # longer than block_size every position shifts, so the cache can't be reused
+                idx_cond = idx[:, -block_size:]
+                for head in heads:
+                    head.kv_cache = {}
+                logits, loss = self(idx_cond)
+                cached = idx_cond.size(1)
+            else:
+                # only feed the newest token, the earlier ones are in the cache
+                logits, loss = self(idx[:, -1:], start_pos=cached)
+                cached += 1
             # focus only on the last time step
             logits = logits[:, -1, :]  # becomes (B, C)
             # apply softmax to get probabilities
@@ -213,6 +237,8 @@ class GPTLanguageModel(nn.Module):
             idx_next = torch.multinomial(probs, num_samples=1)  # (B, 1)
             # append sampled index to the running sequence
             idx = torch.cat((idx, idx_next), dim=1)  # (B, T+1)
+        for head in heads:
+            head.kv_cache = None
         return idx
 
 